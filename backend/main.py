@@ -1,62 +1,447 @@
+import asyncio
+import bisect
+import contextvars
+import gzip
+import hashlib
+import hmac
 import json
 import html
+import io
+import logging
+import logging.handlers
 import os
+import random
 import re
 import shutil
 import socket
 import zipfile
 import tempfile
+import sqlite3
+import subprocess
 import time
 import threading
 import queue
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 import urllib.parse
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from starlette.datastructures import Headers, MutableHeaders
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 import requests
 from supabase import create_client, Client
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 
+try:
+    import orjson
+except ImportError:  # orjson опционален: без него используется стандартный json
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # без brotli ответы сжимаются только gzip
+    brotli = None
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError as BotoClientError
+except ImportError:  # boto3 нужен только для STORAGE_BACKEND=s3
+    boto3 = None
+    BotoConfig = None
+    BotoClientError = Exception
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # без Pillow превью файлов не генерируются
+    Image = None
+    ImageOps = None
+
+try:
+    import pymupdf  # первая страница PDF без внешних утилит
+except ImportError:  # без PyMuPDF PDF рендерится через pdftoppm, если он установлен
+    pymupdf = None
+
 # Загружаем переменные из .env файла
 env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
 load_dotenv(dotenv_path=env_path, override=True)
-print(f"🔧 Загружен .env из: {env_path}")
-print(f"🔧 Файл существует: {os.path.exists(env_path)}")
+
+# Логирование: запись в очередь на горячем пути, форматирование и вывод в stdout
+# делает отдельный поток QueueListener. Сообщения передаются в стиле "%s", args,
+# поэтому строка не собирается, если уровень отключен.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+LOG_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv("LOG_SAMPLE_RATE", "1.0"))))
+LOG_QUEUE_MAX_SIZE = max(100, int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000")))
+# extra для частых событий запроса: они пишутся с вероятностью LOG_SAMPLE_RATE
+LOG_SAMPLED = {"sampled": True}
+LOG_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName", "sampled"}
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra попадают в нее как есть."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogSamplingFilter(logging.Filter):
+    """Пропускает только долю записей, помеченных extra=LOG_SAMPLED."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if LOG_SAMPLE_RATE >= 1.0 or not getattr(record, "sampled", False):
+            return True
+        return random.random() < LOG_SAMPLE_RATE
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке и без блокировки при переполнении."""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Запись уходит в поток listener внутри процесса, pickle не нужен:
+        # msg % args выполнит Formatter уже там
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+LOG_QUEUE: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json"
+    else logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, _log_stream_handler)
+_log_queue_handler = NonBlockingQueueHandler(LOG_QUEUE)
+_log_queue_handler.addFilter(LogSamplingFilter())
+
+logger = logging.getLogger("bbifather.backend")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(_log_queue_handler)
+logger.propagate = False
+
+def start_log_listener():
+    """Запускает поток вывода логов. Вызывается в lifespan: при preload_app
+    Gunicorn потоки, созданные при импорте, не переживают fork."""
+    if LOG_LISTENER._thread is None:
+        LOG_LISTENER.start()
+
+def stop_log_listener():
+    """Дописывает оставшиеся записи и останавливает поток вывода логов."""
+    if LOG_LISTENER._thread is not None:
+        if NonBlockingQueueHandler.dropped:
+            logger.warning("⚠️ Очередь логов переполнялась, потеряно записей: %s", NonBlockingQueueHandler.dropped)
+        LOG_LISTENER.stop()
+
+logger.info("🔧 Загружен .env из: %s", env_path)
+logger.info("🔧 Файл существует: %s", os.path.exists(env_path))
 
 # Функция для инициализации при запуске
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    start_log_listener()
     if init_database():
-        print("🚀 Backend запущен с Supabase!")
+        logger.info("🚀 Backend запущен с Supabase!")
     else:
-        print("⚠️ Backend запущен без подключения к БД!")
+        logger.warning("⚠️ Backend запущен без подключения к БД!")
     
     if BOT_TOKEN and (BOT_CHAT_ID or ADMIN_CHAT_IDS):
-        print("📱 Telegram уведомления настроены")
-        print(f"🔧 BOT_CHAT_ID: {BOT_CHAT_ID}")
-        print(f"🔧 ADMIN_CHAT_IDS: {ADMIN_CHAT_IDS}")
-        print(f"🔧 Raw TELEGRAM_ADMIN_CHAT_IDS: {os.getenv('TELEGRAM_ADMIN_CHAT_IDS', 'НЕ ЗАДАНО')}")
+        logger.info("📱 Telegram уведомления настроены")
+        logger.info("🔧 BOT_CHAT_ID: %s", BOT_CHAT_ID)
+        logger.info("🔧 ADMIN_CHAT_IDS: %s", ADMIN_CHAT_IDS)
+        logger.info("🔧 Raw TELEGRAM_ADMIN_CHAT_IDS: %s", os.getenv('TELEGRAM_ADMIN_CHAT_IDS', 'НЕ ЗАДАНО'))
         start_telegram_notification_worker()
     else:
-        print("⚠️ Telegram уведомления не настроены")
+        logger.warning("⚠️ Telegram уведомления не настроены")
+    start_preview_workers()
+    start_validation_workers()
+    start_broadcast_worker()
 
     yield
     # Shutdown
+    stop_broadcast_worker()
+    stop_validation_workers()
+    stop_preview_workers()
     stop_telegram_notification_worker()
-    print("👋 Backend остановлен")
+    logger.info("👋 Backend остановлен")
+    stop_log_listener()
+
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ через orjson (если установлен) — заметно быстрее на больших списках заказов."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def fast_json(content: Any, status_code: int = 200) -> FastJSONResponse:
+    """Возвращает уже сформированный dict без прохода jsonable_encoder FastAPI."""
+    return FastJSONResponse(content=content, status_code=status_code)
+
+# Сжатие ответов API: JSON списков заказов сжимается примерно в 10 раз
+API_COMPRESSION_MIN_SIZE = max(0, int(os.getenv("API_COMPRESSION_MIN_SIZE", "1024")))
+API_COMPRESSION_GZIP_LEVEL = min(9, max(1, int(os.getenv("API_COMPRESSION_GZIP_LEVEL", "6"))))
+API_COMPRESSION_BROTLI_QUALITY = min(11, max(0, int(os.getenv("API_COMPRESSION_BROTLI_QUALITY", "4"))))
+COMPRESSIBLE_CONTENT_TYPES = (
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "text/",
+)
+
+def choose_response_encoding(accept_encoding: str) -> Optional[str]:
+    """Выбирает br или gzip по Accept-Encoding (с учетом q=0)."""
+    accepted = set()
+    for token in accept_encoding.lower().split(","):
+        name, _, params = token.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """Сжимает JSON и текстовые ответы API через brotli/gzip.
+
+    Файлы (Content-Disposition: attachment), уже сжатые форматы, ответы без
+    Content-Length и ответы меньше порога проходят без изменений.
+    """
+
+    def __init__(self, app, minimum_size: int = API_COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_response_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        body_parts: List[bytes] = []
+        passthrough = False
+
+        async def send_with_compression(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "").lower()
+                content_length = headers.get("content-length")
+                passthrough = (
+                    "content-encoding" in headers
+                    or "attachment" in headers.get("content-disposition", "").lower()
+                    or not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+                    or content_length is None
+                    or not content_length.isdigit()
+                    or int(content_length) < self.minimum_size
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body_parts.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(body_parts)
+            if encoding == "br":
+                compressed = brotli.compress(body, quality=API_COMPRESSION_BROTLI_QUALITY)
+            else:
+                compressed = gzip.compress(body, compresslevel=API_COMPRESSION_GZIP_LEVEL, mtime=0)
+
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, send_with_compression)
+
+# Метрики запросов: гистограммы задержки по маршрутам и учет вызовов Supabase
+REQUEST_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+REQUEST_TRACE_MAX_CALLS = 50
+
+@dataclass
+class RequestMetrics:
+    started: float
+    supabase_calls: int = 0
+    supabase_seconds: float = 0.0
+    trace: List[str] = field(default_factory=list)
+    # Ответ отправлен: BackgroundTasks после этого наследуют контекст, но в метрики не попадают
+    finished: bool = False
+
+# Sync-эндпоинты выполняются в threadpool, куда контекст копируется, поэтому
+# hook'и httpx видят метрики своего запроса
+CURRENT_REQUEST_METRICS: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar(
+    "current_request_metrics", default=None
+)
+ROUTE_LATENCY_STATS: Dict[str, dict] = {}
+ROUTE_LATENCY_LOCK = threading.Lock()
+
+def on_supabase_request(request):
+    """httpx hook: отметка начала вызова PostgREST."""
+    request.extensions["bbifather_started"] = time.perf_counter()
+
+def on_supabase_response(response):
+    """httpx hook: время вызова PostgREST (включая чтение тела) в метрики текущего запроса."""
+    metrics = CURRENT_REQUEST_METRICS.get()
+    started = response.request.extensions.get("bbifather_started")
+    if metrics is None or metrics.finished or started is None:
+        return
+    response.read()
+    elapsed = time.perf_counter() - started
+    metrics.supabase_calls += 1
+    metrics.supabase_seconds += elapsed
+    if len(metrics.trace) < REQUEST_TRACE_MAX_CALLS:
+        url = response.request.url
+        query = url.query.decode("utf-8", "replace")
+        metrics.trace.append(
+            f"{response.request.method} {url.path}{'?' + query[:160] if query else ''} "
+            f"{response.status_code} {elapsed * 1000:.1f}ms"
+        )
+
+def instrument_supabase_client(client: Client):
+    """Подключает учет вызовов к httpx-сессии PostgREST клиента Supabase."""
+    session = client.postgrest.session
+    hooks = session.event_hooks
+    hooks["request"].append(on_supabase_request)
+    hooks["response"].append(on_supabase_response)
+    session.event_hooks = hooks
+
+def build_server_timing(metrics: RequestMetrics) -> str:
+    total_ms = (time.perf_counter() - metrics.started) * 1000
+    db_ms = metrics.supabase_seconds * 1000
+    return (
+        f'db;dur={db_ms:.1f};desc="Supabase x{metrics.supabase_calls}", '
+        f"app;dur={max(total_ms - db_ms, 0):.1f}, total;dur={total_ms:.1f}"
+    )
+
+def record_request_metrics(scope, status_code: int, metrics: RequestMetrics):
+    """Обновляет гистограмму маршрута и пишет медленные запросы с трассой вызовов."""
+    elapsed_ms = (time.perf_counter() - metrics.started) * 1000
+    route = scope.get("route")
+    route_key = f"{scope.get('method', '')} {getattr(route, 'path', '<unmatched>')}"
+
+    with ROUTE_LATENCY_LOCK:
+        stats = ROUTE_LATENCY_STATS.get(route_key)
+        if stats is None:
+            stats = ROUTE_LATENCY_STATS[route_key] = {
+                "count": 0,
+                "errors": 0,
+                "sum_ms": 0.0,
+                "max_ms": 0.0,
+                "supabase_calls": 0,
+                "supabase_ms": 0.0,
+                "buckets": [0] * (len(REQUEST_LATENCY_BUCKETS_MS) + 1),
+            }
+        stats["count"] += 1
+        stats["errors"] += status_code >= 500
+        stats["sum_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["supabase_calls"] += metrics.supabase_calls
+        stats["supabase_ms"] += metrics.supabase_seconds * 1000
+        stats["buckets"][bisect.bisect_left(REQUEST_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    if elapsed_ms >= SLOW_REQUEST_MS:
+        logger.warning(
+            "🐢 Медленный запрос %s %s: %.0fms, Supabase %s вызовов / %.0fms: %s",
+            route_key, status_code, elapsed_ms, metrics.supabase_calls,
+            metrics.supabase_seconds * 1000, "; ".join(metrics.trace) or "-"
+        )
+
+def estimate_latency_percentile(buckets: List[int], count: int, q: float) -> Optional[float]:
+    """Верхняя граница бакета, в который попадает q-й перцентиль."""
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for index, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= rank:
+            return float(REQUEST_LATENCY_BUCKETS_MS[index]) if index < len(REQUEST_LATENCY_BUCKETS_MS) else None
+    return None
+
+class RequestMetricsMiddleware:
+    """Время ответа, число и время вызовов Supabase для каждого HTTP-запроса."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics(started=time.perf_counter())
+        token = CURRENT_REQUEST_METRICS.set(metrics)
+        status_code = 500
+
+        def finish():
+            if not metrics.finished:
+                metrics.finished = True
+                record_request_metrics(scope, status_code, metrics)
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    MutableHeaders(scope=message).append("Server-Timing", build_server_timing(metrics))
+            await send(message)
+            # Последний кусок тела ушел клиенту: фиксируем время до запуска BackgroundTasks
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            CURRENT_REQUEST_METRICS.reset(token)
+            # Исключение или обрыв соединения до конца ответа
+            finish()
 
 # Создаем приложение FastAPI
 app = FastAPI(
     title="Student Orders API",
     description="API для системы управления заказами практических работ",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # Настройка CORS. В production список должен задаваться через .env, без
@@ -72,7 +457,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    # Retry-After нужен миниатюрам, пока превью готовится
+    expose_headers=["Retry-After"],
 )
+# Добавляется после CORS, поэтому сжимает уже готовый ответ с CORS-заголовками
+app.add_middleware(CompressionMiddleware, minimum_size=API_COMPRESSION_MIN_SIZE)
+# Внешний слой: в замер попадают CORS и сжатие
+app.add_middleware(RequestMetricsMiddleware)
 
 # Переменные окружения
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
@@ -80,19 +471,62 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_FORCE_IPV4 = os.getenv("TELEGRAM_FORCE_IPV4", "true").lower() == "true"
 TELEGRAM_PROXY_URL = os.getenv("TELEGRAM_PROXY_URL", "").strip()
+# Общий с ботом шлюз Bot API (telegram_gateway.py): один пул, лимит отправки и пауза 429 на токен.
+# Шлюз сам ходит через TELEGRAM_PROXY_URL, поэтому при нем proxy здесь не используется.
+TELEGRAM_GATEWAY_URL = os.getenv("TELEGRAM_GATEWAY_URL", "").strip().rstrip("/")
+# Позволяет направить запросы в локальный stand-in Bot API (бенчмарки, тесты)
+TELEGRAM_API_BASE_URL = TELEGRAM_GATEWAY_URL or os.getenv("TELEGRAM_API_BASE_URL", "").strip().rstrip("/") or "https://api.telegram.org"
 TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
 TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "20"))
 TELEGRAM_SEND_RETRIES = max(1, int(os.getenv("TELEGRAM_SEND_RETRIES", "2")))
 TELEGRAM_ERROR_LOG_COOLDOWN_SECONDS = max(0.0, float(os.getenv("TELEGRAM_ERROR_LOG_COOLDOWN_SECONDS", "30")))
 TELEGRAM_SESSION_LOCAL = threading.local()
 TELEGRAM_LAST_ERROR_LOG_AT: Dict[str, float] = {}
+# Размер каждой полосы очереди уведомлений, если не задан в TELEGRAM_QUEUE_LANE_MAX_SIZES
 TELEGRAM_QUEUE_MAX_SIZE = max(10, int(os.getenv("TELEGRAM_QUEUE_MAX_SIZE", "500")))
 TELEGRAM_QUEUE_MAX_ATTEMPTS = max(1, int(os.getenv("TELEGRAM_QUEUE_MAX_ATTEMPTS", "8")))
 TELEGRAM_QUEUE_RETRY_BASE_SECONDS = max(1.0, float(os.getenv("TELEGRAM_QUEUE_RETRY_BASE_SECONDS", "10")))
 TELEGRAM_QUEUE_RETRY_MAX_SECONDS = max(5.0, float(os.getenv("TELEGRAM_QUEUE_RETRY_MAX_SECONDS", "300")))
-TELEGRAM_NOTIFICATION_QUEUE: "queue.Queue[Optional[TelegramNotification]]" = queue.Queue(maxsize=TELEGRAM_QUEUE_MAX_SIZE)
+# Полосы приоритета очереди уведомлений: вес в взвешенном round-robin и свой лимит размера,
+# чтобы массовая рассылка исполнителям не задерживала срочное уведомление об оплате.
+# Переопределяются через TELEGRAM_QUEUE_LANE_WEIGHTS / TELEGRAM_QUEUE_LANE_MAX_SIZES ("executors=200,payment=100")
+NOTIFICATION_LANE_PAYMENT = "payment"
+NOTIFICATION_LANE_ADMIN = "admin"
+NOTIFICATION_LANE_STATUS = "status"
+NOTIFICATION_LANE_FILES = "files"
+NOTIFICATION_LANE_EXECUTORS = "executors"
+# Статусы заказа, уведомления о которых студенту идут по платежной полосе
+PAYMENT_NOTIFICATION_STATUSES = ('paid', 'waiting_payment')
+NOTIFICATION_LANE_DEFAULT_WEIGHTS = {
+    NOTIFICATION_LANE_PAYMENT: 8,
+    NOTIFICATION_LANE_ADMIN: 4,
+    NOTIFICATION_LANE_STATUS: 4,
+    NOTIFICATION_LANE_FILES: 2,
+    NOTIFICATION_LANE_EXECUTORS: 1,
+}
 TELEGRAM_QUEUE_STOP = threading.Event()
 TELEGRAM_QUEUE_WORKER: Optional[threading.Thread] = None
+# Недоставленные уведомления (dead letters): причина, история попыток и payload в SQLite,
+# чтобы после сбоя proxy/Telegram их можно было повторить одной операцией
+DEAD_LETTER_DB_PATH = os.getenv("DEAD_LETTER_DB_PATH", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "dead_letters.sqlite3"
+)
+DEAD_LETTER_MAX_ENTRIES = max(100, int(os.getenv("DEAD_LETTER_MAX_ENTRIES", "5000")))
+DEAD_LETTER_TTL_SECONDS = max(3600.0, float(os.getenv("DEAD_LETTER_TTL_DAYS", "14")) * 86400)
+# Повтор идет через обычную очередь, но не быстрее этого темпа и только пока в ней есть место
+DEAD_LETTER_REPLAY_RATE_PER_SECOND = max(0.5, float(os.getenv("DEAD_LETTER_REPLAY_RATE_PER_SECOND", "5")))
+DEAD_LETTER_HISTORY_LIMIT = 10
+DEAD_LETTER_LOCAL = threading.local()
+# Запись в SQLite при переполненной полосе: queue_telegram_notification вызывается и из
+# async-обработчиков, поэтому пишем в отдельном потоке, а не в event loop
+DEAD_LETTER_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dead-letters")
+DEAD_LETTER_REPLAY_WAKE = threading.Event()
+DEAD_LETTER_REPLAY_WORKER: Optional[threading.Thread] = None
+# Короткий кэш chat_id: массовые уведомления не делают запрос в Supabase на каждый заказ.
+CHAT_ID_CACHE_TTL_SECONDS = max(0.0, float(os.getenv("CHAT_ID_CACHE_TTL_SECONDS", "60")))
+CHAT_ID_CACHE_MAX_SIZE = max(100, int(os.getenv("CHAT_ID_CACHE_MAX_SIZE", "5000")))
+CHAT_ID_CACHE: Dict[str, tuple] = {}
+CHAT_ID_CACHE_LOCK = threading.Lock()
 
 if TELEGRAM_FORCE_IPV4:
     _original_getaddrinfo = socket.getaddrinfo
@@ -119,9 +553,9 @@ BOT_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "").strip() or os.getenv("TELEGRAM_A
 # Дополнительные админские чаты
 _raw_admin_ids = os.getenv("TELEGRAM_ADMIN_CHAT_IDS", "")
 _legacy_admin_id = os.getenv("TELEGRAM_ADMIN_CHAT_ID", "")
-print(f"🔧 DEBUG: TELEGRAM_ADMIN_CHAT_IDS raw value: '{_raw_admin_ids}'")
+logger.debug("🔧 TELEGRAM_ADMIN_CHAT_IDS raw value: '%s'", _raw_admin_ids)
 ADMIN_CHAT_IDS = parse_chat_ids(_raw_admin_ids, _legacy_admin_id, ",".join(DEFAULT_ADMIN_CHAT_IDS))
-print(f"🔧 DEBUG: ADMIN_CHAT_IDS parsed: {ADMIN_CHAT_IDS}")
+logger.debug("🔧 ADMIN_CHAT_IDS parsed: %s", ADMIN_CHAT_IDS)
 EXECUTOR_CHAT_IDS = ["814032949", "862151461", "5648974088"]
 BLOCKED_BOARD_EXECUTOR = "artemonsup"
 
@@ -164,7 +598,7 @@ PAYMENT_METHODS = {
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://bbifather.site").rstrip("/")
 WEB_APP_URL = os.getenv("WEB_APP_URL", "https://bbifather.site").rstrip("/")
 
-print(f"🔗 PUBLIC_BASE_URL: {PUBLIC_BASE_URL}")
+logger.info("🔗 PUBLIC_BASE_URL: %s", PUBLIC_BASE_URL)
 
 def build_web_app_url(telegram_username: Optional[str] = None) -> str:
     """Генерирует URL мини-аппа с параметрами пользователя."""
@@ -205,6 +639,8 @@ def sanitize_telegram_error(error: Exception) -> str:
 
 def get_telegram_proxy_url() -> str:
     """Переключает SOCKS5 на DNS-разрешение через proxy для Telegram API."""
+    if TELEGRAM_GATEWAY_URL:
+        return ""
     if TELEGRAM_PROXY_URL.startswith("socks5://"):
         return f"socks5h://{TELEGRAM_PROXY_URL[len('socks5://'):]}"
     return TELEGRAM_PROXY_URL
@@ -242,7 +678,7 @@ def post_telegram(
     if not BOT_TOKEN:
         return None
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+    url = f"{TELEGRAM_API_BASE_URL}/bot{BOT_TOKEN}/{method}"
     request_timeout = timeout if timeout is not None else (TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
     last_response = None
 
@@ -271,7 +707,7 @@ def post_telegram(
             return response
         except requests.RequestException as e:
             if should_log_telegram_error(method):
-                print(f"⚠️ Telegram API timeout на '{method}': {sanitize_telegram_error(e)}")
+                logger.warning("⚠️ Telegram API timeout на '%s': %s", method, sanitize_telegram_error(e))
             if attempt < retries - 1:
                 time.sleep(min(2 * (attempt + 1), 10))
             else:
@@ -279,24 +715,206 @@ def post_telegram(
 
     return last_response
 
+def parse_lane_settings(raw_value: str, defaults: Dict[str, int], minimum: int) -> Dict[str, int]:
+    """Разбирает "lane=число,lane=число" поверх значений по умолчанию; неизвестные полосы игнорируются."""
+    settings = dict(defaults)
+    for item in re.split(r"[\s,;]+", raw_value or ""):
+        lane, _, value = item.partition("=")
+        if lane.strip() in settings and value.strip().isdigit():
+            settings[lane.strip()] = max(minimum, int(value))
+    return settings
+
+NOTIFICATION_LANE_WEIGHTS = parse_lane_settings(
+    os.getenv("TELEGRAM_QUEUE_LANE_WEIGHTS", ""), NOTIFICATION_LANE_DEFAULT_WEIGHTS, 1
+)
+NOTIFICATION_LANE_MAX_SIZES = parse_lane_settings(
+    os.getenv("TELEGRAM_QUEUE_LANE_MAX_SIZES", ""),
+    {lane: TELEGRAM_QUEUE_MAX_SIZE for lane in NOTIFICATION_LANE_DEFAULT_WEIGHTS},
+    10
+)
+
+class PriorityNotificationQueue:
+    """Очередь с полосами приоритета и плавным взвешенным round-robin (как upstream в nginx).
+
+    Среди непустых полос каждая получает долю выдачи по весу, но ни одна не голодает;
+    при равных накоплениях выигрывает полоса, объявленная раньше (payment).
+    Интерфейс повторяет используемую часть queue.Queue: put_nowait, get, task_done, qsize.
+    """
+
+    def __init__(self, weights: Dict[str, int], max_sizes: Dict[str, int]):
+        self.weights = weights
+        self.max_sizes = max_sizes
+        self.lanes: Dict[str, "deque[TelegramNotification]"] = {lane: deque() for lane in weights}
+        self.current_weights = {lane: 0 for lane in weights}
+        self.counters = {lane: {"enqueued": 0, "delivered_from_queue": 0, "rejected_full": 0} for lane in weights}
+        self.condition = threading.Condition()
+
+    def put_nowait(self, notification: "TelegramNotification"):
+        lane = notification.lane if notification.lane in self.lanes else NOTIFICATION_LANE_STATUS
+        with self.condition:
+            if len(self.lanes[lane]) >= self.max_sizes[lane]:
+                self.counters[lane]["rejected_full"] += 1
+                raise queue.Full
+            self.lanes[lane].append(notification)
+            self.counters[lane]["enqueued"] += 1
+            self.condition.notify()
+
+    def get(self, timeout: Optional[float] = None) -> "TelegramNotification":
+        with self.condition:
+            if not self.condition.wait_for(lambda: any(self.lanes.values()), timeout=timeout):
+                raise queue.Empty
+            active = [lane for lane, items in self.lanes.items() if items]
+            total = 0
+            for lane in active:
+                self.current_weights[lane] += self.weights[lane]
+                total += self.weights[lane]
+            chosen = max(active, key=lambda lane: self.current_weights[lane])
+            self.current_weights[chosen] -= total
+            self.counters[chosen]["delivered_from_queue"] += 1
+            return self.lanes[chosen].popleft()
+
+    def task_done(self):
+        """Совместимость с queue.Queue; join() очереди уведомлений не используется."""
+
+    def qsize(self, lane: Optional[str] = None) -> int:
+        with self.condition:
+            if lane is not None:
+                return len(self.lanes.get(lane, ()))
+            return sum(len(items) for items in self.lanes.values())
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self.condition:
+            return {
+                lane: dict(
+                    self.counters[lane],
+                    size=len(items),
+                    max_size=self.max_sizes[lane],
+                    weight=self.weights[lane],
+                )
+                for lane, items in self.lanes.items()
+            }
+
 @dataclass
 class TelegramNotification:
     method: str
     payload: dict
     description: str
     attempt: int = 1
+    lane: str = NOTIFICATION_LANE_STATUS
+    # Неудачные попытки (в том числе до повтора из dead letters): время, HTTP-статус, ошибка
+    history: List[dict] = field(default_factory=list)
+    replay_count: int = 0
+
+    def record_failure(self, status_code: Optional[int], error: str):
+        self.history.append({
+            "attempt": self.attempt,
+            "at": round(time.time(), 3),
+            "status": status_code,
+            "error": error[:300],
+        })
+        del self.history[:-DEAD_LETTER_HISTORY_LIMIT]
+
+TELEGRAM_NOTIFICATION_QUEUE = PriorityNotificationQueue(NOTIFICATION_LANE_WEIGHTS, NOTIFICATION_LANE_MAX_SIZES)
+
+def get_thread_sqlite_connection(
+    local: threading.local,
+    path: str,
+    schema: Tuple[str, ...],
+    row_factory: Optional[Callable] = None
+) -> sqlite3.Connection:
+    """Отдельное SQLite-соединение на поток (WAL, synchronous=NORMAL); файл общий для всех процессов Gunicorn.
+
+    schema выполняется при первом открытии в потоке; ALTER TABLE ... ADD COLUMN для уже
+    существующей колонки пропускается.
+    """
+    connection = getattr(local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        connection.row_factory = row_factory
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            try:
+                connection.execute(statement)
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):
+                    raise
+        local.connection = connection
+    return connection
+
+DEAD_LETTER_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT NOT NULL,
+        description TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        status_code INTEGER,
+        attempts INTEGER NOT NULL,
+        history TEXT NOT NULL,
+        replay_count INTEGER NOT NULL DEFAULT 0,
+        replay_requested_at REAL,
+        failed_at REAL NOT NULL
+    )
+    """,
+    f"ALTER TABLE dead_letters ADD COLUMN lane TEXT NOT NULL DEFAULT '{NOTIFICATION_LANE_STATUS}'",
+    "CREATE INDEX IF NOT EXISTS idx_dead_letters_reason ON dead_letters(reason, id)",
+    "CREATE INDEX IF NOT EXISTS idx_dead_letters_replay ON dead_letters(replay_requested_at, id)",
+)
+
+def get_dead_letter_connection() -> sqlite3.Connection:
+    return get_thread_sqlite_connection(DEAD_LETTER_LOCAL, DEAD_LETTER_DB_PATH, DEAD_LETTER_SCHEMA, sqlite3.Row)
 
-def queue_telegram_notification(method: str, payload: dict, description: str) -> bool:
+def store_dead_letter(notification: TelegramNotification, reason: str, status_code: Optional[int] = None):
+    """Сохраняет недоставленное уведомление вместо того, чтобы просто его потерять."""
+    try:
+        connection = get_dead_letter_connection()
+        now = time.time()
+        cursor = connection.execute(
+            "INSERT INTO dead_letters (method, lane, description, payload, reason, status_code, attempts, history, replay_count, failed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                notification.method,
+                notification.lane,
+                notification.description,
+                json.dumps(notification.payload, ensure_ascii=False, separators=(",", ":")),
+                reason,
+                status_code,
+                notification.attempt,
+                json.dumps(notification.history, ensure_ascii=False, separators=(",", ":")),
+                notification.replay_count,
+                now,
+            )
+        )
+        if cursor.lastrowid % 100 == 0:
+            connection.execute("DELETE FROM dead_letters WHERE failed_at < ?", (now - DEAD_LETTER_TTL_SECONDS,))
+            connection.execute(
+                "DELETE FROM dead_letters WHERE id <= (SELECT id FROM dead_letters ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (DEAD_LETTER_MAX_ENTRIES,)
+            )
+    except (sqlite3.Error, TypeError, ValueError) as e:
+        logger.error("❌ Не удалось сохранить недоставленное уведомление %s: %s", notification.description, e)
+
+def queue_telegram_notification(
+    method: str,
+    payload: dict,
+    description: str,
+    lane: str = NOTIFICATION_LANE_STATUS
+) -> bool:
     """Кладет Telegram-уведомление в очередь, чтобы переживать временные timeout."""
     if not BOT_TOKEN:
         return False
 
+    notification = TelegramNotification(method, payload, description, lane=lane)
     try:
-        TELEGRAM_NOTIFICATION_QUEUE.put_nowait(TelegramNotification(method, payload, description))
-        print(f"📬 Telegram уведомление поставлено в очередь: {description}")
+        TELEGRAM_NOTIFICATION_QUEUE.put_nowait(notification)
+        logger.info("📬 Telegram уведомление поставлено в очередь (%s): %s", lane, description, extra=LOG_SAMPLED)
         return True
     except queue.Full:
-        print(f"❌ Очередь Telegram уведомлений переполнена, уведомление пропущено: {description}")
+        logger.error("❌ Полоса '%s' очереди Telegram уведомлений переполнена, уведомление сохранено в dead letters: %s", lane, description)
+        notification.record_failure(None, "queue full")
+        DEAD_LETTER_WRITER.submit(store_dead_letter, notification, "queue_full")
         return False
 
 def retry_telegram_notification(notification: TelegramNotification):
@@ -312,9 +930,10 @@ def retry_telegram_notification(notification: TelegramNotification):
             return
         try:
             TELEGRAM_NOTIFICATION_QUEUE.put_nowait(notification)
-            print(f"🔁 Повторная отправка Telegram уведомления в очереди: {notification.description}")
+            logger.debug("🔁 Повторная отправка Telegram уведомления в очереди: %s", notification.description)
         except queue.Full:
-            print(f"❌ Очередь Telegram уведомлений переполнена при повторе: {notification.description}")
+            logger.error("❌ Очередь Telegram уведомлений переполнена при повторе: %s", notification.description)
+            store_dead_letter(notification, "queue_full")
 
     timer = threading.Timer(delay, requeue)
     timer.daemon = True
@@ -329,30 +948,30 @@ def telegram_notification_worker():
             continue
 
         try:
-            if notification is None:
-                continue
-
             response = post_telegram(notification.method, notification.payload)
             if response is not None and response.status_code == 200:
-                print(f"✅ Telegram уведомление доставлено: {notification.description}")
+                logger.info("✅ Telegram уведомление доставлено: %s", notification.description, extra=LOG_SAMPLED)
                 continue
 
             status_code = response.status_code if response is not None else None
             response_text = response.text if response is not None else "Telegram API недоступен"
+            notification.record_failure(status_code, response_text)
             if status_code in (400, 403):
-                print(f"❌ Telegram уведомление не будет повторяться ({status_code}): {notification.description}: {response_text}")
+                logger.error("❌ Telegram уведомление не будет повторяться (%s): %s: %s", status_code, notification.description, response_text)
+                store_dead_letter(notification, "rejected", status_code)
                 continue
 
             if notification.attempt < TELEGRAM_QUEUE_MAX_ATTEMPTS:
-                print(
-                    f"⏳ Telegram уведомление не доставлено, будет повтор "
-                    f"{notification.attempt + 1}/{TELEGRAM_QUEUE_MAX_ATTEMPTS}: {notification.description}"
+                logger.warning(
+                    "⏳ Telegram уведомление не доставлено, будет повтор %s/%s: %s",
+                    notification.attempt + 1, TELEGRAM_QUEUE_MAX_ATTEMPTS, notification.description
                 )
                 retry_telegram_notification(notification)
             else:
-                print(f"❌ Telegram уведомление не доставлено после всех попыток: {notification.description}: {response_text}")
+                logger.error("❌ Telegram уведомление не доставлено после всех попыток: %s: %s", notification.description, response_text)
+                store_dead_letter(notification, "attempts_exhausted", status_code)
         except Exception as e:
-            print(f"❌ Ошибка worker Telegram уведомлений: {sanitize_telegram_error(e)}")
+            logger.error("❌ Ошибка worker Telegram уведомлений: %s", sanitize_telegram_error(e))
         finally:
             TELEGRAM_NOTIFICATION_QUEUE.task_done()
 
@@ -368,29 +987,109 @@ def start_telegram_notification_worker():
         daemon=True
     )
     TELEGRAM_QUEUE_WORKER.start()
-    print("📬 Очередь Telegram уведомлений запущена")
+    start_dead_letter_replay_worker()
+    logger.info("📬 Очередь Telegram уведомлений запущена")
 
 def stop_telegram_notification_worker():
     """Останавливает worker очереди без долгого ожидания сетевых запросов."""
     TELEGRAM_QUEUE_STOP.set()
-    try:
-        TELEGRAM_NOTIFICATION_QUEUE.put_nowait(None)
-    except queue.Full:
-        pass
+    DEAD_LETTER_REPLAY_WAKE.set()
 
-def send_telegram_message_to_chat(chat_id: str, message: str) -> bool:
+def replay_dead_letters_worker():
+    """Переносит отмеченные для повтора dead letters в очередь с ограниченным темпом.
+
+    Полоса уведомления заполняется не больше чем наполовину, чтобы повтор после сбоя не
+    вытеснял свежие уведомления; запись удаляется только после того, как попала в очередь.
+    """
+    interval = 1.0 / DEAD_LETTER_REPLAY_RATE_PER_SECOND
+    while not TELEGRAM_QUEUE_STOP.is_set():
+        try:
+            row = get_dead_letter_connection().execute(
+                "SELECT * FROM dead_letters WHERE replay_requested_at IS NOT NULL ORDER BY id LIMIT 1"
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("❌ Ошибка чтения dead letters: %s", e)
+            row = None
+        if row is None:
+            DEAD_LETTER_REPLAY_WAKE.wait(timeout=5)
+            DEAD_LETTER_REPLAY_WAKE.clear()
+            continue
+        lane = row["lane"] if row["lane"] in NOTIFICATION_LANE_MAX_SIZES else NOTIFICATION_LANE_STATUS
+        if TELEGRAM_NOTIFICATION_QUEUE.qsize(lane) >= NOTIFICATION_LANE_MAX_SIZES[lane] // 2:
+            TELEGRAM_QUEUE_STOP.wait(1)
+            continue
+
+        notification = TelegramNotification(
+            row["method"],
+            json.loads(row["payload"]),
+            row["description"],
+            lane=lane,
+            history=json.loads(row["history"]),
+            replay_count=row["replay_count"] + 1,
+        )
+        try:
+            TELEGRAM_NOTIFICATION_QUEUE.put_nowait(notification)
+        except queue.Full:
+            TELEGRAM_QUEUE_STOP.wait(1)
+            continue
+        get_dead_letter_connection().execute("DELETE FROM dead_letters WHERE id = ?", (row["id"],))
+        logger.info("🔁 Недоставленное уведомление возвращено в очередь: %s", notification.description, extra=LOG_SAMPLED)
+        TELEGRAM_QUEUE_STOP.wait(interval)
+
+def start_dead_letter_replay_worker():
+    global DEAD_LETTER_REPLAY_WORKER
+    if DEAD_LETTER_REPLAY_WORKER and DEAD_LETTER_REPLAY_WORKER.is_alive():
+        return
+    DEAD_LETTER_REPLAY_WORKER = threading.Thread(
+        target=replay_dead_letters_worker,
+        name="dead-letter-replay",
+        daemon=True
+    )
+    DEAD_LETTER_REPLAY_WORKER.start()
+
+def send_telegram_message_to_chat(chat_id: str, message: str, lane: str = NOTIFICATION_LANE_ADMIN) -> bool:
     """Отправляет одно админское уведомление и возвращает успех без блокировки других адресатов."""
     payload = {
         'chat_id': chat_id,
         'text': message,
         'parse_mode': 'HTML'
     }
-    return queue_telegram_notification("sendMessage", payload, f"админ {chat_id}")
+    return queue_telegram_notification("sendMessage", payload, f"админ {chat_id}", lane=lane)
 
 def enqueue_background(background_tasks: BackgroundTasks, task: Callable, *args, **kwargs) -> None:
     """Запускает тяжелые уведомления после ответа API, чтобы не держать UI."""
     background_tasks.add_task(task, *args, **kwargs)
 
+# Атомарное создание заказа функцией Postgres (одна транзакция вместо ~7 запросов)
+CREATE_ORDER_RPC_ENABLED = os.getenv("CREATE_ORDER_RPC_ENABLED", "true").lower() == "true"
+CREATE_ORDER_RPC_NAME = "create_order_atomic"
+CREATE_ORDER_RPC_AVAILABLE = True
+CREATE_ORDER_DUPLICATE_WINDOW_SECONDS = 120
+# Пакетное сохранение chat_id от бота одним оператором (см. deploy/supabase-save-chat-ids.sql)
+SAVE_CHAT_IDS_RPC_NAME = "save_chat_ids_bulk"
+SAVE_CHAT_IDS_RPC_AVAILABLE = True
+SAVE_CHAT_IDS_MAX_ENTRIES = max(1, int(os.getenv("SAVE_CHAT_IDS_MAX_ENTRIES", "500")))
+# Атомарное изменение orders.files одним UPDATE (см. deploy/supabase-order-files.sql).
+# Без функции read-modify-write сериализуется по заказу, но только внутри процесса
+UPDATE_ORDER_FILES_RPC_NAME = "update_order_files"
+UPDATE_ORDER_FILES_RPC_AVAILABLE = True
+ORDER_FILES_LOCKS = [threading.Lock() for _ in range(64)]
+
+# Idempotency-Key: ответы хранятся в SQLite рядом с backend и общие для всех worker'ов
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "idempotency.sqlite3"
+)
+IDEMPOTENCY_TTL_SECONDS = max(60.0, float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")))
+IDEMPOTENCY_MAX_ENTRIES = max(100, int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")))
+IDEMPOTENCY_LOCK_SECONDS = 60.0
+IDEMPOTENCY_WAIT_SECONDS = 5.0
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_.:\-]{8,128}$")
+IDEMPOTENCY_LOCAL = threading.local()
+
+# Поля, которые можно менять массово через /api/orders/bulk
+BULK_ORDER_PATCH_FIELDS = {'status', 'actual_price', 'is_paid', 'executor_telegram', 'payout_amount', 'payment_method'}
+BULK_ORDERS_MAX_IDS = 200
+
 # Разрешённые статусы заказов (основные)
 ALLOWED_ORDER_STATUSES = {
     'new',
@@ -402,64 +1101,766 @@ ALLOWED_ORDER_STATUSES = {
 }
 
 if not SUPABASE_URL or not SUPABASE_KEY:
-    print("⚠️ SUPABASE_URL и SUPABASE_KEY должны быть установлены!")
-    print("Создайте .env файл или установите переменные окружения")
+    logger.warning("⚠️ SUPABASE_URL и SUPABASE_KEY должны быть установлены!")
+    logger.warning("Создайте .env файл или установите переменные окружения")
 
 # Инициализация Supabase клиента
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
+if supabase:
+    instrument_supabase_client(supabase)
 
 # Пути для данных и загрузок
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
+UPLOADS_DIR = os.getenv("UPLOADS_DIR", "").strip() or os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# Хранилище файлов заказов: local (UPLOADS_DIR) или s3 (AWS S3, MinIO и другие S3-совместимые)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").strip().lower() or "local"
+STORAGE_STREAM_CHUNK_SIZE = 1024 * 1024
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "").strip() or None
+# Адрес, который видят клиенты, если backend ходит в MinIO по внутреннему имени
+S3_PUBLIC_ENDPOINT_URL = os.getenv("S3_PUBLIC_ENDPOINT_URL", "").strip() or None
+S3_BUCKET = os.getenv("S3_BUCKET", "").strip()
+S3_REGION = os.getenv("S3_REGION", "").strip() or "us-east-1"
+S3_PREFIX = os.getenv("S3_PREFIX", "").strip().strip("/")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "").strip() or None
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "").strip() or None
+S3_FORCE_PATH_STYLE = os.getenv("S3_FORCE_PATH_STYLE", "true").lower() == "true"
+S3_PRESIGNED_URL_TTL_SECONDS = max(60, int(os.getenv("S3_PRESIGNED_URL_TTL_SECONDS", "900")))
+
+FILE_MEDIA_TYPES = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain; charset=utf-8',
+    '.zip': 'application/zip',
+    '.rar': 'application/x-rar-compressed',
+    '.7z': 'application/x-7z-compressed',
+    '.doc': 'application/msword',
+    '.xls': 'application/vnd.ms-excel',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.ppt': 'application/vnd.ms-powerpoint',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+}
+
+def guess_file_media_type(filename: str) -> str:
+    """media-type для отдачи файла заказа; неизвестные расширения — octet-stream"""
+    return FILE_MEDIA_TYPES.get(os.path.splitext(filename.lower())[1], 'application/octet-stream')
+
+def build_content_disposition(filename: str) -> str:
+    """attachment с ASCII-запасным именем и filename* (RFC 5987) для кириллицы"""
+    ascii_name = filename.encode("ascii", "ignore").decode("ascii").replace('"', "") or "file"
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{urllib.parse.quote(filename)}"
+
+def order_file_key(order_id: int, filename: str) -> str:
+    """Ключ файла в хранилище — та же раскладка, что и каталоги в UPLOADS_DIR"""
+    return f"order_{order_id}/{filename}"
+
+@dataclass
+class StoredFile:
+    key: str
+    size: int
+    content_type: Optional[str] = None
+
+class LocalFileStorage:
+    """Файлы на локальном диске: <root>/order_<id>/<имя>"""
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, key: str) -> Optional[str]:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Недопустимый ключ файла: {key}")
+        return path
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> StoredFile:
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем во временный файл и подменяем — скачивание не увидит недописанный файл
+        temp_path = f"{path}.part"
+        with open(temp_path, "wb") as buffer:
+            buffer.write(data)
+        os.replace(temp_path, path)
+        return StoredFile(key, len(data), content_type)
+
+    def open(self, key: str):
+        """Поток для чтения; FileNotFoundError, если файла нет"""
+        return open(self.local_path(key), "rb")
+
+    def stat(self, key: str) -> Optional[StoredFile]:
+        try:
+            size = os.path.getsize(self.local_path(key))
+        except OSError:
+            return None
+        return StoredFile(key, size, guess_file_media_type(key))
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.unlink(self.local_path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def presigned_url(self, key: str, filename: Optional[str] = None, expires_in: Optional[int] = None) -> Optional[str]:
+        # Диск доступен только через backend — прямых ссылок нет
+        return None
+
+class S3FileStorage:
+    """Файлы в S3-совместимом бакете: [<prefix>/]order_<id>/<имя>"""
+    name = "s3"
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, public_endpoint_url: Optional[str] = None,
+                 region: str = "us-east-1", prefix: str = "", access_key_id: Optional[str] = None,
+                 secret_access_key: Optional[str] = None, force_path_style: bool = True):
+        if boto3 is None:
+            raise RuntimeError("Для STORAGE_BACKEND=s3 установите boto3 (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("Для STORAGE_BACKEND=s3 нужно задать S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        config = BotoConfig(
+            signature_version="s3v4",
+            s3={"addressing_style": "path" if force_path_style else "auto"},
+            retries={"max_attempts": 3, "mode": "standard"},
+            max_pool_connections=20,
+        )
+        client_kwargs = {
+            "region_name": region,
+            "aws_access_key_id": access_key_id,
+            "aws_secret_access_key": secret_access_key,
+            "config": config,
+        }
+        # boto3-клиенты потокобезопасны — один на процесс, с общим пулом соединений
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, **client_kwargs)
+        self.presign_client = (
+            boto3.client("s3", endpoint_url=public_endpoint_url, **client_kwargs)
+            if public_endpoint_url else self.client
+        )
+
+    def object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    @staticmethod
+    def is_not_found(error: Exception) -> bool:
+        code = str(getattr(error, "response", {}).get("Error", {}).get("Code", ""))
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+    def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> StoredFile:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.object_key(key),
+            Body=data,
+            ContentType=content_type or "application/octet-stream",
+        )
+        return StoredFile(key, len(data), content_type)
+
+    def open(self, key: str):
+        """Поток тела объекта (botocore StreamingBody); FileNotFoundError, если объекта нет"""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+        except BotoClientError as e:
+            if self.is_not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def stat(self, key: str) -> Optional[StoredFile]:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except BotoClientError as e:
+            if self.is_not_found(e):
+                return None
+            raise
+        return StoredFile(key, int(head.get("ContentLength", 0)), head.get("ContentType"))
+
+    def delete(self, key: str) -> bool:
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+        return True
+
+    def presigned_url(self, key: str, filename: Optional[str] = None, expires_in: Optional[int] = None) -> Optional[str]:
+        params = {"Bucket": self.bucket, "Key": self.object_key(key)}
+        if filename:
+            params["ResponseContentDisposition"] = build_content_disposition(filename)
+            params["ResponseContentType"] = guess_file_media_type(filename)
+        return self.presign_client.generate_presigned_url(
+            "get_object",
+            Params=params,
+            ExpiresIn=expires_in or S3_PRESIGNED_URL_TTL_SECONDS,
+        )
+
+def create_file_storage():
+    if STORAGE_BACKEND == "s3":
+        storage = S3FileStorage(
+            bucket=S3_BUCKET,
+            endpoint_url=S3_ENDPOINT_URL,
+            public_endpoint_url=S3_PUBLIC_ENDPOINT_URL,
+            region=S3_REGION,
+            prefix=S3_PREFIX,
+            access_key_id=S3_ACCESS_KEY_ID,
+            secret_access_key=S3_SECRET_ACCESS_KEY,
+            force_path_style=S3_FORCE_PATH_STYLE,
+        )
+        logger.info("🪣 Файлы заказов хранятся в S3: %s/%s", S3_ENDPOINT_URL or "aws", S3_BUCKET)
+        return storage
+    if STORAGE_BACKEND != "local":
+        logger.warning("⚠️ Неизвестный STORAGE_BACKEND=%s, используем локальный диск", STORAGE_BACKEND)
+    return LocalFileStorage(UPLOADS_DIR)
+
+FILE_STORAGE = create_file_storage()
+
+def iter_stored_file(key: str, chunk_size: int = STORAGE_STREAM_CHUNK_SIZE):
+    """Читает файл из хранилища кусками — для StreamingResponse и архивов"""
+    stream = FILE_STORAGE.open(key)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        stream.close()
+
+def read_stored_file(key: str) -> bytes:
+    return b"".join(iter_stored_file(key))
+
+# Превью файлов заказов: миниатюры изображений и первой страницы PDF, генерируются в фоне после загрузки
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "true").lower() == "true"
+PREVIEW_WORKERS = max(1, int(os.getenv("PREVIEW_WORKERS", "1")))
+PREVIEW_QUEUE_MAX_SIZE = max(10, int(os.getenv("PREVIEW_QUEUE_MAX_SIZE", "200")))
+PREVIEW_JPEG_QUALITY = min(95, max(30, int(os.getenv("PREVIEW_JPEG_QUALITY", "70"))))
+# Защита от «бомб»: 10000x10000 PNG весит килобайты, а в памяти — сотни мегабайт
+PREVIEW_MAX_SOURCE_PIXELS = max(1_000_000, int(os.getenv("PREVIEW_MAX_SOURCE_PIXELS", "50000000")))
+PREVIEW_MAX_SOURCE_BYTES = 50 * 1024 * 1024
+# Имя размера -> длинная сторона в пикселях
+PREVIEW_SIZES = {
+    "thumb": max(32, int(os.getenv("PREVIEW_THUMB_SIZE", "160"))),
+    "preview": max(64, int(os.getenv("PREVIEW_PAGE_SIZE", "800"))),
+}
+PREVIEW_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff'}
+PREVIEW_PDF_EXTENSIONS = {'.pdf'}
+# Имена файлов заказа не переиспользуются (загрузка добавляет суффикс _N),
+# поэтому превью по адресу заказ/имя/размер никогда не меняется
+PREVIEW_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PREVIEW_QUEUE: "queue.Queue[Optional[PreviewJob]]" = queue.Queue(maxsize=PREVIEW_QUEUE_MAX_SIZE)
+PREVIEW_STOP = threading.Event()
+PREVIEW_WORKER_THREADS: List[threading.Thread] = []
+PREVIEW_PENDING: set = set()
+PREVIEW_PENDING_LOCK = threading.Lock()
+# Файлы, для которых превью построить не удалось: GET /preview отвечает 404, а не «готовится»
+PREVIEW_FAILED_MAX_ENTRIES = 5000
+PREVIEW_FAILED: "OrderedDict[tuple, None]" = OrderedDict()
+
+@dataclass
+class PreviewJob:
+    order_id: int
+    filename: str
+
+def preview_key(order_id: int, filename: str, size: str) -> str:
+    return f"previews/order_{order_id}/{filename}.{size}.jpg"
+
+def preview_supported(filename: str) -> bool:
+    """Можно ли построить превью этого файла в текущем окружении"""
+    if Image is None:
+        return False
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in PREVIEW_IMAGE_EXTENSIONS:
+        return True
+    return extension in PREVIEW_PDF_EXTENSIONS and (pymupdf is not None or shutil.which("pdftoppm") is not None)
+
+def render_pdf_first_page(data: bytes, max_side: int):
+    """Первая страница PDF как PIL.Image: PyMuPDF, иначе pdftoppm"""
+    if pymupdf is not None:
+        with pymupdf.open(stream=data, filetype="pdf") as document:
+            if document.page_count == 0:
+                return None
+            page = document[0]
+            zoom = max_side / max(page.rect.width, page.rect.height, 1)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+    with tempfile.TemporaryDirectory(prefix="preview-") as work_dir:
+        source_path = os.path.join(work_dir, "source.pdf")
+        with open(source_path, "wb") as source:
+            source.write(data)
+        output_base = os.path.join(work_dir, "page")
+        subprocess.run(
+            ["pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-scale-to", str(max_side), "-png", source_path, output_base],
+            check=True, timeout=60, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        with Image.open(f"{output_base}.png") as page_image:
+            page_image.load()
+            return page_image.copy()
+
+def open_preview_source(filename: str, data: bytes, max_side: int):
+    """Исходное изображение для превью (RGB) или None, если формат не поддерживается"""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in PREVIEW_PDF_EXTENSIONS:
+        image = render_pdf_first_page(data, max_side)
+    elif extension in PREVIEW_IMAGE_EXTENSIONS:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > PREVIEW_MAX_SOURCE_PIXELS:
+            raise ValueError(f"изображение слишком большое: {image.width}x{image.height}")
+        # JPEG декодируется сразу в уменьшенном масштабе — в разы быстрее и меньше памяти
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+    else:
+        return None
+    if image is None:
+        return None
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def render_file_previews(filename: str, data: bytes) -> Dict[str, bytes]:
+    """JPEG для каждого размера из PREVIEW_SIZES; пустой dict — формат не поддерживается"""
+    source = open_preview_source(filename, data, max(PREVIEW_SIZES.values()))
+    if source is None:
+        return {}
+    previews = {}
+    # От большего к меньшему: миниатюра считается из уже уменьшенного кадра
+    for size_name, max_side in sorted(PREVIEW_SIZES.items(), key=lambda item: -item[1]):
+        source.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        source.save(output, "JPEG", quality=PREVIEW_JPEG_QUALITY, optimize=True, progressive=max_side > 320)
+        previews[size_name] = output.getvalue()
+    return previews
+
+def generate_file_previews(order_id: int, filename: str) -> bool:
+    """Строит и сохраняет превью файла заказа; повторный вызов ничего не пересчитывает"""
+    keys = {size: preview_key(order_id, filename, size) for size in PREVIEW_SIZES}
+    if all(FILE_STORAGE.stat(key) for key in keys.values()):
+        return True
+
+    stored = FILE_STORAGE.stat(order_file_key(order_id, filename))
+    if stored is None:
+        logger.warning("⚠️ Превью: файл не найден в хранилище: заказ %s, %s", order_id, filename)
+        return False
+    if stored.size > PREVIEW_MAX_SOURCE_BYTES:
+        logger.info("ℹ️ Превью не строится для большого файла %s (%.1fMB)", filename, stored.size / 1024 / 1024)
+        return False
+
+    started = time.perf_counter()
+    previews = render_file_previews(filename, read_stored_file(order_file_key(order_id, filename)))
+    for size, content in previews.items():
+        FILE_STORAGE.put(keys[size], content, "image/jpeg")
+    if previews:
+        logger.info(
+            "🖼️ Превью готово: заказ %s, %s (%s) за %.0fms",
+            order_id, filename,
+            ", ".join(f"{size} {len(content) / 1024:.1f}KB" for size, content in previews.items()),
+            (time.perf_counter() - started) * 1000,
+        )
+    return bool(previews)
+
+def queue_file_preview(order_id: int, filename: str) -> bool:
+    """Ставит файл в очередь превью; дубликаты, пока задача не выполнена, отбрасываются"""
+    if not PREVIEW_ENABLED or not preview_supported(filename):
+        return False
+    job_id = (order_id, filename)
+    with PREVIEW_PENDING_LOCK:
+        if job_id in PREVIEW_PENDING:
+            return True
+        PREVIEW_PENDING.add(job_id)
+        # Файл могли загрузить заново под тем же именем — пробуем еще раз
+        PREVIEW_FAILED.pop(job_id, None)
+    try:
+        PREVIEW_QUEUE.put_nowait(PreviewJob(order_id, filename))
+        return True
+    except queue.Full:
+        with PREVIEW_PENDING_LOCK:
+            PREVIEW_PENDING.discard(job_id)
+        logger.warning("⚠️ Очередь превью переполнена, превью будет построено при первом запросе: %s", filename)
+        return False
+
+def preview_worker():
+    """Фоновая генерация превью: CPU-работа не занимает event loop и потоки запросов"""
+    while not PREVIEW_STOP.is_set():
+        try:
+            job = PREVIEW_QUEUE.get(timeout=0.5)
+        except queue.Empty:
+            continue
+
+        built = False
+        try:
+            if job is None:
+                continue
+            built = generate_file_previews(job.order_id, job.filename)
+        except Exception as e:
+            logger.warning("⚠️ Не удалось построить превью %s для заказа %s: %s", job.filename, job.order_id, e)
+        finally:
+            if job is not None:
+                job_id = (job.order_id, job.filename)
+                with PREVIEW_PENDING_LOCK:
+                    PREVIEW_PENDING.discard(job_id)
+                    if not built:
+                        PREVIEW_FAILED[job_id] = None
+                        if len(PREVIEW_FAILED) > PREVIEW_FAILED_MAX_ENTRIES:
+                            PREVIEW_FAILED.popitem(last=False)
+            PREVIEW_QUEUE.task_done()
+
+def preview_failed(order_id: int, filename: str) -> bool:
+    with PREVIEW_PENDING_LOCK:
+        return (order_id, filename) in PREVIEW_FAILED
+
+def start_preview_workers():
+    if not PREVIEW_ENABLED:
+        return
+    if Image is None:
+        logger.warning("⚠️ Pillow не установлен — превью файлов отключены")
+        return
+    if any(thread.is_alive() for thread in PREVIEW_WORKER_THREADS):
+        return
+    PREVIEW_STOP.clear()
+    PREVIEW_WORKER_THREADS.clear()
+    for index in range(PREVIEW_WORKERS):
+        thread = threading.Thread(target=preview_worker, name=f"preview-worker-{index + 1}", daemon=True)
+        thread.start()
+        PREVIEW_WORKER_THREADS.append(thread)
+    logger.info("🖼️ Генерация превью запущена (%s worker)", PREVIEW_WORKERS)
+
+def stop_preview_workers():
+    PREVIEW_STOP.set()
+    for _ in PREVIEW_WORKER_THREADS:
+        try:
+            PREVIEW_QUEUE.put_nowait(None)
+        except queue.Full:
+            break
+
+# Проверка загруженных файлов после ответа на загрузку: сигнатуры, zip-бомбы, учет размеров.
+# Заказ переходит в completed, только когда все файлы партии прошли проверку.
+VALIDATION_WORKERS = max(1, int(os.getenv("VALIDATION_WORKERS", "2")))
+VALIDATION_QUEUE_MAX_SIZE = max(10, int(os.getenv("VALIDATION_QUEUE_MAX_SIZE", "1000")))
+VALIDATION_CACHE_MAX_ENTRIES = max(100, int(os.getenv("VALIDATION_CACHE_MAX_ENTRIES", "5000")))
+VALIDATION_ZIP_MAX_ENTRIES = max(10, int(os.getenv("VALIDATION_ZIP_MAX_ENTRIES", "10000")))
+VALIDATION_ZIP_MAX_UNCOMPRESSED_BYTES = max(1, int(os.getenv("VALIDATION_ZIP_MAX_UNCOMPRESSED_MB", "1024"))) * 1024 * 1024
+VALIDATION_ZIP_MAX_RATIO = max(10, int(os.getenv("VALIDATION_ZIP_MAX_RATIO", "200")))
+VALIDATION_MAX_FILE_SIZE = 100 * 1024 * 1024  # как MAX_FILE_SIZE в upload_order_files
+
+# Допустимые сигнатуры (смещение, байты) по расширению
+ZIP_SIGNATURES = [(0, b"PK\x03\x04"), (0, b"PK\x05\x06")]
+OLE_SIGNATURES = [(0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")]
+FILE_SIGNATURES = {
+    '.pdf': [(0, b"%PDF-")],
+    '.doc': OLE_SIGNATURES, '.xls': OLE_SIGNATURES, '.ppt': OLE_SIGNATURES,
+    '.docx': ZIP_SIGNATURES, '.xlsx': ZIP_SIGNATURES, '.pptx': ZIP_SIGNATURES,
+    '.odt': ZIP_SIGNATURES, '.ods': ZIP_SIGNATURES, '.odp': ZIP_SIGNATURES, '.zip': ZIP_SIGNATURES,
+    '.rtf': [(0, b"{\\rtf")],
+    '.rar': [(0, b"Rar!\x1a\x07")],
+    '.7z': [(0, b"7z\xbc\xaf\x27\x1c")],
+    '.gz': [(0, b"\x1f\x8b")],
+    '.bz2': [(0, b"BZh")],
+    '.tar': [(257, b"ustar")],
+    '.png': [(0, b"\x89PNG\r\n\x1a\n")],
+    '.jpg': [(0, b"\xff\xd8\xff")], '.jpeg': [(0, b"\xff\xd8\xff")],
+    '.gif': [(0, b"GIF87a"), (0, b"GIF89a")],
+    '.bmp': [(0, b"BM")],
+    '.tiff': [(0, b"II*\x00"), (0, b"MM\x00*")],
+}
+# Текстовые форматы: проверяем, что это не бинарный файл под чужим расширением
+TEXT_FILE_EXTENSIONS = {
+    '.txt', '.csv', '.md', '.log', '.svg', '.py', '.js', '.html', '.css', '.json', '.xml', '.yaml', '.yml',
+    '.cpp', '.c', '.java', '.php', '.rb', '.go', '.rs', '.swift',
+}
+# Обязательная часть контейнера Office/ODF — отличает документ от переименованного zip
+CONTAINER_REQUIRED_ENTRIES = {
+    '.docx': '[Content_Types].xml', '.xlsx': '[Content_Types].xml', '.pptx': '[Content_Types].xml',
+    '.odt': 'mimetype', '.ods': 'mimetype', '.odp': 'mimetype',
+}
+
+VALIDATION_QUEUE: "queue.Queue[Optional[ValidationJob]]" = queue.Queue(maxsize=VALIDATION_QUEUE_MAX_SIZE)
+VALIDATION_STOP = threading.Event()
+VALIDATION_WORKER_THREADS: List[threading.Thread] = []
+# (sha256, расширение) -> причина отказа или None; вердикт зависит и от заявленного расширения
+VALIDATION_CACHE: "OrderedDict[tuple, Optional[str]]" = OrderedDict()
+VALIDATION_CACHE_LOCK = threading.Lock()
+VALIDATION_STATS = {
+    "files": 0, "rejected": 0, "cache_hits": 0,
+    "bytes_checked": 0, "archive_bytes_inflated": 0, "seconds": 0.0,
+}
+VALIDATION_STATS_LOCK = threading.Lock()
+
+@dataclass
+class ValidationBatch:
+    """Файлы одной загрузки: по последнему результату решается судьба заказа"""
+    order_id: int
+    filenames: List[str]
+    failures: Dict[str, str] = field(default_factory=dict)
+    remaining: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self.remaining = len(self.filenames)
+
+@dataclass
+class ValidationJob:
+    batch: ValidationBatch
+    filename: str
+
+def sniff_file_type(extension: str, head: bytes) -> Optional[str]:
+    """Сверяет первые байты файла с его расширением; возвращает причину отказа или None"""
+    signatures = FILE_SIGNATURES.get(extension)
+    if signatures is not None:
+        if not any(head[offset:offset + len(magic)] == magic for offset, magic in signatures):
+            return f"Содержимое не соответствует расширению {extension}"
+        return None
+    if extension in TEXT_FILE_EXTENSIONS and b"\x00" in head:
+        return f"Бинарные данные в текстовом файле {extension}"
+    return None
+
+def inspect_zip_archive(source, extension: str) -> int:
+    """Проверяет zip-контейнер распаковкой с ограничением объема; возвращает распакованные байты.
+
+    Заявленным в заголовках размерам не доверяем: считаем реально распакованные байты
+    и обрываем чтение, как только превышен общий лимит или коэффициент сжатия.
+    """
+    with zipfile.ZipFile(source) as archive:
+        entries = archive.infolist()
+        if len(entries) > VALIDATION_ZIP_MAX_ENTRIES:
+            raise ValueError(f"Слишком много файлов в архиве: {len(entries)}")
+
+        names = {entry.filename for entry in entries}
+        required_entry = CONTAINER_REQUIRED_ENTRIES.get(extension)
+        if required_entry and required_entry not in names:
+            raise ValueError(f"Файл {extension} поврежден: нет {required_entry}")
+
+        inflated_total = 0
+        compressed_total = 0
+        for entry in entries:
+            normalized = entry.filename.replace("\\", "/")
+            if normalized.startswith("/") or ".." in normalized.split("/"):
+                raise ValueError(f"Опасный путь в архиве: {entry.filename}")
+            if entry.is_dir():
+                continue
+            if entry.flag_bits & 0x1:
+                # Зашифрованное содержимое не проверить — допускаем, учитывая заявленный размер
+                inflated_total += entry.file_size
+                continue
+            compressed_total += entry.compress_size
+            with archive.open(entry) as member:
+                while True:
+                    chunk = member.read(STORAGE_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    inflated_total += len(chunk)
+                    if inflated_total > VALIDATION_ZIP_MAX_UNCOMPRESSED_BYTES:
+                        raise ValueError("Архив распаковывается в слишком большой объем")
+                    if inflated_total > STORAGE_STREAM_CHUNK_SIZE and inflated_total > VALIDATION_ZIP_MAX_RATIO * max(compressed_total, 1):
+                        raise ValueError("Подозрительно высокая степень сжатия (zip-бомба)")
+        return inflated_total
+
+def validate_stored_file(order_id: int, filename: str) -> Optional[str]:
+    """Полная проверка файла из хранилища; возвращает причину отказа или None"""
+    key = order_file_key(order_id, filename)
+    stored = FILE_STORAGE.stat(key)
+    if stored is None:
+        return "Файл не найден в хранилище"
+    if stored.size == 0:
+        return "Пустой файл"
+    if stored.size > VALIDATION_MAX_FILE_SIZE:
+        return f"Файл слишком большой: {stored.size / 1024 / 1024:.1f}MB"
+
+    extension = os.path.splitext(filename.lower())[1]
+    local_path = FILE_STORAGE.local_path(key)
+    hasher = hashlib.sha256()
+    head = b""
+    is_zip_container = FILE_SIGNATURES.get(extension) is ZIP_SIGNATURES
+    # zipfile нужен seekable-источник: из удаленного хранилища архив читаем в память
+    buffer = io.BytesIO() if is_zip_container and not local_path else None
+    for chunk in iter_stored_file(key):
+        if len(head) < 8192:
+            head += chunk[:8192 - len(head)]
+        hasher.update(chunk)
+        if buffer is not None:
+            buffer.write(chunk)
+    cache_key = (hasher.hexdigest(), extension)
+
+    with VALIDATION_CACHE_LOCK:
+        if cache_key in VALIDATION_CACHE:
+            VALIDATION_CACHE.move_to_end(cache_key)
+            with VALIDATION_STATS_LOCK:
+                VALIDATION_STATS["cache_hits"] += 1
+            return VALIDATION_CACHE[cache_key]
+
+    inflated = 0
+    reason = sniff_file_type(extension, head)
+    if reason is None and is_zip_container:
+        try:
+            inflated = inspect_zip_archive(local_path or buffer, extension)
+        except (ValueError, zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, EOFError) as e:
+            reason = str(e) if isinstance(e, ValueError) else f"Поврежденный архив: {e}"
+
+    with VALIDATION_CACHE_LOCK:
+        VALIDATION_CACHE[cache_key] = reason
+        if len(VALIDATION_CACHE) > VALIDATION_CACHE_MAX_ENTRIES:
+            VALIDATION_CACHE.popitem(last=False)
+    with VALIDATION_STATS_LOCK:
+        VALIDATION_STATS["bytes_checked"] += stored.size
+        VALIDATION_STATS["archive_bytes_inflated"] += inflated
+    return reason
+
+def queue_files_validation(order_id: int, filenames: List[str], background_tasks: BackgroundTasks) -> ValidationBatch:
+    """Ставит файлы загрузки на проверку; при переполненной очереди проверяет после ответа"""
+    batch = ValidationBatch(order_id, list(filenames))
+    for filename in filenames:
+        job = ValidationJob(batch, filename)
+        try:
+            VALIDATION_QUEUE.put_nowait(job)
+        except queue.Full:
+            logger.warning("⚠️ Очередь проверки файлов переполнена, %s проверяется в фоне запроса", filename)
+            background_tasks.add_task(run_validation_job, job)
+    return batch
+
+def run_validation_job(job: ValidationJob):
+    started = time.perf_counter()
+    try:
+        reason = validate_stored_file(job.batch.order_id, job.filename)
+    except Exception as e:
+        logger.error("❌ Ошибка проверки файла %s заказа %s: %s", job.filename, job.batch.order_id, e)
+        reason = "Не удалось проверить файл"
+    elapsed = time.perf_counter() - started
+
+    with VALIDATION_STATS_LOCK:
+        VALIDATION_STATS["files"] += 1
+        VALIDATION_STATS["seconds"] += elapsed
+        if reason:
+            VALIDATION_STATS["rejected"] += 1
+    if reason:
+        logger.warning("🚫 Файл %s заказа %s не прошел проверку: %s", job.filename, job.batch.order_id, reason)
+    else:
+        logger.info("🛡️ Файл %s заказа %s проверен за %.0fms", job.filename, job.batch.order_id, elapsed * 1000, extra=LOG_SAMPLED)
+
+    with job.batch.lock:
+        if reason:
+            job.batch.failures[job.filename] = reason
+        job.batch.remaining -= 1
+        batch_done = job.batch.remaining == 0
+    if batch_done:
+        finish_validation_batch(job.batch)
+
+def finish_validation_batch(batch: ValidationBatch):
+    """Последний файл партии проверен: отклоненные убираем, чистую партию завершаем"""
+    order_id = batch.order_id
+    passed = [name for name in batch.filenames if name not in batch.failures]
+    for filename in passed:
+        queue_file_preview(order_id, filename)
+
+    try:
+        if batch.failures:
+            for filename in batch.failures:
+                FILE_STORAGE.delete(order_file_key(order_id, filename))
+            # Параллельная загрузка в этот же заказ могла дописать свои файлы — убираем только отклоненные
+            update_order_files(order_id, remove=list(batch.failures))
+
+            details = "\n".join(
+                f"• {html.escape(name)}: {html.escape(reason)}" for name, reason in batch.failures.items()
+            )
+            send_notification(
+                f"🚫 <b>Файлы заказа #{order_id} не прошли проверку</b>\n\n{details}\n\n"
+                f"Заказ не переведен в «Выполнен» — загрузите файлы заново."
+            )
+            return
+
+        supabase.table('orders').update({
+            'status': 'completed',
+            'updated_at': datetime.now().isoformat()
+        }).eq('id', order_id).execute()
+        logger.info("✅ Файлы заказа %s проверены, заказ выполнен: %s", order_id, batch.filenames)
+        send_status_notification_to_user(get_order(order_id), 'completed')
+    except Exception as e:
+        logger.error("❌ Не удалось завершить проверку файлов заказа %s: %s", order_id, e)
+
+def validation_worker():
+    while not VALIDATION_STOP.is_set():
+        try:
+            job = VALIDATION_QUEUE.get(timeout=0.5)
+        except queue.Empty:
+            continue
+
+        try:
+            if job is not None:
+                run_validation_job(job)
+        finally:
+            VALIDATION_QUEUE.task_done()
+
+def start_validation_workers():
+    if any(thread.is_alive() for thread in VALIDATION_WORKER_THREADS):
+        return
+    VALIDATION_STOP.clear()
+    VALIDATION_WORKER_THREADS.clear()
+    for index in range(VALIDATION_WORKERS):
+        thread = threading.Thread(target=validation_worker, name=f"validation-worker-{index + 1}", daemon=True)
+        thread.start()
+        VALIDATION_WORKER_THREADS.append(thread)
+    logger.info("🛡️ Проверка загруженных файлов запущена (%s worker)", VALIDATION_WORKERS)
+
+def stop_validation_workers():
+    VALIDATION_STOP.set()
+    for _ in VALIDATION_WORKER_THREADS:
+        try:
+            VALIDATION_QUEUE.put_nowait(None)
+        except queue.Full:
+            break
+
 def init_database():
     """Проверяем подключение к Supabase и готовность таблиц"""
     if not supabase:
-        print("❌ Supabase клиент не инициализирован!")
+        logger.error("❌ Supabase клиент не инициализирован!")
         return False
     
     try:
         # Проверяем подключение
         response = supabase.table('subjects').select('id').limit(1).execute()
-        print("✅ Подключение к Supabase установлено!")
+        logger.info("✅ Подключение к Supabase установлено!")
         
         # Проверяем есть ли базовые предметы
         subjects_count = supabase.table('subjects').select('id', count='exact').execute()
         if subjects_count.count == 0:
-            print("⚠️ В таблице subjects нет данных. Создайте предметы в Supabase Dashboard.")
+            logger.warning("⚠️ В таблице subjects нет данных. Создайте предметы в Supabase Dashboard.")
         
         return True
     except Exception as e:
-        print(f"❌ Ошибка подключения к Supabase: {e}")
+        logger.error("❌ Ошибка подключения к Supabase: %s", e)
         return False
 
-def send_notification(message: str):
+def send_notification(message: str, lane: str = NOTIFICATION_LANE_ADMIN):
     """Отправка уведомления администратору(ам) в Telegram"""
     if not BOT_TOKEN or (not BOT_CHAT_ID and not ADMIN_CHAT_IDS):
-        print("⚠️ Telegram бот не настроен")
-        print(f"📱 УВЕДОМЛЕНИЕ: {message}")
+        logger.warning("⚠️ Telegram бот не настроен")
+        logger.info("📱 УВЕДОМЛЕНИЕ: %s", message)
         return
 
     try:
         targets = parse_chat_ids(BOT_CHAT_ID, ",".join(ADMIN_CHAT_IDS))
-        print(f"📣 Админ-цели для уведомления: {targets}")
+        logger.info("📣 Админ-цели для уведомления: %s", targets)
 
         queued_any = False
         for chat_id in targets:
-            queued_any = send_telegram_message_to_chat(chat_id, message) or queued_any
+            queued_any = send_telegram_message_to_chat(chat_id, message, lane=lane) or queued_any
 
         if not queued_any:
-            print("⚠️ Не удалось поставить сообщение в очередь ни одному администратору")
+            logger.warning("⚠️ Не удалось поставить сообщение в очередь ни одному администратору")
     except Exception as e:
-        print(f"❌ Ошибка отправки в Telegram: {e}")
-        print(f"📱 УВЕДОМЛЕНИЕ: {message}")
+        logger.error("❌ Ошибка отправки в Telegram: %s", e)
+        logger.info("📱 УВЕДОМЛЕНИЕ: %s", message)
 
 def send_executor_notification(message: str):
     """Отправка уведомления исполнителям о новом заказе"""
     if not BOT_TOKEN or not EXECUTOR_CHAT_IDS:
-        print("⚠️ Telegram бот не настроен для уведомлений исполнителей")
-        print(f"📱 УВЕДОМЛЕНИЕ: {message}")
+        logger.warning("⚠️ Telegram бот не настроен для уведомлений исполнителей")
+        logger.info("📱 УВЕДОМЛЕНИЕ: %s", message)
         return
 
     try:
@@ -469,10 +1870,10 @@ def send_executor_notification(message: str):
                 'text': message,
                 'parse_mode': 'HTML'
             }
-            queue_telegram_notification("sendMessage", payload, f"исполнитель {chat_id}")
+            queue_telegram_notification("sendMessage", payload, f"исполнитель {chat_id}", lane=NOTIFICATION_LANE_EXECUTORS)
     except Exception as e:
-        print(f"❌ Ошибка отправки исполнителям в Telegram: {e}")
-        print(f"📱 УВЕДОМЛЕНИЕ: {message}")
+        logger.error("❌ Ошибка отправки исполнителям в Telegram: %s", e)
+        logger.info("📱 УВЕДОМЛЕНИЕ: %s", message)
 
 def normalize_executor_telegram(value: Optional[str]) -> Optional[str]:
     if not isinstance(value, str):
@@ -483,14 +1884,18 @@ def normalize_executor_telegram(value: Optional[str]) -> Optional[str]:
 def is_blocked_board_executor(value: Optional[str]) -> bool:
     return normalize_executor_telegram(value) == BLOCKED_BOARD_EXECUTOR
 
+# Реквизиты собираются один раз; в ответах один и тот же dict только читается
+PAYMENT_DETAILS_BY_METHOD = {
+    method: {"method": method, **details}
+    for method, details in PAYMENT_METHODS.items()
+}
+
 def get_payment_details_for_order(order: dict) -> dict:
-    raw_method = str(order.get("payment_method") or "").strip().lower()
-    method = raw_method if raw_method in PAYMENT_METHODS else PAYMENT_METHOD_SBERBANK
-    details = PAYMENT_METHODS[method]
-    return {
-        "method": method,
-        **details
-    }
+    raw_method = order.get("payment_method")
+    if raw_method in PAYMENT_DETAILS_BY_METHOD:
+        return PAYMENT_DETAILS_BY_METHOD[raw_method]
+    method = str(raw_method or "").strip().lower()
+    return PAYMENT_DETAILS_BY_METHOD.get(method, PAYMENT_DETAILS_BY_METHOD[PAYMENT_METHOD_SBERBANK])
 
 def normalize_telegram_username(value: Optional[str]) -> str:
     if not isinstance(value, str):
@@ -518,50 +1923,150 @@ def find_student_by_telegram(telegram_username: str, fields: str = "id, chat_id"
         if response.data:
             return response.data[0]
     except Exception as e:
-        print(f"⚠️ Ошибка точного поиска студента @{clean_telegram}: {e}")
+        logger.warning("⚠️ Ошибка точного поиска студента @%s: %s", clean_telegram, e)
 
     try:
         response = supabase.table('students').select(fields).ilike('telegram', clean_telegram).limit(1).execute()
         if response.data:
             return response.data[0]
     except Exception as e:
-        print(f"⚠️ Ошибка нечувствительного к регистру поиска студента @{clean_telegram}: {e}")
+        logger.warning("⚠️ Ошибка нечувствительного к регистру поиска студента @%s: %s", clean_telegram, e)
 
     return None
 
+def get_cached_chat_id(key: str) -> tuple:
+    """Возвращает (найден_в_кэше, chat_id). Отрицательный результат тоже кэшируется."""
+    with CHAT_ID_CACHE_LOCK:
+        entry = CHAT_ID_CACHE.get(key)
+        if entry is None:
+            return False, None
+        chat_id, expires_at = entry
+        if time.monotonic() >= expires_at:
+            CHAT_ID_CACHE.pop(key, None)
+            return False, None
+        return True, chat_id
+
+def cache_chat_id(keys: List[str], chat_id: Optional[str]) -> None:
+    """Запоминает chat_id под несколькими ключами (id студента и telegram)."""
+    if CHAT_ID_CACHE_TTL_SECONDS <= 0:
+        return
+    expires_at = time.monotonic() + CHAT_ID_CACHE_TTL_SECONDS
+    with CHAT_ID_CACHE_LOCK:
+        if len(CHAT_ID_CACHE) + len(keys) > CHAT_ID_CACHE_MAX_SIZE:
+            now = time.monotonic()
+            for stale_key in [k for k, (_, exp) in CHAT_ID_CACHE.items() if exp <= now]:
+                del CHAT_ID_CACHE[stale_key]
+            # Если все записи свежие, выбрасываем самую старую половину
+            if len(CHAT_ID_CACHE) + len(keys) > CHAT_ID_CACHE_MAX_SIZE:
+                for old_key in list(CHAT_ID_CACHE)[:len(CHAT_ID_CACHE) // 2 + len(keys)]:
+                    del CHAT_ID_CACHE[old_key]
+        for key in keys:
+            CHAT_ID_CACHE[key] = (chat_id, expires_at)
+
+def remember_student_chat_id(student_id: Any, telegram_username: Optional[str], chat_id: Any) -> None:
+    """Обновляет кэш сразу после сохранения chat_id, чтобы не ждать истечения TTL."""
+    keys = []
+    if student_id is not None and str(student_id).strip():
+        keys.append(f"id:{student_id}")
+    clean_telegram = normalize_telegram_username(telegram_username)
+    if clean_telegram:
+        keys.append(f"tg:{clean_telegram}")
+    if keys:
+        cache_chat_id(keys, normalize_chat_id(chat_id))
+
+def quote_postgrest_value(value: str) -> str:
+    """Экранирует значение для списка in.(...) внутри фильтра or=(...)."""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+def resolve_chat_ids(students: List[dict]) -> List[Optional[str]]:
+    """Находит chat_id для списка студентов одним запросом к Supabase.
+
+    Порядок поиска повторяет одиночный вариант: сначала по id студента, затем по
+    telegram. Результат возвращается в том же порядке, что и входной список.
+    """
+    lookups = []
+    pending_ids: Dict[str, None] = {}
+    pending_telegrams: Dict[str, None] = {}
+
+    for student in students:
+        student = student or {}
+        raw_id = student.get('id')
+        student_id = str(raw_id).strip() if raw_id is not None else ""
+        if not student_id.isdigit():
+            student_id = ""
+        clean_telegram = normalize_telegram_username(student.get('telegram'))
+        lookups.append((student_id, clean_telegram))
+
+        if student_id and not get_cached_chat_id(f"id:{student_id}")[0]:
+            pending_ids[student_id] = None
+        if clean_telegram and not get_cached_chat_id(f"tg:{clean_telegram}")[0]:
+            pending_telegrams[clean_telegram] = None
+
+    if (pending_ids or pending_telegrams) and supabase:
+        filters = []
+        if pending_ids:
+            filters.append(f"id.in.({','.join(pending_ids)})")
+        if pending_telegrams:
+            filters.append(f"telegram.in.({','.join(quote_postgrest_value(t) for t in pending_telegrams)})")
+        try:
+            response = supabase.table('students').select('id, telegram, chat_id').or_(",".join(filters)).execute()
+            for row in response.data or []:
+                remember_student_chat_id(row.get('id'), row.get('telegram'), row.get('chat_id'))
+                pending_ids.pop(str(row.get('id')), None)
+                pending_telegrams.pop(normalize_telegram_username(row.get('telegram')), None)
+            # Не найденные записи кэшируем как отсутствующие
+            cache_chat_id([f"id:{student_id}" for student_id in pending_ids], None)
+        except Exception as e:
+            logger.warning("⚠️ Ошибка пакетного поиска chat_id: %s", e)
+            pending_telegrams.clear()
+
+        # Старые записи могут хранить telegram в другом регистре
+        for clean_telegram in pending_telegrams:
+            try:
+                response = supabase.table('students').select('id, chat_id').ilike('telegram', clean_telegram).limit(1).execute()
+                row = response.data[0] if response.data else {}
+                remember_student_chat_id(row.get('id'), clean_telegram, row.get('chat_id'))
+            except Exception as e:
+                logger.warning("⚠️ Ошибка нечувствительного к регистру поиска студента @%s: %s", clean_telegram, e)
+
+    resolved: List[Optional[str]] = []
+    for student_id, clean_telegram in lookups:
+        chat_id = get_cached_chat_id(f"id:{student_id}")[1] if student_id else None
+        if not chat_id and clean_telegram:
+            chat_id = get_cached_chat_id(f"tg:{clean_telegram}")[1]
+        resolved.append(chat_id)
+    return resolved
+
+def resolve_chat_id(student: dict) -> Optional[str]:
+    """Находит chat_id одного студента через общий пакетный резолвер."""
+    return resolve_chat_ids([student])[0]
+
 def send_status_notification_to_user(order: dict, new_status: str):
     """Отправка уведомления пользователю об изменении статуса заказа"""
     if not BOT_TOKEN:
-        print("⚠️ BOT_TOKEN не настроен для уведомлений пользователей")
+        logger.warning("⚠️ BOT_TOKEN не настроен для уведомлений пользователей")
         return
         
     user_telegram = normalize_telegram_username(order['student'].get('telegram'))
     if not user_telegram:
-        print("⚠️ У пользователя не указан telegram")
+        logger.warning("⚠️ У пользователя не указан telegram")
         return
     
     # Получаем chat_id пользователя из БД. Telegram Bot API не умеет надежно писать
     # обычным пользователям по @username, поэтому нужен сохраненный numeric chat_id.
-    notification_target = None
+    # Для пачки заказов chat_id заранее загружаются resolve_chat_ids и берутся из кэша.
     try:
-        student_id = order.get('student', {}).get('id')
-        if student_id:
-            student_response = supabase.table('students').select('chat_id').eq('id', student_id).limit(1).execute()
-            if student_response.data:
-                notification_target = normalize_chat_id(student_response.data[0].get('chat_id'))
-
-        if not notification_target:
-            student = find_student_by_telegram(user_telegram, fields="id, chat_id")
-            notification_target = normalize_chat_id(student.get('chat_id')) if student else None
+        notification_target = resolve_chat_id(order.get('student') or {})
 
         if notification_target:
-            print(f"📱 Отправляем уведомление пользователю @{user_telegram} (chat_id: {notification_target})")
+            logger.info("📱 Отправляем уведомление пользователю @%s (chat_id: %s)", user_telegram, notification_target, extra=LOG_SAMPLED)
         else:
-            print(f"⚠️ Chat ID не найден для @{user_telegram}. Пользователь должен открыть мини-апп или написать боту.")
+            logger.warning("⚠️ Chat ID не найден для @%s. Пользователь должен открыть мини-апп или написать боту.", user_telegram)
             return
 
     except Exception as e:
-        print(f"❌ Ошибка получения chat_id: {e}")
+        logger.error("❌ Ошибка получения chat_id: %s", e)
         return
     
     # Сообщения для разных статусов
@@ -692,13 +2197,27 @@ def send_status_notification_to_user(order: dict, new_status: str):
         queued = queue_telegram_notification(
             "sendMessage",
             payload,
-            f"статус '{new_status}' для @{user_telegram}"
+            f"статус '{new_status}' для @{user_telegram}",
+            lane=NOTIFICATION_LANE_PAYMENT if new_status in PAYMENT_NOTIFICATION_STATUSES else NOTIFICATION_LANE_STATUS
         )
         if not queued:
-            print(f"❌ Не удалось поставить уведомление о статусе '{new_status}' в очередь для @{user_telegram}")
+            logger.error("❌ Не удалось поставить уведомление о статусе '%s' в очередь для @%s", new_status, user_telegram)
             
     except Exception as e:
-        print(f"❌ Ошибка отправки уведомления пользователю @{user_telegram}: {e}")
+        logger.error("❌ Ошибка отправки уведомления пользователю @%s: %s", user_telegram, e)
+
+def send_status_notifications_to_users(updates: List[tuple]):
+    """Массовая рассылка статусов: chat_id всех студентов загружаются одним запросом."""
+    if not BOT_TOKEN or not updates:
+        return
+
+    try:
+        resolve_chat_ids([(order or {}).get('student') or {} for order, _ in updates])
+    except Exception as e:
+        logger.warning("⚠️ Ошибка предзагрузки chat_id: %s", e)
+
+    for order, new_status in updates:
+        send_status_notification_to_user(order, new_status)
 
 def notify_executors_board_entry(order: dict):
     """Уведомление исполнителей, когда заказ попадает/возвращается на доску."""
@@ -710,7 +2229,7 @@ def notify_executors_board_entry(order: dict):
         if status not in ('paid', 'needs_revision'):
             return
         if is_blocked_board_executor(order.get('executor_telegram')):
-            print(f"ℹ️ Уведомление о доске пропущено: исполнитель @{BLOCKED_BOARD_EXECUTOR}")
+            logger.info("ℹ️ Уведомление о доске пропущено: исполнитель @%s", BLOCKED_BOARD_EXECUTOR)
             return
 
         subject_name = html.escape(str(order.get('subject', {}).get('name', 'Не указан')))
@@ -754,12 +2273,424 @@ def notify_executors_board_entry(order: dict):
 
         send_executor_notification(executor_message)
     except Exception as e:
-        print(f"⚠️ Ошибка отправки уведомления исполнителям: {e}")
+        logger.warning("⚠️ Ошибка отправки уведомления исполнителям: %s", e)
+
+# Рассылки: студенты читаются из Supabase страницами по id (keyset), сообщения уходят
+# с общим для рассылки лимитом, прогресс после каждой страницы сохраняется в SQLite,
+# поэтому после перезапуска backend рассылка продолжается с последней страницы.
+BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "broadcasts.sqlite3"
+)
+# Токен для админских API (рассылки и обновление клавиатур, dead letters); без него эти endpoints выключены.
+# BROADCAST_ADMIN_TOKEN — прежнее имя переменной
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "").strip() or os.getenv("BROADCAST_ADMIN_TOKEN", "").strip()
+# Ниже лимита Telegram (~30/с), чтобы обычным уведомлениям оставался запас
+BROADCAST_RATE_PER_SECOND = max(0.5, float(os.getenv("BROADCAST_RATE_PER_SECOND", "20")))
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "4")))
+BROADCAST_PAGE_SIZE = min(1000, max(10, int(os.getenv("BROADCAST_PAGE_SIZE", "100"))))
+BROADCAST_SEND_ATTEMPTS = max(1, int(os.getenv("BROADCAST_SEND_ATTEMPTS", "3")))
+# Пауза перед продолжением рассылки после временной ошибки Supabase/SQLite (удваивается)
+BROADCAST_RETRY_BASE_SECONDS = max(1.0, float(os.getenv("BROADCAST_RETRY_BASE_SECONDS", "5")))
+BROADCAST_RETRY_MAX_SECONDS = max(BROADCAST_RETRY_BASE_SECONDS, float(os.getenv("BROADCAST_RETRY_MAX_SECONDS", "300")))
+BROADCAST_MAX_TEXT_LENGTH = 4096
+BROADCAST_KIND_KEYBOARD = "keyboard"
+BROADCAST_KIND_ANNOUNCEMENT = "announcement"
+BROADCAST_KEYBOARD_TEXT = "🔄 Меню бота обновлено"
+BROADCAST_ACTIVE_STATUSES = ("queued", "running")
+BROADCAST_LOCAL = threading.local()
+BROADCAST_WAKE = threading.Event()
+BROADCAST_STOP = threading.Event()
+BROADCAST_WORKER: Optional[threading.Thread] = None
+# Колонка students.bot_blocked_at из deploy/supabase-broadcasts.sql; без нее заблокированные
+# пользователи помечаются только в локальной SQLite
+BROADCAST_BLOCKED_COLUMN_AVAILABLE = True
+
+class BroadcastRateLimiter:
+    """Равномерный лимит отправки для потоков одной рассылки; 429 сдвигает всех."""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_at)
+            self.next_at = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+BROADCAST_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        text TEXT,
+        parse_mode TEXT,
+        silent INTEGER NOT NULL DEFAULT 1,
+        status TEXT NOT NULL,
+        last_student_id INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        updated_at REAL NOT NULL,
+        finished_at REAL,
+        error TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, id)",
+    """
+    CREATE TABLE IF NOT EXISTS blocked_chats (
+        chat_id TEXT PRIMARY KEY,
+        reason TEXT,
+        blocked_at REAL NOT NULL
+    )
+    """,
+)
+
+def get_broadcast_connection() -> sqlite3.Connection:
+    return get_thread_sqlite_connection(BROADCAST_LOCAL, BROADCAST_DB_PATH, BROADCAST_SCHEMA, sqlite3.Row)
+
+def format_broadcast(row: sqlite3.Row) -> dict:
+    """Строка рассылки с прогрессом, скоростью и оценкой оставшегося времени."""
+    broadcast = dict(row)
+    broadcast["silent"] = bool(broadcast["silent"])
+    processed = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    broadcast["processed"] = processed
+    total = broadcast.get("total")
+    broadcast["progress_percent"] = round(min(100.0, processed * 100.0 / total), 1) if total else None
+    rate = None
+    eta = None
+    if broadcast.get("started_at") and processed:
+        elapsed = (broadcast.get("finished_at") or time.time()) - broadcast["started_at"]
+        if elapsed > 0:
+            rate = round(processed / elapsed, 1)
+            if total and broadcast["status"] == "running":
+                eta = round(max(0, total - processed) / (processed / elapsed))
+    broadcast["messages_per_second"] = rate
+    broadcast["eta_seconds"] = eta
+    return broadcast
+
+def get_broadcast(broadcast_id: int) -> Optional[dict]:
+    row = get_broadcast_connection().execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return format_broadcast(row) if row else None
+
+def create_broadcast(kind: str, text: Optional[str] = None, parse_mode: Optional[str] = None, silent: bool = True) -> dict:
+    """Ставит рассылку в очередь; обновление клавиатур не дублируется, пока идет предыдущее."""
+    connection = get_broadcast_connection()
+    if kind == BROADCAST_KIND_KEYBOARD:
+        row = connection.execute(
+            "SELECT * FROM broadcasts WHERE kind = ? AND status IN (?, ?) ORDER BY id LIMIT 1",
+            (kind, *BROADCAST_ACTIVE_STATUSES)
+        ).fetchone()
+        if row:
+            return format_broadcast(row)
+    now = time.time()
+    cursor = connection.execute(
+        "INSERT INTO broadcasts (kind, text, parse_mode, silent, status, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+        (kind, text, parse_mode, int(silent), now, now)
+    )
+    BROADCAST_WAKE.set()
+    logger.info("📣 Рассылка #%s (%s) поставлена в очередь", cursor.lastrowid, kind)
+    return get_broadcast(cursor.lastrowid)
+
+def cancel_broadcast(broadcast_id: int) -> Optional[dict]:
+    """Останавливает рассылку после текущей страницы."""
+    now = time.time()
+    get_broadcast_connection().execute(
+        "UPDATE broadcasts SET status = 'cancelled', updated_at = ?, finished_at = ? "
+        "WHERE id = ? AND status IN (?, ?)",
+        (now, now, broadcast_id, *BROADCAST_ACTIVE_STATUSES)
+    )
+    return get_broadcast(broadcast_id)
+
+def broadcast_recipients_query(after_id: int, columns: str = 'id, telegram, chat_id', count: Optional[str] = None):
+    query = supabase.table('students').select(columns, count=count).gt('id', after_id).not_.is_('chat_id', 'null')
+    if BROADCAST_BLOCKED_COLUMN_AVAILABLE:
+        query = query.is_('bot_blocked_at', 'null')
+    return query
+
+def disable_blocked_column_on_error(error: Exception) -> bool:
+    """True, если ошибка — отсутствие колонки bot_blocked_at (SQL еще не выполнен)."""
+    global BROADCAST_BLOCKED_COLUMN_AVAILABLE
+    if BROADCAST_BLOCKED_COLUMN_AVAILABLE and 'bot_blocked_at' in str(error):
+        BROADCAST_BLOCKED_COLUMN_AVAILABLE = False
+        logger.warning("⚠️ Колонки students.bot_blocked_at нет, блокировки храним локально. Выполните deploy/supabase-broadcasts.sql")
+        return True
+    return False
+
+def fetch_broadcast_page(after_id: int) -> List[dict]:
+    """Следующая страница получателей по id: без OFFSET, стоимость не растет к концу списка."""
+    try:
+        return broadcast_recipients_query(after_id).order('id').limit(BROADCAST_PAGE_SIZE).execute().data or []
+    except Exception as e:
+        if disable_blocked_column_on_error(e):
+            return fetch_broadcast_page(after_id)
+        raise
+
+def count_broadcast_recipients() -> Optional[int]:
+    """Оценка числа получателей для прогресса; без нее рассылка все равно идет."""
+    try:
+        return broadcast_recipients_query(0, columns='id', count='exact').limit(1).execute().count
+    except Exception as e:
+        if disable_blocked_column_on_error(e):
+            return count_broadcast_recipients()
+        logger.warning("⚠️ Не удалось посчитать получателей рассылки: %s", e)
+        return None
+
+def get_blocked_chat_ids(chat_ids: List[str]) -> set:
+    if not chat_ids:
+        return set()
+    placeholders = ",".join("?" for _ in chat_ids)
+    rows = get_broadcast_connection().execute(
+        f"SELECT chat_id FROM blocked_chats WHERE chat_id IN ({placeholders})", chat_ids
+    ).fetchall()
+    return {row["chat_id"] for row in rows}
+
+def flag_blocked_chat(chat_id: str, reason: str):
+    """Пользователь заблокировал бота: больше не пишем ему в рассылках."""
+    get_broadcast_connection().execute(
+        "INSERT INTO blocked_chats (chat_id, reason, blocked_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET reason = excluded.reason, blocked_at = excluded.blocked_at",
+        (chat_id, reason[:200], time.time())
+    )
+    if supabase and BROADCAST_BLOCKED_COLUMN_AVAILABLE:
+        try:
+            supabase.table('students').update({
+                'bot_blocked_at': datetime.now(timezone.utc).isoformat()
+            }).eq('chat_id', chat_id).execute()
+        except Exception as e:
+            if not disable_blocked_column_on_error(e):
+                logger.warning("⚠️ Не удалось пометить chat_id %s как заблокировавший бота: %s", chat_id, e)
+
+def clear_blocked_chat_ids(chat_ids: List[str]):
+    """Пользователь снова написал боту — снимаем отметку о блокировке."""
+    try:
+        blocked = sorted(get_blocked_chat_ids([str(chat_id) for chat_id in chat_ids if chat_id]))
+        if not blocked:
+            return
+        placeholders = ",".join("?" for _ in blocked)
+        get_broadcast_connection().execute(f"DELETE FROM blocked_chats WHERE chat_id IN ({placeholders})", blocked)
+    except sqlite3.Error as e:
+        logger.warning("⚠️ Ошибка снятия отметки блокировки: %s", e)
+        return
+    if supabase and BROADCAST_BLOCKED_COLUMN_AVAILABLE:
+        try:
+            supabase.table('students').update({'bot_blocked_at': None}).in_('chat_id', blocked).execute()
+        except Exception as e:
+            if not disable_blocked_column_on_error(e):
+                logger.warning("⚠️ Не удалось снять отметку блокировки: %s", e)
+    logger.info("🔓 Сняли отметку блокировки бота: %s chat_id", len(blocked))
+
+def build_broadcast_payload(broadcast: dict, student: dict) -> dict:
+    payload = {
+        'chat_id': str(student['chat_id']),
+        'disable_notification': broadcast['silent'],
+    }
+    if broadcast['kind'] == BROADCAST_KIND_KEYBOARD:
+        payload['text'] = BROADCAST_KEYBOARD_TEXT
+        payload['reply_markup'] = build_main_reply_keyboard(student.get('telegram'))
+    else:
+        payload['text'] = broadcast['text']
+        if broadcast.get('parse_mode'):
+            payload['parse_mode'] = broadcast['parse_mode']
+    return payload
+
+def send_broadcast_message(payload: dict, limiter: BroadcastRateLimiter) -> Optional[str]:
+    """Возвращает sent, blocked или failed; None — backend останавливается, сообщение не отправлено."""
+    for attempt in range(BROADCAST_SEND_ATTEMPTS):
+        if BROADCAST_STOP.is_set():
+            return None
+        limiter.wait()
+        response = post_telegram("sendMessage", payload, retries=1)
+        if response is not None and response.status_code == 200:
+            return "sent"
+        status_code = response.status_code if response is not None else None
+        description = ""
+        retry_after = None
+        if response is not None:
+            try:
+                body = response.json()
+                description = str(body.get("description") or "")
+                retry_after = (body.get("parameters") or {}).get("retry_after")
+            except Exception:
+                description = response.text[:200]
+        if status_code == 403 or (status_code == 400 and "chat not found" in description.lower()):
+            flag_blocked_chat(payload['chat_id'], description or str(status_code))
+            return "blocked"
+        if status_code == 429:
+            # Пауза для всех потоков рассылки, а не только для этого сообщения
+            limiter.pause(float(retry_after) if isinstance(retry_after, (int, float)) and retry_after > 0 else 1.0)
+            continue
+        if status_code is not None and status_code < 500:
+            logger.warning("⚠️ Рассылка: Telegram отклонил сообщение для %s (%s): %s", payload['chat_id'], status_code, description)
+            return "failed"
+        time.sleep(min(2 * (attempt + 1), 10))
+    return "failed"
+
+def run_broadcast(broadcast: dict):
+    """Проходит получателей страницами; прогресс фиксируется после каждой полной страницы."""
+    connection = get_broadcast_connection()
+    broadcast_id = broadcast["id"]
+    now = time.time()
+    if broadcast["status"] == "queued":
+        started = connection.execute(
+            "UPDATE broadcasts SET status = 'running', started_at = ?, updated_at = ?, total = ? WHERE id = ? AND status = 'queued'",
+            (now, now, count_broadcast_recipients(), broadcast_id)
+        ).rowcount
+        if not started:
+            # Отменили между next_broadcast() и запуском
+            logger.info("⏹️ Рассылка #%s отменена до начала", broadcast_id)
+            return
+        logger.info("📣 Рассылка #%s (%s) начата", broadcast_id, broadcast["kind"])
+    else:
+        logger.info("📣 Рассылка #%s продолжается с id > %s", broadcast_id, broadcast["last_student_id"])
+
+    limiter = BroadcastRateLimiter(BROADCAST_RATE_PER_SECOND)
+    last_student_id = broadcast["last_student_id"]
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix=f"broadcast-{broadcast_id}") as executor:
+        while not BROADCAST_STOP.is_set():
+            # Отмена видна перед каждой страницей, а не только после ее отправки
+            status = connection.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            if status is None or status[0] != 'running':
+                logger.info("⏹️ Рассылка #%s остановлена", broadcast_id)
+                return
+
+            page = fetch_broadcast_page(last_student_id)
+            if not page:
+                now = time.time()
+                connection.execute(
+                    "UPDATE broadcasts SET status = 'completed', updated_at = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                    (now, now, broadcast_id)
+                )
+                finished = get_broadcast(broadcast_id)
+                logger.info(
+                    "✅ Рассылка #%s завершена: отправлено %s, ошибок %s, заблокировали бота %s",
+                    broadcast_id, finished["sent"], finished["failed"], finished["blocked"]
+                )
+                return
+
+            recipients = [student for student in page if normalize_chat_id(student.get('chat_id'))]
+            # Заблокировавших бота пропускаем, даже если колонки в Supabase нет
+            blocked = get_blocked_chat_ids([str(student['chat_id']) for student in recipients])
+            recipients = [student for student in recipients if str(student['chat_id']) not in blocked]
+            outcomes = list(executor.map(
+                lambda student: send_broadcast_message(build_broadcast_payload(broadcast, student), limiter),
+                recipients
+            ))
+            if None in outcomes:
+                # Остановка посреди страницы: она будет пройдена заново после перезапуска
+                return
+
+            last_student_id = max(int(student['id']) for student in page)
+            updated = connection.execute(
+                "UPDATE broadcasts SET last_student_id = ?, sent = sent + ?, failed = failed + ?, "
+                "blocked = blocked + ?, updated_at = ?, error = NULL WHERE id = ? AND status = 'running'",
+                (last_student_id, outcomes.count("sent"), outcomes.count("failed"),
+                 outcomes.count("blocked"), time.time(), broadcast_id)
+            ).rowcount
+            if not updated:
+                logger.info("⏹️ Рассылка #%s остановлена", broadcast_id)
+                return
+
+def next_broadcast() -> Optional[dict]:
+    """Сначала незавершенная после перезапуска, затем самая старая из очереди."""
+    row = get_broadcast_connection().execute(
+        "SELECT * FROM broadcasts WHERE status IN (?, ?) ORDER BY status = 'running' DESC, id LIMIT 1",
+        BROADCAST_ACTIVE_STATUSES
+    ).fetchone()
+    return format_broadcast(row) if row else None
+
+def is_retryable_broadcast_error(error: Exception) -> bool:
+    """Сбои сети, 5xx и занятая SQLite — временные; ошибки запроса и данных — нет."""
+    if isinstance(error, (KeyError, TypeError, ValueError)) and not isinstance(error, json.JSONDecodeError):
+        return False
+    code = str(getattr(error, "code", "") or "")
+    # PGRST1xx/2xx — некорректный запрос или схема; SQLSTATE 22/23/42 — данные и синтаксис, 28 — доступ
+    if code.startswith(("PGRST1", "PGRST2")) or code[:2] in ("22", "23", "28", "42"):
+        return False
+    return True
+
+def broadcast_worker():
+    """Одна рассылка за раз: параллельные рассылки только делили бы один лимит Telegram.
+
+    После временной ошибки рассылка остается в очереди/running и повторяется с нарастающей
+    паузой с последней сохраненной страницы; failed — только для неисправимых ошибок.
+    """
+    consecutive_errors = 0
+    while not BROADCAST_STOP.is_set():
+        broadcast = None
+        try:
+            broadcast = next_broadcast()
+            if broadcast is None:
+                BROADCAST_WAKE.wait(timeout=5)
+                BROADCAST_WAKE.clear()
+                continue
+            run_broadcast(broadcast)
+            consecutive_errors = 0
+        except Exception as e:
+            error_text = sanitize_telegram_error(e)[:500]
+            if broadcast is None:
+                logger.error("❌ Ошибка очереди рассылок: %s", error_text)
+                BROADCAST_STOP.wait(5)
+                continue
+            try:
+                current = get_broadcast(broadcast["id"]) or broadcast
+                # Страница сохранилась после прошлой ошибки — backoff начинается заново
+                if current["last_student_id"] != broadcast["last_student_id"]:
+                    consecutive_errors = 0
+                now = time.time()
+                if is_retryable_broadcast_error(e):
+                    consecutive_errors += 1
+                    delay = min(BROADCAST_RETRY_BASE_SECONDS * (2 ** (consecutive_errors - 1)), BROADCAST_RETRY_MAX_SECONDS)
+                    logger.warning(
+                        "⏳ Рассылка #%s: временная ошибка, повтор через %.0f сек с id > %s: %s",
+                        broadcast["id"], delay, current["last_student_id"], error_text
+                    )
+                    get_broadcast_connection().execute(
+                        "UPDATE broadcasts SET error = ?, updated_at = ? WHERE id = ?",
+                        (error_text, now, broadcast["id"])
+                    )
+                    BROADCAST_STOP.wait(delay)
+                    continue
+                logger.error("❌ Рассылка #%s остановлена: %s", broadcast["id"], error_text)
+                get_broadcast_connection().execute(
+                    "UPDATE broadcasts SET status = 'failed', error = ?, updated_at = ?, finished_at = ? "
+                    "WHERE id = ? AND status IN (?, ?)",
+                    (error_text, now, now, broadcast["id"], *BROADCAST_ACTIVE_STATUSES)
+                )
+                consecutive_errors = 0
+            except sqlite3.Error as db_error:
+                logger.error("❌ Ошибка хранилища рассылок: %s", db_error)
+                BROADCAST_STOP.wait(BROADCAST_RETRY_BASE_SECONDS)
+
+def start_broadcast_worker():
+    global BROADCAST_WORKER
+    if not BOT_TOKEN or not supabase:
+        return
+    if BROADCAST_WORKER and BROADCAST_WORKER.is_alive():
+        return
+    BROADCAST_STOP.clear()
+    BROADCAST_WORKER = threading.Thread(target=broadcast_worker, name="broadcast-worker", daemon=True)
+    BROADCAST_WORKER.start()
+    logger.info("📣 Рассылки запущены (%s сообщений/с)", BROADCAST_RATE_PER_SECOND)
+
+def stop_broadcast_worker():
+    BROADCAST_STOP.set()
+    BROADCAST_WAKE.set()
 
 def force_refresh_all_user_keyboards(silent: bool = True) -> dict:
-    """Принудительно отправляет всем пользователям актуальную клавиатуру."""
-    print("ℹ️ Массовое обновление клавиатур отключено")
-    return {"status": "skipped", "reason": "keyboard refresh disabled"}
+    """Ставит в очередь рассылку актуальной клавиатуры всем пользователям."""
+    return create_broadcast(BROADCAST_KIND_KEYBOARD, silent=silent)
 
 # Старый startup удален - теперь используем lifespan
 
@@ -768,9 +2699,48 @@ def force_refresh_all_user_keyboards(silent: bool = True) -> dict:
 def read_root():
     return {"message": "Student Orders API is running"}
 
+@app.get("/api/health")
+def health_check():
+    """Легкая проверка живости для бота и балансировщика: без обращений к Supabase."""
+    return {"status": "ok"}
+
+@app.get("/api/metrics")
+def get_request_metrics(request: Request):
+    """Гистограммы задержки по маршрутам и средняя нагрузка на Supabase (с момента запуска процесса)."""
+    require_admin_token(request)
+    with ROUTE_LATENCY_LOCK:
+        snapshot = {route: dict(stats, buckets=list(stats["buckets"])) for route, stats in ROUTE_LATENCY_STATS.items()}
+
+    bucket_labels = [str(bound) for bound in REQUEST_LATENCY_BUCKETS_MS] + ["+Inf"]
+    routes = {}
+    for route, stats in sorted(snapshot.items()):
+        count = stats["count"]
+        routes[route] = {
+            "count": count,
+            "errors": stats["errors"],
+            "avg_ms": round(stats["sum_ms"] / count, 1) if count else None,
+            "p50_ms": estimate_latency_percentile(stats["buckets"], count, 0.5),
+            "p99_ms": estimate_latency_percentile(stats["buckets"], count, 0.99),
+            "max_ms": round(stats["max_ms"], 1),
+            "supabase_calls_per_request": round(stats["supabase_calls"] / count, 2) if count else None,
+            "supabase_ms_per_request": round(stats["supabase_ms"] / count, 1) if count else None,
+            "buckets_ms": dict(zip(bucket_labels, stats["buckets"])),
+        }
+    with VALIDATION_STATS_LOCK:
+        validation = dict(VALIDATION_STATS, seconds=round(VALIDATION_STATS["seconds"], 3))
+    validation["queue_size"] = VALIDATION_QUEUE.qsize()
+    validation["cache_entries"] = len(VALIDATION_CACHE)
+    return fast_json({
+        "slow_request_ms": SLOW_REQUEST_MS,
+        "routes": routes,
+        "file_validation": validation,
+        "notification_lanes": TELEGRAM_NOTIFICATION_QUEUE.snapshot(),
+    })
+
 @app.post("/api/bot/force-refresh-keyboards")
-async def force_refresh_keyboards(request: Request, background_tasks: BackgroundTasks):
+async def force_refresh_keyboards(request: Request):
     """Принудительное обновление клавиатуры для всех пользователей."""
+    require_admin_token(request)
     silent = True
     try:
         body = await request.json()
@@ -780,12 +2750,13 @@ async def force_refresh_keyboards(request: Request, background_tasks: Background
         # Тело может отсутствовать, в этом случае используем silent=True по умолчанию.
         pass
 
-    enqueue_background(background_tasks, force_refresh_all_user_keyboards, silent=silent)
-    return {"status": "accepted", "message": "Обновление клавиатур запущено в фоне"}
+    broadcast = await asyncio.to_thread(force_refresh_all_user_keyboards, silent=silent)
+    return {"status": "accepted", "message": "Обновление клавиатур запущено в фоне", "broadcast_id": broadcast["id"]}
 
 @app.post("/bot/force-refresh-keyboards")
-async def force_refresh_keyboards_compat(request: Request, background_tasks: BackgroundTasks):
+async def force_refresh_keyboards_compat(request: Request):
     """Совместимость для прокси, который срезает префикс /api."""
+    require_admin_token(request)
     silent = True
     try:
         body = await request.json()
@@ -794,8 +2765,177 @@ async def force_refresh_keyboards_compat(request: Request, background_tasks: Bac
     except Exception:
         pass
 
-    enqueue_background(background_tasks, force_refresh_all_user_keyboards, silent=silent)
-    return {"status": "accepted", "message": "Обновление клавиатур запущено в фоне"}
+    broadcast = await asyncio.to_thread(force_refresh_all_user_keyboards, silent=silent)
+    return {"status": "accepted", "message": "Обновление клавиатур запущено в фоне", "broadcast_id": broadcast["id"]}
+
+def require_admin_token(request: Request):
+    """Проверяет X-Admin-Token для админских API."""
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=503, detail="ADMIN_API_TOKEN не настроен")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Неверный токен администратора")
+
+@app.post("/api/broadcasts")
+@app.post("/broadcasts")
+async def create_broadcast_endpoint(request: Request):
+    """Новая рассылка: {"kind": "announcement", "text": "...", "parse_mode": "HTML", "silent": false}"""
+    require_admin_token(request)
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Ожидается JSON-объект")
+    kind = data.get("kind") or BROADCAST_KIND_ANNOUNCEMENT
+    if kind not in (BROADCAST_KIND_ANNOUNCEMENT, BROADCAST_KIND_KEYBOARD):
+        raise HTTPException(status_code=400, detail="kind должен быть announcement или keyboard")
+    text = str(data.get("text") or "").strip()
+    if kind == BROADCAST_KIND_ANNOUNCEMENT and not text:
+        raise HTTPException(status_code=400, detail="Не указан текст рассылки")
+    if len(text) > BROADCAST_MAX_TEXT_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Текст длиннее {BROADCAST_MAX_TEXT_LENGTH} символов")
+    parse_mode = data.get("parse_mode") or None
+    if parse_mode not in (None, "HTML", "Markdown", "MarkdownV2"):
+        raise HTTPException(status_code=400, detail="parse_mode должен быть HTML, Markdown или MarkdownV2")
+    if not BOT_TOKEN or not supabase:
+        raise HTTPException(status_code=503, detail="Telegram или база данных не настроены")
+    broadcast = await asyncio.to_thread(
+        create_broadcast, kind, text or None, parse_mode, bool(data.get("silent", kind == BROADCAST_KIND_KEYBOARD))
+    )
+    return fast_json(broadcast, status_code=202)
+
+@app.get("/api/broadcasts")
+@app.get("/broadcasts")
+async def list_broadcasts(request: Request, limit: int = 20):
+    require_admin_token(request)
+    rows = await asyncio.to_thread(
+        lambda: get_broadcast_connection().execute(
+            "SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (min(100, max(1, limit)),)
+        ).fetchall()
+    )
+    return fast_json({"broadcasts": [format_broadcast(row) for row in rows]})
+
+@app.get("/api/broadcasts/{broadcast_id}")
+@app.get("/broadcasts/{broadcast_id}")
+async def get_broadcast_endpoint(broadcast_id: int, request: Request):
+    """Прогресс рассылки: отправлено, ошибки, заблокировавшие бота, скорость и ETA."""
+    require_admin_token(request)
+    broadcast = await asyncio.to_thread(get_broadcast, broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    return fast_json(broadcast)
+
+@app.post("/api/broadcasts/{broadcast_id}/cancel")
+@app.post("/broadcasts/{broadcast_id}/cancel")
+async def cancel_broadcast_endpoint(broadcast_id: int, request: Request):
+    require_admin_token(request)
+    broadcast = await asyncio.to_thread(cancel_broadcast, broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    return fast_json(broadcast)
+
+def format_dead_letter(row: sqlite3.Row) -> dict:
+    dead_letter = dict(row)
+    dead_letter["payload"] = json.loads(dead_letter["payload"])
+    dead_letter["history"] = json.loads(dead_letter["history"])
+    dead_letter["replay_pending"] = dead_letter.pop("replay_requested_at") is not None
+    return dead_letter
+
+def dead_letter_filter(data: dict) -> tuple:
+    """WHERE по ids/reason/status_code/method/older_than_hours; пустой фильтр — только с all=true."""
+    conditions = []
+    params: List[Any] = []
+    ids = data.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(item, int) for item in ids):
+            raise HTTPException(status_code=400, detail="ids должен быть списком чисел")
+        if not ids:
+            return "0", []
+        conditions.append(f"id IN ({','.join('?' for _ in ids)})")
+        params.extend(ids)
+    for column in ("reason", "method"):
+        if data.get(column):
+            conditions.append(f"{column} = ?")
+            params.append(str(data[column]))
+    if data.get("status_code") is not None:
+        conditions.append("status_code = ?")
+        params.append(int(data["status_code"]))
+    if data.get("older_than_hours") is not None:
+        conditions.append("failed_at < ?")
+        params.append(time.time() - float(data["older_than_hours"]) * 3600)
+    if not conditions and data.get("all") is not True:
+        raise HTTPException(status_code=400, detail="Укажите фильтр (ids, reason, status_code, method, older_than_hours) или all=true")
+    return " AND ".join(conditions) or "1", params
+
+async def read_dead_letter_filter(request: Request) -> tuple:
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Ожидается JSON-объект")
+    try:
+        return dead_letter_filter(data)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный фильтр")
+
+@app.get("/api/notifications/dead-letters")
+@app.get("/notifications/dead-letters")
+async def list_dead_letters(request: Request, limit: int = 50, reason: Optional[str] = None,
+                            status_code: Optional[int] = None, method: Optional[str] = None):
+    """Недоставленные уведомления (новые первыми) и сводка по причинам."""
+    require_admin_token(request)
+    where, params = dead_letter_filter({"reason": reason, "status_code": status_code, "method": method, "all": True})
+
+    def load():
+        connection = get_dead_letter_connection()
+        rows = connection.execute(
+            f"SELECT * FROM dead_letters WHERE {where} ORDER BY id DESC LIMIT ?",
+            (*params, min(500, max(1, limit)))
+        ).fetchall()
+        summary = connection.execute(
+            "SELECT reason, status_code, COUNT(*) AS count, SUM(replay_requested_at IS NOT NULL) AS replay_pending "
+            "FROM dead_letters GROUP BY reason, status_code ORDER BY count DESC"
+        ).fetchall()
+        return rows, summary
+
+    rows, summary = await asyncio.to_thread(load)
+    return fast_json({
+        "summary": [dict(row) for row in summary],
+        "total": sum(row["count"] for row in summary),
+        "dead_letters": [format_dead_letter(row) for row in rows],
+    })
+
+@app.post("/api/notifications/dead-letters/replay")
+@app.post("/notifications/dead-letters/replay")
+async def replay_dead_letters(request: Request):
+    """Повтор выбранных уведомлений через обычную очередь: {"reason": "attempts_exhausted"} или {"ids": [...]}"""
+    require_admin_token(request)
+    if not BOT_TOKEN:
+        raise HTTPException(status_code=503, detail="Telegram не настроен")
+    where, params = await read_dead_letter_filter(request)
+    marked = await asyncio.to_thread(
+        lambda: get_dead_letter_connection().execute(
+            f"UPDATE dead_letters SET replay_requested_at = ? WHERE replay_requested_at IS NULL AND {where}",
+            (time.time(), *params)
+        ).rowcount
+    )
+    DEAD_LETTER_REPLAY_WAKE.set()
+    logger.info("🔁 Запрошен повтор %s недоставленных уведомлений", marked)
+    return {"status": "accepted", "replay_queued": marked, "rate_per_second": DEAD_LETTER_REPLAY_RATE_PER_SECOND}
+
+@app.post("/api/notifications/dead-letters/purge")
+@app.post("/notifications/dead-letters/purge")
+async def purge_dead_letters(request: Request):
+    """Удаляет недоставленные уведомления по фильтру: {"status_code": 403} или {"all": true}"""
+    require_admin_token(request)
+    where, params = await read_dead_letter_filter(request)
+    deleted = await asyncio.to_thread(
+        lambda: get_dead_letter_connection().execute(f"DELETE FROM dead_letters WHERE {where}", params).rowcount
+    )
+    logger.info("🗑️ Удалено недоставленных уведомлений: %s", deleted)
+    return {"status": "success", "deleted": deleted}
 
 async def save_chat_id_handler(request: Request):
     """Общий обработчик для сохранения chat_id пользователя"""
@@ -806,7 +2946,7 @@ async def save_chat_id_handler(request: Request):
         first_name = data.get('first_name', '')
         last_name = data.get('last_name', '')
         
-        print(f"💾 Получен запрос на сохранение chat_id: @{telegram_username} -> {chat_id}")
+        logger.info("💾 Получен запрос на сохранение chat_id: @%s -> %s", telegram_username, chat_id, extra=LOG_SAMPLED)
         
         if not telegram_username or not chat_id:
             raise HTTPException(status_code=400, detail="Не указан telegram_username или chat_id")
@@ -816,6 +2956,8 @@ async def save_chat_id_handler(request: Request):
         
         if existing_student:
             if str(existing_student.get("chat_id") or "") == str(chat_id):
+                remember_student_chat_id(existing_student.get('id'), telegram_username, chat_id)
+                clear_blocked_chat_ids([chat_id])
                 return {"status": "success", "message": "Chat ID уже актуален"}
 
             # Обновляем существующего студента
@@ -824,21 +2966,25 @@ async def save_chat_id_handler(request: Request):
                 'telegram': telegram_username,
                 'chat_id': str(chat_id)
             }).eq('id', student_id).execute()
-            print(f"✅ Chat ID обновлен для студента @{telegram_username} (ID: {student_id})")
+            remember_student_chat_id(student_id, telegram_username, chat_id)
+            logger.info("✅ Chat ID обновлен для студента @%s (ID: %s)", telegram_username, student_id)
         else:
             # Создаем нового студента с chat_id (будет дополнен при создании заказа)
-            supabase.table('students').insert({
+            new_student = supabase.table('students').insert({
                 'telegram': telegram_username,
                 'chat_id': str(chat_id),
                 'name': first_name + (' ' + last_name if last_name else ''),
                 'group_name': 'Не указана'  # Будет обновлено при создании заказа
             }).execute()
-            print(f"✅ Создан новый студент @{telegram_username} с chat_id")
+            new_student_id = new_student.data[0].get('id') if new_student.data else None
+            remember_student_chat_id(new_student_id, telegram_username, chat_id)
+            logger.info("✅ Создан новый студент @%s с chat_id", telegram_username)
         
+        clear_blocked_chat_ids([chat_id])
         return {"status": "success", "message": "Chat ID сохранен"}
         
     except Exception as e:
-        print(f"❌ Ошибка сохранения chat_id: {e}")
+        logger.error("❌ Ошибка сохранения chat_id: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка сохранения: {str(e)}")
 
 @app.post("/api/save-chat-id")
@@ -851,55 +2997,206 @@ async def save_chat_id_direct(request: Request):
     """Сохранение chat_id пользователя для отправки уведомлений (без префикса /api/)"""
     return await save_chat_id_handler(request)
 
-async def try_direct_file_upload(file_info, file_name: str, order_id: int, user_chat_id: str, send_document_url: str) -> bool:
-    """Попытка прямой отправки файла в Telegram с проверкой размера"""
+def normalize_chat_id_entries(raw_entries: Any) -> tuple:
+    """Возвращает (записи {telegram, chat_id, name} без повторов, число отброшенных)."""
+    if not isinstance(raw_entries, list):
+        raise HTTPException(status_code=400, detail="entries должен быть списком")
+    if len(raw_entries) > SAVE_CHAT_IDS_MAX_ENTRIES:
+        raise HTTPException(status_code=413, detail=f"Не больше {SAVE_CHAT_IDS_MAX_ENTRIES} записей за запрос")
+
+    entries = {}
+    rejected = 0
+    for raw_entry in raw_entries:
+        if not isinstance(raw_entry, dict):
+            rejected += 1
+            continue
+        telegram = normalize_telegram_username(raw_entry.get('telegram_username', ''))
+        chat_id = normalize_chat_id(raw_entry.get('chat_id'))
+        if not telegram or not chat_id:
+            rejected += 1
+            continue
+        first_name = str(raw_entry.get('first_name') or '')
+        last_name = str(raw_entry.get('last_name') or '')
+        # Последнее наблюдение побеждает
+        entries.pop(telegram, None)
+        entries[telegram] = {
+            'telegram': telegram,
+            'chat_id': chat_id,
+            'name': first_name + (' ' + last_name if last_name else ''),
+        }
+    return list(entries.values()), rejected
+
+def save_chat_ids_via_rpc(entries: List[dict]) -> Optional[dict]:
+    """Применяет пачку функцией save_chat_ids_bulk; None — функции нет в БД."""
+    global SAVE_CHAT_IDS_RPC_AVAILABLE
+    if not SAVE_CHAT_IDS_RPC_AVAILABLE:
+        return None
     try:
-        print(f"🔄 Пробуем альтернативный метод для {file_name}")
+        response = supabase.rpc(SAVE_CHAT_IDS_RPC_NAME, {'p_entries': entries}).execute()
+    except Exception as e:
+        err_text = str(e)
+        if 'PGRST202' in err_text or 'could not find the function' in err_text.lower():
+            SAVE_CHAT_IDS_RPC_AVAILABLE = False
+            logger.warning(
+                "⚠️ Функция %s не найдена в БД, сохраняем chat_id обычными запросами. "
+                "Выполните deploy/supabase-save-chat-ids.sql", SAVE_CHAT_IDS_RPC_NAME
+            )
+            return None
+        raise
+
+    result = response.data
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    return result or {}
+
+def save_chat_ids_fallback(entries: List[dict]) -> dict:
+    """Та же пачка без функции в БД: один select на всех, update только изменившихся, один insert."""
+    telegrams = [entry['telegram'] for entry in entries]
+    response = supabase.table('students').select('id,telegram,chat_id').in_('telegram', telegrams).execute()
+    found = {}
+    for row in response.data or []:
+        found.setdefault(normalize_telegram_username(row.get('telegram')), row)
+    # Старые записи могли сохранить telegram в другом регистре: один ilike-запрос на всех
+    # ненайденных (имена Telegram — только буквы, цифры и _, экранирование не нужно)
+    missing = [telegram for telegram in telegrams if telegram not in found]
+    simple_missing = [telegram for telegram in missing if re.fullmatch(r"\w+", telegram)]
+    if simple_missing:
+        response = supabase.table('students').select('id,telegram,chat_id').or_(
+            ",".join(f"telegram.ilike.{telegram}" for telegram in simple_missing)
+        ).execute()
+        for row in sorted(response.data or [], key=lambda row: row.get('id') or 0):
+            # ilike считает _ любым символом — оставляем только точные совпадения без учета регистра
+            row_telegram = normalize_telegram_username(row.get('telegram'))
+            if row_telegram in simple_missing:
+                found.setdefault(row_telegram, row)
+    for telegram in missing:
+        if telegram not in found and telegram not in simple_missing:
+            student = find_student_by_telegram(telegram, fields="id,telegram,chat_id")
+            if student:
+                found[telegram] = student
+
+    students = []
+    updated = 0
+    new_entries = []
+    for entry in entries:
+        student = found.get(entry['telegram'])
+        if student is None:
+            new_entries.append(entry)
+            continue
+        if str(student.get('chat_id') or '') != entry['chat_id']:
+            supabase.table('students').update({
+                'telegram': entry['telegram'],
+                'chat_id': entry['chat_id']
+            }).eq('id', student['id']).execute()
+            updated += 1
+        students.append({'id': student['id'], 'telegram': entry['telegram'], 'chat_id': entry['chat_id']})
+
+    if new_entries:
+        inserted = supabase.table('students').insert([
+            {
+                'telegram': entry['telegram'],
+                'chat_id': entry['chat_id'],
+                'name': entry['name'],
+                'group_name': 'Не указана'  # Будет обновлено при создании заказа
+            }
+            for entry in new_entries
+        ]).execute()
+        students.extend(
+            {'id': row.get('id'), 'telegram': row.get('telegram'), 'chat_id': row.get('chat_id')}
+            for row in inserted.data or []
+        )
+    return {'students': students, 'updated': updated, 'inserted': len(new_entries)}
+
+@app.post("/api/save-chat-ids")
+@app.post("/save-chat-ids")
+async def save_chat_ids_batch(request: Request):
+    """Пакетное сохранение chat_id от бота: {"entries": [{telegram_username, chat_id, first_name, last_name}]}"""
+    if not supabase:
+        raise HTTPException(status_code=503, detail="База данных недоступна")
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный JSON")
+    entries, rejected = normalize_chat_id_entries(data.get('entries') if isinstance(data, dict) else None)
+    if not entries:
+        return {"status": "success", "saved": 0, "updated": 0, "inserted": 0, "rejected": rejected}
+
+    try:
+        result = await asyncio.to_thread(save_chat_ids_via_rpc, entries)
+        if result is None:
+            result = await asyncio.to_thread(save_chat_ids_fallback, entries)
+    except Exception as e:
+        logger.error("❌ Ошибка пакетного сохранения chat_id (%s записей): %s", len(entries), e)
+        raise HTTPException(status_code=500, detail=f"Ошибка сохранения: {str(e)}")
+
+    for student in result.get('students') or []:
+        remember_student_chat_id(student.get('id'), student.get('telegram'), student.get('chat_id'))
+    await asyncio.to_thread(clear_blocked_chat_ids, [entry['chat_id'] for entry in entries])
+    logger.info(
+        "💾 Пакет chat_id: %s записей, обновлено %s, создано %s, отброшено %s",
+        len(entries), result.get('updated', 0), result.get('inserted', 0), rejected, extra=LOG_SAMPLED
+    )
+    return {
+        "status": "success",
+        "saved": len(entries),
+        "updated": result.get('updated', 0),
+        "inserted": result.get('inserted', 0),
+        "rejected": rejected,
+    }
+
+def try_direct_file_upload(file_info, file_name: str, order_id: int, user_chat_id: str, send_document_url: str) -> bool:
+    """Попытка прямой отправки файла в Telegram с проверкой размера (блокирующая: вызывать через asyncio.to_thread)"""
+    try:
+        logger.debug("🔄 Пробуем альтернативный метод для %s", file_name)
         
         if isinstance(file_info, str):
-            # Файл на локальном сервере
-            local_file_path = os.path.join(UPLOADS_DIR, f"order_{order_id}", file_name)
-            print(f"📁 Ищем локальный файл: {local_file_path}")
+            # Файл в хранилище заказов (локальный диск или S3)
+            file_key = order_file_key(order_id, file_name)
+            logger.debug("📁 Ищем файл в хранилище %s: %s", FILE_STORAGE.name, file_key)
+            stored = FILE_STORAGE.stat(file_key)
             
-            if os.path.exists(local_file_path):
+            if stored:
                 # Проверяем размер файла (Telegram лимит 50MB)
-                file_size = os.path.getsize(local_file_path)
+                file_size = stored.size
                 max_size = 50 * 1024 * 1024  # 50MB в байтах
                 
                 if file_size > max_size:
-                    print(f"⚠️ Файл {file_name} слишком большой ({file_size / 1024 / 1024:.1f}MB) для Telegram (лимит 50MB)")
+                    logger.warning("⚠️ Файл %s слишком большой (%.1fMB) для Telegram (лимит 50MB)", file_name, file_size / 1024 / 1024)
                     return False
                 
-                print(f"📎 Отправляем файл напрямую: {file_name} ({file_size / 1024 / 1024:.1f}MB)")
+                logger.info("📎 Отправляем файл напрямую: %s (%.1fMB)", file_name, file_size / 1024 / 1024)
                 
-                with open(local_file_path, 'rb') as file_data:
+                file_data = FILE_STORAGE.open(file_key)
+                try:
                     files = {'document': (file_name, file_data)}
                     data = {
                         'chat_id': user_chat_id,
                         'caption': f"📎 {file_name} ({file_size / 1024 / 1024:.1f}MB)"
                     }
-                    response = requests.post(
+                    response = get_telegram_session().post(
                         send_document_url,
                         files=files,
                         data=data,
                         timeout=(TELEGRAM_CONNECT_TIMEOUT, max(TELEGRAM_READ_TIMEOUT, 90))
                     )
+                finally:
+                    file_data.close()
                     
-                    if response.status_code == 200:
-                        print(f"✅ Файл {file_name} отправлен напрямую")
-                        return True
-                    else:
-                        print(f"❌ Ошибка прямой отправки файла {file_name}: {response.text}")
-                        return False
+                if response.status_code == 200:
+                    logger.info("✅ Файл %s отправлен напрямую", file_name)
+                    return True
+                else:
+                    logger.error("❌ Ошибка прямой отправки файла %s: %s", file_name, response.text)
+                    return False
             else:
-                print(f"❌ Локальный файл не найден: {local_file_path}")
+                logger.error("❌ Файл не найден в хранилище: %s", file_key)
                 return False
         else:
-            print(f"❌ Альтернативный метод не поддерживается для URL-файлов")
+            logger.error("❌ Альтернативный метод не поддерживается для URL-файлов")
             return False
             
     except Exception as e:
-        print(f"❌ Ошибка альтернативного метода для {file_name}: {sanitize_telegram_error(e)}")
+        logger.error("❌ Ошибка альтернативного метода для %s: %s", file_name, sanitize_telegram_error(e))
         return False
 
 async def send_files_to_telegram_handler(request: Request):
@@ -909,13 +3206,13 @@ async def send_files_to_telegram_handler(request: Request):
         order_id = data.get('order_id')
         telegram_username = data.get('telegram', '').lstrip('@')
         
-        print(f"📁 Запрос на отправку файлов заказа #{order_id} для @{telegram_username}")
+        logger.info("📁 Запрос на отправку файлов заказа #%s для @%s", order_id, telegram_username)
         
         if not order_id or not telegram_username:
             raise HTTPException(status_code=400, detail="Не указан order_id или telegram")
         
-        # Получаем заказ с файлами
-        order = get_order(order_id)
+        # Получаем заказ с файлами (Supabase, хранилище и Telegram ниже — блокирующие вызовы, уводим их в поток)
+        order = await asyncio.to_thread(get_order, order_id)
         if not order:
             raise HTTPException(status_code=404, detail="Заказ не найден")
         
@@ -928,20 +3225,18 @@ async def send_files_to_telegram_handler(request: Request):
         if not files:
             raise HTTPException(status_code=404, detail="У заказа нет файлов")
         
-        print(f"📋 Структура файлов заказа #{order_id}:")
-        print(f"   Тип: {type(files)}")
-        print(f"   Содержимое: {files}")
-        for i, file_info in enumerate(files):
-            print(f"   Файл {i}: {type(file_info)} = {file_info}")
+        logger.debug("📋 Структура файлов заказа #%s: %r", order_id, files)
         
         # Получаем chat_id пользователя
-        student_response = supabase.table('students').select('chat_id').eq('telegram', telegram_username).limit(1).execute()
+        student_response = await asyncio.to_thread(
+            supabase.table('students').select('chat_id').eq('telegram', telegram_username).limit(1).execute
+        )
         
         if not student_response.data or not student_response.data[0].get('chat_id'):
             raise HTTPException(status_code=404, detail="Chat ID не найден. Напишите боту /start")
         
         user_chat_id = student_response.data[0]['chat_id']
-        print(f"📱 Отправляем файлы пользователю с chat_id: {user_chat_id}")
+        logger.debug("📱 Отправляем файлы пользователю с chat_id: %s", user_chat_id)
         
         # Отправляем сообщение с информацией о заказе
         intro_message = f"""
@@ -963,7 +3258,8 @@ async def send_files_to_telegram_handler(request: Request):
         queue_telegram_notification(
             "sendMessage",
             intro_payload,
-            f"вступительное сообщение с файлами заказа #{order_id}"
+            f"вступительное сообщение с файлами заказа #{order_id}",
+            lane=NOTIFICATION_LANE_FILES
         )
         
         # Отправляем каждый файл
@@ -978,49 +3274,54 @@ async def send_files_to_telegram_handler(request: Request):
                 if isinstance(file_info, str):
                     # Если file_info это строка, то это имя файла
                     file_name = file_info
-                    # Создаем URL для файла на основе имени (кодируем для безопасности)
+                    # Telegram скачает файл сам: из S3 по presigned URL, иначе через наш backend
                     encoded_name = urllib.parse.quote(file_name)
-                    file_url = f"{PUBLIC_BASE_URL}/api/orders/{order_id}/download/{encoded_name}"
+                    file_url = (
+                        await asyncio.to_thread(FILE_STORAGE.presigned_url, order_file_key(order_id, file_name), file_name)
+                        or f"{PUBLIC_BASE_URL}/api/orders/{order_id}/download/{encoded_name}"
+                    )
                 elif isinstance(file_info, dict):
                     # Если file_info это словарь, извлекаем URL и имя
                     file_url = file_info.get('url')
                     file_name = file_info.get('name', 'file')
                 else:
-                    print(f"⚠️ Неизвестный тип файла: {type(file_info)}")
+                    logger.warning("⚠️ Неизвестный тип файла: %s", type(file_info))
                     failed_files.append(file_name)
                     continue
                 
                 if not file_name:
-                    print(f"❌ Пустое имя файла: {file_info}")
+                    logger.error("❌ Пустое имя файла: %s", file_info)
                     failed_files.append("unnamed_file")
                     continue
                 
                 # Проверяем размер файла перед отправкой
                 if isinstance(file_info, str):
-                    local_file_path = os.path.join(UPLOADS_DIR, f"order_{order_id}", file_name)
-                    if os.path.exists(local_file_path):
-                        file_size = os.path.getsize(local_file_path)
+                    stored = await asyncio.to_thread(FILE_STORAGE.stat, order_file_key(order_id, file_name))
+                    if stored:
+                        file_size = stored.size
                         max_size = 50 * 1024 * 1024  # 50MB
                         
                         if file_size > max_size:
-                            print(f"⚠️ Файл {file_name} слишком большой ({file_size / 1024 / 1024:.1f}MB) для Telegram")
+                            logger.warning("⚠️ Файл %s слишком большой (%.1fMB) для Telegram", file_name, file_size / 1024 / 1024)
                             skipped_large_files.append(f"{file_name} ({file_size / 1024 / 1024:.1f}MB)")
                             continue
                 
-                print(f"📎 Отправляем файл: {file_name}")
+                logger.debug("📎 Отправляем файл: %s", file_name)
                 
-                send_document_url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendDocument"
+                send_document_url = f"{TELEGRAM_API_BASE_URL}/bot{BOT_TOKEN}/sendDocument"
                 success = False
                 
                 # Для строк (локальные файлы) сразу пробуем прямую отправку
                 if isinstance(file_info, str):
-                    print(f"📁 Локальный файл, пробуем прямую отправку")
-                    success = await try_direct_file_upload(file_info, file_name, order_id, user_chat_id, send_document_url)
+                    logger.debug("📁 Локальный файл, пробуем прямую отправку")
+                    success = await asyncio.to_thread(
+                        try_direct_file_upload, file_info, file_name, order_id, user_chat_id, send_document_url
+                    )
                 
                 # Если не получилось или это URL-файл, пробуем отправку по URL
                 if not success:
-                    print(f"🔗 URL файла: {file_url}")
-                    print(f"🌐 Пробуем отправку по URL")
+                    logger.debug("🔗 URL файла: %s", file_url)
+                    logger.debug("🌐 Пробуем отправку по URL")
                     
                     document_payload = {
                         'chat_id': user_chat_id,
@@ -1028,19 +3329,21 @@ async def send_files_to_telegram_handler(request: Request):
                         'caption': f"📎 {file_name}"
                     }
                     
-                    response = post_telegram("sendDocument", document_payload)
+                    response = await asyncio.to_thread(post_telegram, "sendDocument", document_payload)
                     
                     if response is not None and response.status_code == 200:
-                        print(f"✅ Файл {file_name} отправлен по URL")
+                        logger.info("✅ Файл %s отправлен по URL", file_name)
                         success = True
                     else:
                         response_text = response.text if response is not None else "Telegram API недоступен"
-                        print(f"⚠️ Не удалось отправить по URL: {response_text}")
+                        logger.warning("⚠️ Не удалось отправить по URL: %s", response_text)
                         
                         # Последняя попытка - прямая отправка (если ещё не пробовали)
                         if isinstance(file_info, str):
-                            print(f"🔄 Последняя попытка прямой отправки")
-                            success = await try_direct_file_upload(file_info, file_name, order_id, user_chat_id, send_document_url)
+                            logger.debug("🔄 Последняя попытка прямой отправки")
+                            success = await asyncio.to_thread(
+                                try_direct_file_upload, file_info, file_name, order_id, user_chat_id, send_document_url
+                            )
                 
                 if success:
                     sent_count += 1
@@ -1048,17 +3351,19 @@ async def send_files_to_telegram_handler(request: Request):
                     failed_files.append(file_name)
                     
             except Exception as e:
-                print(f"❌ Критическая ошибка при отправке файла {file_name}: {e}")
+                logger.error("❌ Критическая ошибка при отправке файла %s: %s", file_name, e)
                 failed_files.append(file_name)
                 # В критических случаях пробуем только прямую отправку
                 if isinstance(file_info, str):
                     try:
-                        success = await try_direct_file_upload(file_info, file_name, order_id, user_chat_id, send_document_url)
+                        success = await asyncio.to_thread(
+                            try_direct_file_upload, file_info, file_name, order_id, user_chat_id, send_document_url
+                        )
                         if success:
                             sent_count += 1
                             failed_files.remove(file_name)  # Убираем из неудачных, если получилось
                     except Exception as final_e:
-                        print(f"❌ Финальная попытка не удалась для {file_name}: {final_e}")
+                        logger.error("❌ Финальная попытка не удалась для %s: %s", file_name, final_e)
         
         # Формируем итоговое сообщение
         final_message_parts = []
@@ -1091,7 +3396,8 @@ async def send_files_to_telegram_handler(request: Request):
         queue_telegram_notification(
             "sendMessage",
             final_payload,
-            f"итог отправки файлов заказа #{order_id}"
+            f"итог отправки файлов заказа #{order_id}",
+            lane=NOTIFICATION_LANE_FILES
         )
         
         return {
@@ -1111,9 +3417,7 @@ async def send_files_to_telegram_handler(request: Request):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка отправки файлов в Telegram: {e}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception("❌ Ошибка отправки файлов в Telegram: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
 
 @app.post("/api/send-files-to-telegram")
@@ -1132,7 +3436,7 @@ async def send_files_to_telegram_direct(request: Request):
 def get_students():
     try:
         response = supabase.table('students').select('*').order('created_at', desc=True).execute()
-        return response.data
+        return fast_json(response.data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения студентов: {str(e)}")
 
@@ -1152,24 +3456,164 @@ def get_subjects():
             .neq('name', 'Архитектура прикладных информационных систем (ERP)') \
             .order('name') \
             .execute()
-        return response.data
+        return fast_json(response.data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения предметов: {str(e)}")
 
 # Orders endpoints
+# Алиасы PostgREST сразу отдают student/subject в формате API, без перекладывания в Python.
+# Колонки orders остаются "*": executor_telegram/payout_amount/payment_method добавляются
+# отдельными миграциями и могут отсутствовать в старых базах.
+ORDER_STUDENT_SELECT = 'student:students!inner(id, name, group:group_name, telegram)'
+ORDER_SUBJECT_SELECT = 'subject:subjects!inner(id, name, description, price)'
+ORDER_JOINED_SELECT = f"*, {ORDER_STUDENT_SELECT}, {ORDER_SUBJECT_SELECT}"
+
+# Облегченные проекции для списков: длинные текстовые поля отдает только get_order
+ORDER_LIST_FIELDS = {
+    'id', 'student_id', 'subject_id', 'title', 'description', 'input_data', 'variant_info',
+    'deadline', 'status', 'is_paid', 'files', 'selected_works', 'is_full_course', 'actual_price',
+    'revision_comment', 'revision_grade', 'executor_telegram', 'payout_amount', 'payment_method',
+    'created_at', 'updated_at',
+}
+ORDER_LIST_RELATIONS = {
+    'student': ORDER_STUDENT_SELECT,
+    'subject': 'subject:subjects!inner(id, name, price)',
+}
+ORDER_LIST_VIEWS = {
+    'full': ORDER_JOINED_SELECT,
+    'summary': (
+        'id', 'student_id', 'subject_id', 'title', 'deadline', 'status', 'is_paid', 'files', 'actual_price',
+        'executor_telegram', 'payout_amount', 'payment_method', 'created_at', 'updated_at',
+        'student', 'subject',
+    ),
+}
+# Явно перечисленные в проекциях колонки из отдельных миграций: если в базе какой-то
+# из них нет, запоминаем это по первой ошибке и дальше не запрашиваем
+ORDER_OPTIONAL_COLUMNS = ('executor_telegram', 'payout_amount', 'payment_method')
+MISSING_ORDER_COLUMNS: set = set()
+
+def parse_order_files(raw_files: Any) -> list:
+    """Поле files может храниться как JSON-строка или как массив jsonb."""
+    if not raw_files:
+        return []
+    if isinstance(raw_files, str):
+        try:
+            parsed = json.loads(raw_files)
+        except Exception:
+            return []
+        return parsed if isinstance(parsed, list) else []
+    return list(raw_files)
+
+def update_order_files(order_id: int, add: List[str] = (), remove: List[str] = ()) -> List[str]:
+    """Добавляет и убирает имена в orders.files, не теряя параллельные изменения; возвращает новый список."""
+    global UPDATE_ORDER_FILES_RPC_AVAILABLE
+    if UPDATE_ORDER_FILES_RPC_AVAILABLE:
+        try:
+            response = supabase.rpc(UPDATE_ORDER_FILES_RPC_NAME, {
+                'p_order_id': order_id,
+                'p_add': list(add),
+                'p_remove': list(remove),
+            }).execute()
+            return parse_order_files(response.data)
+        except Exception as e:
+            err_text = str(e)
+            if 'PGRST202' not in err_text and 'could not find the function' not in err_text.lower():
+                raise
+            UPDATE_ORDER_FILES_RPC_AVAILABLE = False
+            logger.warning(
+                "⚠️ Функция %s не найдена в БД, меняем файлы заказа через select + update. "
+                "Выполните deploy/supabase-order-files.sql", UPDATE_ORDER_FILES_RPC_NAME
+            )
+
+    with ORDER_FILES_LOCKS[order_id % len(ORDER_FILES_LOCKS)]:
+        current = supabase.table('orders').select('files').eq('id', order_id).single().execute()
+        files = [name for name in parse_order_files(current.data.get('files')) if name not in remove]
+        files += [name for name in add if name not in files]
+        supabase.table('orders').update({
+            'files': files,  # jsonb-массив, без двойной сериализации в строку
+            'updated_at': datetime.now().isoformat()
+        }).eq('id', order_id).execute()
+    return files
+
+def format_order_row(order: dict, partial: bool = False) -> dict:
+    """Дополняет строку заказа вычисляемыми полями и возвращает её же.
+
+    student/subject уже приходят в нужной форме благодаря алиасам в select, поэтому
+    строка меняется на месте без копирования. partial=True используется для
+    облегченных проекций: отсутствующие колонки не заполняются значениями None.
+    """
+    if not partial or 'files' in order:
+        files = order.get('files')
+        if not isinstance(files, list):
+            order['files'] = parse_order_files(files)
+
+    if not partial:
+        for column in ORDER_OPTIONAL_COLUMNS:
+            if column not in order:
+                order[column] = None
+        order['payment_details'] = get_payment_details_for_order(order)
+    elif 'payment_method' in order:
+        order['payment_details'] = get_payment_details_for_order(order)
+    return order
+
+def build_order_fields_select(requested) -> str:
+    """select из разрешенных полей и связей; отсутствующие в базе колонки пропускаются."""
+    columns = ['id'] + [
+        field for field in requested
+        if field in ORDER_LIST_FIELDS and field != 'id' and field not in MISSING_ORDER_COLUMNS
+    ]
+    relations = [ORDER_LIST_RELATIONS[field] for field in requested if field in ORDER_LIST_RELATIONS]
+    return ", ".join(list(dict.fromkeys(columns)) + relations)
+
+def build_order_list_select(view: str, fields: Optional[str]) -> str:
+    """Собирает select для списка заказов: готовая проекция view или явный список fields."""
+    if fields:
+        requested = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in requested if field not in ORDER_LIST_FIELDS and field not in ORDER_LIST_RELATIONS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Недопустимые поля: {', '.join(unknown)}")
+        return build_order_fields_select(requested)
+
+    if view not in ORDER_LIST_VIEWS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный view: {view}")
+    view_select = ORDER_LIST_VIEWS[view]
+    return view_select if isinstance(view_select, str) else build_order_fields_select(view_select)
+
+def disable_missing_order_columns_on_error(error: Exception) -> bool:
+    """True, если ошибка — отсутствие колонки orders из отдельной миграции."""
+    err_text = str(error)
+    if 'column' not in err_text.lower():
+        return False
+    missing = [column for column in ORDER_OPTIONAL_COLUMNS if column in err_text and column not in MISSING_ORDER_COLUMNS]
+    if not missing:
+        return False
+    MISSING_ORDER_COLUMNS.update(missing)
+    logger.warning("⚠️ В таблице orders нет колонок %s, списки заказов отдаются без них", ", ".join(missing))
+    return True
+
+def fetch_order_list_page(view: str, fields: Optional[str], student_id: Optional[int], offset: int, limit: int):
+    """Страница списка заказов; при отсутствии колонки из миграции повторяет запрос без нее."""
+    query = supabase.table('orders').select(build_order_list_select(view, fields))
+    if student_id is not None:
+        query = query.eq('student_id', student_id)
+    try:
+        return query.order('created_at', desc=True).range(offset, offset + limit - 1).execute()
+    except Exception as e:
+        if disable_missing_order_columns_on_error(e):
+            return fetch_order_list_page(view, fields, student_id, offset, limit)
+        raise
+
 @app.get("/api/orders")
 @app.get("/orders")
-def get_orders(page: int = 1, limit: int = 10, telegram: str = None):
+def get_orders(page: int = 1, limit: int = 10, telegram: str = None, view: str = "full", fields: Optional[str] = None):
     try:
         page = max(1, int(page or 1))
         limit = max(1, min(int(limit or 10), 200))
         offset = (page - 1) * limit
-        
-        query = supabase.table('orders').select("""
-            *,
-            students!inner(id, name, group_name, telegram),
-            subjects!inner(id, name, description, price)
-        """)
+        # Проверяем view/fields до обращений к базе
+        build_order_list_select(view, fields)
+        partial = bool(fields) or view != "full"
+        student_id = None
 
         count_query = supabase.table('orders').select('id', count='exact', head=True)
 
@@ -1186,97 +3630,36 @@ def get_orders(page: int = 1, limit: int = 10, telegram: str = None):
             student_id = student_response.data[0]['id']
             
             # 2. Фильтровать заказы по student_id
-            query = query.eq('student_id', student_id)
             count_query = count_query.eq('student_id', student_id)
 
         # Получаем заказы с пагинацией
-        response = query.order('created_at', desc=True).range(offset, offset + limit - 1).execute()
+        response = fetch_order_list_page(view, fields, student_id, offset, limit)
         
         # Получаем общее количество
         total_response = count_query.execute()
         total = total_response.count if total_response.count is not None else 0
 
-        orders = []
-        for order_data in response.data:
-            # Преобразуем данные в нужный формат
-            order = {
-                **order_data,
-                'student': {
-                    'id': order_data['students']['id'],
-                    'name': order_data['students']['name'],
-                    'group': order_data['students']['group_name'],
-                    'telegram': order_data['students']['telegram']
-                },
-                'subject': {
-                    'id': order_data['subjects']['id'],
-                    'name': order_data['subjects']['name'],
-                    'description': order_data['subjects']['description'],
-                    'price': order_data['subjects']['price']
-                },
-                'files': json.loads(order_data.get('files', '[]')) if isinstance(order_data.get('files'), str) else order_data.get('files', []),
-                'executor_telegram': order_data.get('executor_telegram'),
-                'payout_amount': order_data.get('payout_amount'),
-                'payment_method': order_data.get('payment_method')
-            }
-            order['payment_details'] = get_payment_details_for_order(order)
-            del order['students']
-            del order['subjects']
-            orders.append(order)
+        orders = [format_order_row(order_data, partial=partial) for order_data in response.data]
         
-        print(f"📦 GET /api/orders page={page} limit={limit} telegram={telegram or '-'} returned={len(orders)} total={total}")
-        return {"orders": orders, "total": total}
+        logger.info("📦 GET /api/orders page=%s limit=%s view=%s telegram=%s returned=%s total=%s", page, limit, 'fields' if fields else view, telegram or '-', len(orders), total, extra=LOG_SAMPLED)
+        return fast_json({"orders": orders, "total": total})
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ BACKEND: Ошибка получения заказов: {e}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception("❌ BACKEND: Ошибка получения заказов: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка на сервере при получении заказов: {str(e)}")
 
 @app.get("/api/orders/{order_id}")
 @app.get("/orders/{order_id}")
 def get_order(order_id: int):
     try:
-        response = supabase.table('orders').select("""
-            *,
-            students!inner(id, name, group_name, telegram),
-            subjects!inner(id, name, description, price)
-        """).eq('id', order_id).single().execute()
+        response = supabase.table('orders').select(ORDER_JOINED_SELECT).eq('id', order_id).single().execute()
         
         if not response.data:
             raise HTTPException(status_code=404, detail="Заказ не найден")
         
-        order = response.data
-        
-        # Парсим файлы
-        if order.get('files'):
-            try:
-                order['files'] = json.loads(order['files']) if isinstance(order['files'], str) else order['files']
-            except:
-                order['files'] = []
-        else:
-            order['files'] = []
-        
-        # Преобразуем связанные данные
-        order['student'] = {
-            'id': order['students']['id'],
-            'name': order['students']['name'],
-            'group': order['students']['group_name'],
-            'telegram': order['students']['telegram']
-        }
-        order['subject'] = {
-            'id': order['subjects']['id'],
-            'name': order['subjects']['name'],
-            'description': order['subjects']['description'],
-            'price': order['subjects']['price']
-        }
-        order['executor_telegram'] = order.get('executor_telegram')
-        order['payout_amount'] = order.get('payout_amount')
-        order['payment_method'] = order.get('payment_method')
-        order['payment_details'] = get_payment_details_for_order(order)
-        
-        # Удаляем вложенные объекты
-        del order['students']
-        del order['subjects']
+        order = format_order_row(response.data)
         
         return order
         
@@ -1285,13 +3668,266 @@ def get_order(order_id: int):
             raise HTTPException(status_code=404, detail="Заказ не найден")
         raise HTTPException(status_code=500, detail=f"Ошибка получения заказа: {str(e)}")
 
+IDEMPOTENCY_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        status_code INTEGER,
+        body TEXT,
+        created_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_created_at ON idempotency_keys(created_at)",
+)
+
+def get_idempotency_connection() -> sqlite3.Connection:
+    return get_thread_sqlite_connection(IDEMPOTENCY_LOCAL, IDEMPOTENCY_DB_PATH, IDEMPOTENCY_SCHEMA)
+
+def get_idempotency_key(request: Request) -> Optional[str]:
+    """Достает Idempotency-Key из заголовков; некорректный ключ дает 400."""
+    raw_key = (request.headers.get("Idempotency-Key") or "").strip()
+    if not raw_key:
+        return None
+    if not IDEMPOTENCY_KEY_PATTERN.match(raw_key):
+        raise HTTPException(status_code=400, detail="Некорректный Idempotency-Key")
+    return raw_key
+
+def build_request_fingerprint(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def prune_idempotency_store(connection: sqlite3.Connection):
+    """Удаляет просроченные ключи и держит размер хранилища в пределах лимита."""
+    connection.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (time.time() - IDEMPOTENCY_TTL_SECONDS,))
+    connection.execute(
+        "DELETE FROM idempotency_keys WHERE key IN ("
+        "SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (IDEMPOTENCY_MAX_ENTRIES,)
+    )
+
+def reserve_idempotency_key(storage_key: str, fingerprint: str, now: float) -> Tuple[bool, Optional[tuple]]:
+    """Пытается занять ключ; (True, None) — ключ наш, иначе (False, сохраненная строка или None)."""
+    connection = get_idempotency_connection()
+    inserted = connection.execute(
+        "INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, status_code, body, created_at) VALUES (?, ?, NULL, NULL, ?)",
+        (storage_key, fingerprint, now)
+    ).rowcount
+    if inserted:
+        return True, None
+    row = connection.execute(
+        "SELECT fingerprint, status_code, body, created_at FROM idempotency_keys WHERE key = ?",
+        (storage_key,)
+    ).fetchone()
+    return False, row
+
+async def claim_idempotency_key(scope: str, key: str, data: Any) -> Optional[Response]:
+    """Резервирует ключ или возвращает сохраненный ответ для повторного запроса.
+
+    None означает, что запрос нужно выполнить; после выполнения вызывается
+    store_idempotent_response или release_idempotency_key.
+    """
+    storage_key = f"{scope}:{key}"
+    fingerprint = build_request_fingerprint(data)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+    while True:
+        now = time.time()
+        try:
+            # SQLite с busy timeout 5 сек — в потоке, чтобы занятая база не держала event loop
+            inserted, row = await asyncio.to_thread(reserve_idempotency_key, storage_key, fingerprint, now)
+        except sqlite3.Error as e:
+            # Хранилище не должно ломать создание заказов
+            logger.warning("⚠️ Ошибка хранилища Idempotency-Key: %s", e)
+            return None
+        if inserted:
+            return None
+
+        if row is None:
+            continue
+
+        stored_fingerprint, status_code, body, created_at = row
+        if stored_fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key уже использован с другими данными")
+
+        if status_code is not None:
+            logger.info("🔁 Повтор запроса по Idempotency-Key, возвращаем сохраненный ответ: %s", key)
+            # Сохраненное тело уже сериализовано — отдаем байты без повторного парсинга
+            return Response(
+                content=body,
+                status_code=status_code,
+                media_type="application/json",
+                headers={"Idempotent-Replayed": "true"}
+            )
+
+        # Ключ завис (worker упал во время обработки) — забираем его
+        if now - created_at > IDEMPOTENCY_LOCK_SECONDS:
+            await asyncio.to_thread(release_idempotency_key, scope, key)
+            continue
+
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="Запрос с этим Idempotency-Key еще обрабатывается")
+        await asyncio.sleep(0.2)
+
+def store_idempotent_response(scope: str, key: str, status_code: int, body: Any):
+    """Сохраняет успешный ответ, чтобы повтор с тем же ключом получил его без запросов к БД."""
+    try:
+        connection = get_idempotency_connection()
+        connection.execute(
+            "UPDATE idempotency_keys SET status_code = ?, body = ?, created_at = ? WHERE key = ?",
+            (status_code, json.dumps(body, ensure_ascii=False, default=str), time.time(), f"{scope}:{key}")
+        )
+        prune_idempotency_store(connection)
+    except sqlite3.Error as e:
+        logger.warning("⚠️ Не удалось сохранить ответ для Idempotency-Key: %s", e)
+
+def release_idempotency_key(scope: str, key: str):
+    """Снимает резерв после ошибки, чтобы клиент мог повторить запрос."""
+    try:
+        get_idempotency_connection().execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND status_code IS NULL",
+            (f"{scope}:{key}",)
+        )
+    except sqlite3.Error as e:
+        logger.warning("⚠️ Не удалось освободить Idempotency-Key: %s", e)
+
+def enqueue_new_order_notifications(background_tasks: BackgroundTasks, created_order: dict):
+    """Ставит в фон уведомления администратору и студенту о новом заказе."""
+    try:
+        order_id = created_order['id']
+        actual_price = created_order.get('actual_price', 0.0)
+        description = created_order.get('description') or ''
+        message = f"""
+🆕 Новый заказ #{order_id}
+
+👤 Студент: {created_order['student']['name']}
+👥 Группа: {created_order['student']['group']}
+📱 Telegram: {created_order['student']['telegram']}
+
+📚 Предмет: {created_order['subject']['name']}
+📝 Название: {created_order['title']}
+📄 Описание: {description[:200]}{'...' if len(description) > 200 else ''}
+
+⏰ Дедлайн: {created_order['deadline']}
+💰 Стоимость: {actual_price} ₽
+
+Создан: {datetime.now().strftime('%d.%m.%Y %H:%M')}
+        """.strip()
+        
+        if created_order.get('variant_info'):
+            message += f"\n\n🔢 Информация о варианте:\n{created_order['variant_info'][:300]}{'...' if len(created_order['variant_info']) > 300 else ''}"
+        
+        if created_order.get('input_data'):
+            message += f"\n\n📋 Дополнительные требования:\n{created_order['input_data'][:300]}{'...' if len(created_order['input_data']) > 300 else ''}"
+        
+        enqueue_background(background_tasks, send_notification, message)
+
+        # Уведомляем самого пользователя о создании заказа (если доступна доставка)
+        enqueue_background(background_tasks, send_status_notification_to_user, created_order, 'new')
+        
+    except Exception as e:
+        logger.warning("⚠️ Ошибка отправки уведомления администратору: %s", e)
+
+def create_order_via_rpc(
+    data: dict,
+    student_data: dict,
+    clean_telegram: str,
+    student_chat_id: Optional[str],
+    duplicate_window_seconds: int = CREATE_ORDER_DUPLICATE_WINDOW_SECONDS
+) -> Optional[tuple]:
+    """Создает заказ функцией create_order_atomic (см. deploy/supabase-create-order.sql).
+
+    Возвращает (заказ, is_duplicate) или None, если функция не установлена в БД,
+    и тогда используется прежняя цепочка запросов.
+    """
+    global CREATE_ORDER_RPC_AVAILABLE
+    if not CREATE_ORDER_RPC_ENABLED or not CREATE_ORDER_RPC_AVAILABLE or not supabase:
+        return None
+
+    subject_id = data.get('subject_id')
+    try:
+        subject_id = int(subject_id) if subject_id is not None else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный subject_id")
+
+    params = {
+        'p_student_name': student_data['name'],
+        'p_student_group': student_data['group'],
+        'p_telegram': clean_telegram,
+        'p_chat_id': student_chat_id,
+        'p_subject_id': subject_id,
+        'p_title': data['title'],
+        'p_description': data.get('description', ''),
+        'p_input_data': data.get('input_data', ''),
+        'p_variant_info': data.get('variant_info', ''),
+        'p_deadline': data['deadline'],
+        'p_selected_works': json.dumps(data.get('selected_works', [])) if data.get('selected_works') else None,
+        'p_is_full_course': data.get('is_full_course', False),
+        'p_actual_price': data.get('actual_price', 0.0),
+        'p_duplicate_window_seconds': duplicate_window_seconds,
+    }
+
+    try:
+        response = supabase.rpc(CREATE_ORDER_RPC_NAME, params).execute()
+    except Exception as e:
+        err_text = str(e)
+        if 'subject_not_found' in err_text:
+            raise HTTPException(status_code=400, detail=f"Предмет с ID {subject_id} не найден")
+        if 'PGRST202' in err_text or 'could not find the function' in err_text.lower():
+            CREATE_ORDER_RPC_AVAILABLE = False
+            logger.warning(
+                "⚠️ Функция %s не найдена в БД, используем последовательные запросы. "
+                "Выполните deploy/supabase-create-order.sql", CREATE_ORDER_RPC_NAME
+            )
+            return None
+        raise
+
+    row = response.data
+    if isinstance(row, list):
+        row = row[0] if row else None
+    if not row:
+        raise RuntimeError(f"{CREATE_ORDER_RPC_NAME} не вернула заказ")
+
+    is_duplicate = bool(row.pop('is_duplicate', False))
+    created_order = format_order_row(row)
+    if student_chat_id:
+        remember_student_chat_id(created_order['student']['id'], clean_telegram, student_chat_id)
+    return created_order, is_duplicate
+
 @app.post("/api/orders")
 @app.post("/orders")
 async def create_order(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
     
-    print("📥 Получены данные заказа:", json.dumps(data, indent=2, ensure_ascii=False))
-    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📥 Получены данные заказа: %s", json.dumps(data, ensure_ascii=False))
+
+    idempotency_key = get_idempotency_key(request)
+    if not idempotency_key:
+        return await asyncio.to_thread(process_create_order, data, background_tasks, check_duplicates=True)
+
+    # С ключом повтор из WebView получает сохраненный ответ без обращения к orders
+    scope = "POST /api/orders"
+    replay = await claim_idempotency_key(scope, idempotency_key, data)
+    if replay is not None:
+        return replay
+
+    # Создание и запись ответа — одним вызовом в потоке: даже если запрос отменят,
+    # поток доведет заказ до конца и сохранит ответ для повтора
+    return await asyncio.to_thread(process_create_order_idempotent, scope, idempotency_key, data, background_tasks)
+
+def process_create_order_idempotent(scope: str, key: str, data: dict, background_tasks: BackgroundTasks):
+    """Создание заказа под занятым Idempotency-Key: ответ сохраняется, при ошибке ключ освобождается."""
+    try:
+        created_order = process_create_order(data, background_tasks, check_duplicates=False)
+    except BaseException:
+        release_idempotency_key(scope, key)
+        raise
+
+    store_idempotent_response(scope, key, 200, created_order)
+    return created_order
+
+def process_create_order(data: dict, background_tasks: BackgroundTasks, check_duplicates: bool = True):
+    """Создание заказа; check_duplicates включает эвристику повторов без Idempotency-Key."""
     try:
         # Проверяем обязательные поля
         if 'student' not in data:
@@ -1315,15 +3951,32 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
         student_chat_id = normalize_chat_id(student_data.get('chat_id'))
         if not clean_telegram:
             raise HTTPException(status_code=400, detail="Некорректный Telegram. Укажите username в формате @username")
-        print(f"👤 Обработка студента: @{clean_telegram}")
+        logger.debug("👤 Обработка студента: @%s", clean_telegram)
+
+        # Основной путь: одна транзакция в Postgres вместо цепочки запросов
+        rpc_result = create_order_via_rpc(
+            data,
+            student_data,
+            clean_telegram,
+            student_chat_id,
+            CREATE_ORDER_DUPLICATE_WINDOW_SECONDS if check_duplicates else 0
+        )
+        if rpc_result is not None:
+            created_order, is_duplicate = rpc_result
+            if is_duplicate:
+                logger.info("🔁 Найден дубликат заказа за последние 2 минуты. Возвращаем ID: %s", created_order['id'])
+            else:
+                logger.info("📝 Создан заказ ID: %s (rpc)", created_order['id'])
+                enqueue_new_order_notifications(background_tasks, created_order)
+            return created_order
         
         # Проверяем существует ли студент
         existing_student_data = find_student_by_telegram(clean_telegram, fields="id")
-        print(f"🔍 Поиск существующего студента: {existing_student_data}")
+        logger.debug("🔍 Поиск существующего студента: %s", existing_student_data)
         
         if existing_student_data:
             student_id = existing_student_data['id']
-            print(f"👤 Найден существующий студент ID: {student_id}")
+            logger.info("👤 Найден существующий студент ID: %s", student_id)
             # Обновляем данные студента
             student_update_payload = {
                 'name': student_data['name'],
@@ -1333,10 +3986,12 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
             if student_chat_id:
                 student_update_payload['chat_id'] = student_chat_id
             update_result = supabase.table('students').update(student_update_payload).eq('id', student_id).execute()
-            print(f"📝 Обновление данных студента: {update_result}")
+            if student_chat_id:
+                remember_student_chat_id(student_id, clean_telegram, student_chat_id)
+            logger.debug("📝 Обновление данных студента: %s", update_result)
         else:
             # Создаем нового студента
-            print(f"➕ Создаем нового студента: {student_data}")
+            logger.debug("➕ Создаем нового студента: %s", student_data)
             new_student_payload = {
                 'name': student_data['name'],
                 'group_name': student_data['group'],
@@ -1345,9 +4000,10 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
             if student_chat_id:
                 new_student_payload['chat_id'] = student_chat_id
             new_student = supabase.table('students').insert(new_student_payload).execute()
-            print(f"✅ Результат создания студента: {new_student}")
+            logger.debug("✅ Результат создания студента: %s", new_student)
             student_id = new_student.data[0]['id']
-            print(f"👤 Создан новый студент ID: {student_id}")
+            remember_student_chat_id(student_id, clean_telegram, student_chat_id)
+            logger.info("👤 Создан новый студент ID: %s", student_id)
         
         # Проверяем существование предмета или создаем кастомный
         subject_id = data.get('subject_id')
@@ -1361,15 +4017,15 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
                 raise HTTPException(status_code=400, detail=f"Предмет с ID {subject_id} не найден")
             
             subject_name = subject.data[0]['name']
-            print(f"📚 Предмет: {subject_name} (ID: {subject_id})")
+            logger.debug("📚 Предмет: %s (ID: %s)", subject_name, subject_id)
         else:
             # Для кастомных заказов создаем или находим специальный предмет
-            print(f"📚 Кастомный заказ - ищем/создаем специальный предмет")
+            logger.info("📚 Кастомный заказ - ищем/создаем специальный предмет")
             custom_subject = supabase.table('subjects').select('id').eq('name', 'Кастомный предмет').limit(1).execute()
             
             if custom_subject.data and len(custom_subject.data) > 0:
                 subject_id = custom_subject.data[0]['id']
-                print(f"✅ Найден кастомный предмет ID: {subject_id}")
+                logger.info("✅ Найден кастомный предмет ID: %s", subject_id)
             else:
                 # Создаем кастомный предмет
                 new_custom_subject = supabase.table('subjects').insert({
@@ -1378,33 +4034,35 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
                     'price': 0.0
                 }).execute()
                 subject_id = new_custom_subject.data[0]['id']
-                print(f"✅ Создан кастомный предмет ID: {subject_id}")
+                logger.info("✅ Создан кастомный предмет ID: %s", subject_id)
         
         # Подготавливаем данные заказа
         actual_price = data.get('actual_price', 0.0)
         selected_works_json = json.dumps(data.get('selected_works', [])) if data.get('selected_works') else None
         is_full_course = data.get('is_full_course', False)
         
-        print(f"💰 Стоимость заказа: {actual_price} ₽")
+        logger.debug("💰 Стоимость заказа: %s ₽", actual_price)
 
         # Идемпотентность: если аналогичный заказ уже создан недавно, возвращаем его
-        try:
-            window_start_iso = (datetime.utcnow() - timedelta(minutes=2)).isoformat()
-            dup_check = supabase.table('orders').select('id, created_at') \
-                .eq('student_id', student_id) \
-                .eq('subject_id', subject_id) \
-                .eq('title', data['title']) \
-                .eq('deadline', data['deadline']) \
-                .gte('created_at', window_start_iso) \
-                .order('created_at', desc=True) \
-                .limit(1) \
-                .execute()
-            if dup_check.data and len(dup_check.data) > 0:
-                existing_id = dup_check.data[0]['id']
-                print(f"🔁 Найден дубликат заказа за последние 2 минуты. Возвращаем ID: {existing_id}")
-                return get_order(existing_id)
-        except Exception as e:
-            print(f"⚠️ Ошибка проверки идемпотентности: {e}")
+        # (запросы с Idempotency-Key обрабатываются отдельно и эту проверку пропускают)
+        if check_duplicates:
+            try:
+                window_start_iso = (datetime.utcnow() - timedelta(seconds=CREATE_ORDER_DUPLICATE_WINDOW_SECONDS)).isoformat()
+                dup_check = supabase.table('orders').select('id, created_at') \
+                    .eq('student_id', student_id) \
+                    .eq('subject_id', subject_id) \
+                    .eq('title', data['title']) \
+                    .eq('deadline', data['deadline']) \
+                    .gte('created_at', window_start_iso) \
+                    .order('created_at', desc=True) \
+                    .limit(1) \
+                    .execute()
+                if dup_check.data and len(dup_check.data) > 0:
+                    existing_id = dup_check.data[0]['id']
+                    logger.info("🔁 Найден дубликат заказа за последние 2 минуты. Возвращаем ID: %s", existing_id)
+                    return get_order(existing_id)
+            except Exception as e:
+                logger.warning("⚠️ Ошибка проверки идемпотентности: %s", e)
         
         # Создаем заказ
         order_data = {
@@ -1422,58 +4080,28 @@ async def create_order(request: Request, background_tasks: BackgroundTasks):
             'executor_telegram': None,
             'payout_amount': None
         }
-        print(f"📝 Создаем заказ с данными: {order_data}")
+        logger.debug("📝 Создаем заказ с данными: %s", order_data)
         
         new_order = supabase.table('orders').insert(order_data).execute()
-        print(f"✅ Результат создания заказа: {new_order}")
+        logger.debug("✅ Результат создания заказа: %s", new_order)
         
         order_id = new_order.data[0]['id']
-        print(f"📝 Создан заказ ID: {order_id}")
+        logger.info("📝 Создан заказ ID: %s", order_id)
         
         # Получаем созданный заказ с связанными данными
-        print(f"🔍 Получаем созданный заказ...")
+        logger.debug("🔍 Получаем созданный заказ...")
         created_order = get_order(order_id)
-        print(f"📦 Получен заказ: {created_order}")
+        logger.debug("📦 Получен заказ: %s", created_order)
         
-        # Отправляем уведомление администратору о новом заказе
-        try:
-            message = f"""
-🆕 Новый заказ #{order_id}
-
-👤 Студент: {created_order['student']['name']}
-👥 Группа: {created_order['student']['group']}
-📱 Telegram: {created_order['student']['telegram']}
-
-📚 Предмет: {created_order['subject']['name']}
-📝 Название: {created_order['title']}
-📄 Описание: {created_order['description'][:200]}{'...' if len(created_order['description']) > 200 else ''}
-
-⏰ Дедлайн: {created_order['deadline']}
-💰 Стоимость: {actual_price} ₽
-
-Создан: {datetime.now().strftime('%d.%m.%Y %H:%M')}
-            """.strip()
-            
-            if created_order.get('variant_info'):
-                message += f"\n\n🔢 Информация о варианте:\n{created_order['variant_info'][:300]}{'...' if len(created_order['variant_info']) > 300 else ''}"
-            
-            if created_order.get('input_data'):
-                message += f"\n\n📋 Дополнительные требования:\n{created_order['input_data'][:300]}{'...' if len(created_order['input_data']) > 300 else ''}"
-            
-            enqueue_background(background_tasks, send_notification, message)
-
-            # Уведомляем самого пользователя о создании заказа (если доступна доставка)
-            enqueue_background(background_tasks, send_status_notification_to_user, created_order, 'new')
-            
-        except Exception as e:
-            print(f"⚠️ Ошибка отправки уведомления администратору: {e}")
+        # Отправляем уведомления администратору и пользователю о новом заказе
+        enqueue_new_order_notifications(background_tasks, created_order)
 
         return created_order
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка создания заказа: {e}")
+        logger.error("❌ Ошибка создания заказа: %s", e)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка при создании заказа")
 
 @app.patch("/api/orders/{order_id}/status")
@@ -1526,15 +4154,17 @@ async def update_order_status(order_id: int, request: Request, background_tasks:
             raise HTTPException(status_code=404, detail="Заказ не найден")
         raise HTTPException(status_code=500, detail=f"Ошибка обновления статуса: {str(e)}")
 
+def derive_paid_status(old_status: Optional[str]) -> Optional[str]:
+    """Статус после отметки оплаты, в том числе для массовой сверки оплат."""
+    return old_status if old_status in ('completed', 'needs_revision') else 'paid'
+
 @app.patch("/api/orders/{order_id}/paid")
 @app.patch("/orders/{order_id}/paid")
 async def mark_order_as_paid(order_id: int, background_tasks: BackgroundTasks):
     try:
         old_order = get_order(order_id)
 
-        next_status = old_order.get('status')
-        if next_status not in ('completed', 'needs_revision'):
-            next_status = 'paid'
+        next_status = derive_paid_status(old_order.get('status'))
 
         # Обновляем статус оплаты
         response = supabase.table('orders').update({
@@ -1594,10 +4224,161 @@ async def update_order_executor(order_id: int, request: Request):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка обновления исполнителя: {e}")
+        logger.error("❌ Ошибка обновления исполнителя: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка обновления исполнителя: {str(e)}")
 
 
+def build_order_patch(data: dict) -> dict:
+    """Валидирует общие админские поля заказа (цена, статус, оплата, исполнитель)."""
+    patch = {}
+
+    if 'actual_price' in data:
+        try:
+            price_val = float(data.get('actual_price'))
+            if price_val < 0:
+                raise ValueError
+            patch['actual_price'] = price_val
+        except Exception:
+            raise HTTPException(status_code=400, detail="Некорректная стоимость заказа")
+
+    if 'status' in data:
+        new_status = data.get('status')
+        if new_status not in ALLOWED_ORDER_STATUSES:
+            raise HTTPException(status_code=400, detail=f"Недопустимый статус: {new_status}")
+        patch['status'] = new_status
+
+    if 'is_paid' in data:
+        patch['is_paid'] = bool(data.get('is_paid'))
+
+    if 'executor_telegram' in data:
+        executor = data.get('executor_telegram')
+        patch['executor_telegram'] = executor.lstrip('@') if isinstance(executor, str) and executor else None
+
+    if 'payout_amount' in data:
+        try:
+            payout_val = float(data.get('payout_amount')) if data.get('payout_amount') is not None else None
+            if payout_val is not None and payout_val < 0:
+                raise ValueError
+            patch['payout_amount'] = payout_val
+        except Exception:
+            raise HTTPException(status_code=400, detail="Некорректная сумма к выплате")
+
+    if 'payment_method' in data:
+        payment_method = str(data.get('payment_method') or '').strip().lower()
+        if payment_method and payment_method not in PAYMENT_METHODS:
+            raise HTTPException(status_code=400, detail="Некорректный способ оплаты")
+        patch['payment_method'] = payment_method or PAYMENT_METHOD_SBERBANK
+
+    return patch
+
+def notify_order_status_changes(changed_orders: List[dict]):
+    """Одна фоновая задача на пачку заказов: статусы студентам и доска исполнителей."""
+    send_status_notifications_to_users([
+        (order, order.get('status'))
+        for order in changed_orders
+        if order.get('student', {}).get('telegram')
+    ])
+    for order in changed_orders:
+        if order.get('status') in ('paid', 'needs_revision'):
+            notify_executors_board_entry(order)
+
+def apply_orders_bulk_patch(order_ids: List[int], update_payload: dict) -> tuple:
+    """Синхронная часть массового обновления (запросы к Supabase); вызывается в отдельном потоке."""
+    # Старые статусы нужны для перехода в paid и чтобы уведомлять только о реальных изменениях
+    old_rows = supabase.table('orders').select('id, status').in_('id', order_ids).execute()
+    old_statuses = {row['id']: row.get('status') for row in old_rows.data or []}
+
+    # {"is_paid": true} без явного статуса переводит заказ в paid, как одиночная отметка оплаты;
+    # заказы с разным итоговым статусом обновляются отдельными запросами
+    payload_groups: Dict[Optional[str], List[int]] = {}
+    if update_payload.get('is_paid') is True and 'status' not in update_payload:
+        for order_id in order_ids:
+            if order_id in old_statuses:
+                payload_groups.setdefault(derive_paid_status(old_statuses[order_id]), []).append(order_id)
+    else:
+        payload_groups[update_payload.get('status')] = [order_id for order_id in order_ids if order_id in old_statuses]
+
+    updated_ids = []
+    for status, ids in payload_groups.items():
+        if not ids:
+            continue
+        payload = dict(update_payload, status=status) if status else update_payload
+        try:
+            response = supabase.table('orders').update(payload).in_('id', ids).execute()
+        except Exception as e:
+            err_text = str(e).lower()
+            if 'payment_method' in payload and 'payment_method' in err_text and 'column' in err_text:
+                raise HTTPException(
+                    status_code=400,
+                    detail=("В БД отсутствует колонка orders.payment_method. "
+                            "Выполните SQL миграцию: ALTER TABLE orders ADD COLUMN IF NOT EXISTS payment_method TEXT DEFAULT 'sberbank';")
+                )
+            raise
+        updated_ids.extend(row['id'] for row in response.data or [])
+
+    if not updated_ids:
+        return [], [], []
+
+    joined = supabase.table('orders').select(ORDER_JOINED_SELECT).in_('id', updated_ids).order('created_at', desc=True).execute()
+    updated_orders = [format_order_row(row) for row in joined.data or []]
+    changed_orders = [order for order in updated_orders if old_statuses.get(order['id']) != order.get('status')]
+    return updated_ids, updated_orders, changed_orders
+
+@app.patch("/api/orders/bulk")
+@app.patch("/orders/bulk")
+async def update_orders_bulk(request: Request, background_tasks: BackgroundTasks):
+    """Массовое обновление заказов одним запросом к БД (сверка оплат, назначение исполнителей)"""
+    require_admin_token(request)
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Некорректный формат запроса")
+
+        raw_ids = data.get('order_ids')
+        if not isinstance(raw_ids, list) or not raw_ids:
+            raise HTTPException(status_code=400, detail="Не указаны order_ids")
+        try:
+            order_ids = list(dict.fromkeys(int(order_id) for order_id in raw_ids))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Некорректный список order_ids")
+        if len(order_ids) > BULK_ORDERS_MAX_IDS:
+            raise HTTPException(status_code=400, detail=f"Слишком много заказов (максимум {BULK_ORDERS_MAX_IDS})")
+
+        patch = data.get('patch')
+        if not isinstance(patch, dict):
+            raise HTTPException(status_code=400, detail="Не указан patch")
+        unknown_fields = set(patch) - BULK_ORDER_PATCH_FIELDS
+        if unknown_fields:
+            raise HTTPException(status_code=400, detail=f"Недопустимые поля: {', '.join(sorted(unknown_fields))}")
+
+        update_payload = build_order_patch(patch)
+        if not update_payload:
+            raise HTTPException(status_code=400, detail="Нет данных для обновления")
+        update_payload['updated_at'] = datetime.now().isoformat()
+
+        updated_ids, updated_orders, changed_orders = await asyncio.to_thread(
+            apply_orders_bulk_patch, order_ids, update_payload
+        )
+        if not updated_ids:
+            return fast_json({"orders": [], "updated": 0, "missing_ids": order_ids})
+
+        if changed_orders:
+            enqueue_background(background_tasks, notify_order_status_changes, changed_orders)
+
+        updated_id_set = set(updated_ids)
+        logger.info("📦 PATCH /api/orders/bulk fields=%s updated=%s notified=%s", sorted(update_payload), len(updated_ids), len(changed_orders))
+        return fast_json({
+            "orders": updated_orders,
+            "updated": len(updated_ids),
+            "missing_ids": [order_id for order_id in order_ids if order_id not in updated_id_set]
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("❌ Ошибка массового обновления заказов: %s", e)
+        raise HTTPException(status_code=500, detail=f"Ошибка массового обновления: {str(e)}")
+
 @app.patch("/api/orders/{order_id}/admin")
 @app.patch("/orders/{order_id}/admin")
 async def update_order_admin(order_id: int, request: Request, background_tasks: BackgroundTasks):
@@ -1617,13 +4398,13 @@ async def update_order_admin(order_id: int, request: Request, background_tasks:
         except HTTPException:
             raise
         except Exception as e:
-            print(f"❌ Ошибка получения student_id для заказа {order_id}: {e}")
+            logger.error("❌ Ошибка получения student_id для заказа %s: %s", order_id, e)
             raise HTTPException(status_code=500, detail="Не удалось получить данные студента")
 
         # Простые поля
-        for field in ['title', 'description', 'input_data', 'variant_info', 'deadline']:
-            if field in data:
-                update_payload[field] = data[field]
+        for column in ['title', 'description', 'input_data', 'variant_info', 'deadline']:
+            if column in data:
+                update_payload[column] = data[column]
 
         # Обновление имени и группы студента
         if 'student_name' in data:
@@ -1642,46 +4423,8 @@ async def update_order_admin(order_id: int, request: Request, background_tasks:
                 if not subject_exists.data:
                     raise HTTPException(status_code=400, detail="Предмет не найден")
 
-        # Цена
-        if 'actual_price' in data:
-            try:
-                price_val = float(data.get('actual_price'))
-                if price_val < 0:
-                    raise ValueError
-                update_payload['actual_price'] = price_val
-            except Exception:
-                raise HTTPException(status_code=400, detail="Некорректная стоимость заказа")
-
-        # Статус
-        if 'status' in data:
-            new_status = data.get('status')
-            if new_status not in ALLOWED_ORDER_STATUSES:
-                raise HTTPException(status_code=400, detail=f"Недопустимый статус: {new_status}")
-            update_payload['status'] = new_status
-
-        # Оплата
-        if 'is_paid' in data:
-            update_payload['is_paid'] = bool(data.get('is_paid'))
-
-        # Исполнитель и выплата
-        if 'executor_telegram' in data:
-            executor = data.get('executor_telegram')
-            update_payload['executor_telegram'] = executor.lstrip('@') if isinstance(executor, str) and executor else None
-
-        if 'payout_amount' in data:
-            try:
-                payout_val = float(data.get('payout_amount')) if data.get('payout_amount') is not None else None
-                if payout_val is not None and payout_val < 0:
-                    raise ValueError
-                update_payload['payout_amount'] = payout_val
-            except Exception:
-                raise HTTPException(status_code=400, detail="Некорректная сумма к выплате")
-
-        if 'payment_method' in data:
-            payment_method = str(data.get('payment_method') or '').strip().lower()
-            if payment_method and payment_method not in PAYMENT_METHODS:
-                raise HTTPException(status_code=400, detail="Некорректный способ оплаты")
-            update_payload['payment_method'] = payment_method or PAYMENT_METHOD_SBERBANK
+        # Цена, статус, оплата, исполнитель и выплата
+        update_payload.update(build_order_patch(data))
 
         if not update_payload and not student_update:
             raise HTTPException(status_code=400, detail="Нет данных для обновления")
@@ -1715,14 +4458,14 @@ async def update_order_admin(order_id: int, request: Request, background_tasks:
                 if new_status in ('paid', 'needs_revision'):
                     enqueue_background(background_tasks, notify_executors_board_entry, updated_order)
         except Exception as e:
-            print(f"⚠️ Ошибка отправки уведомления о смене статуса: {e}")
+            logger.warning("⚠️ Ошибка отправки уведомления о смене статуса: %s", e)
 
         return updated_order
 
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка админ-обновления заказа: {e}")
+        logger.error("❌ Ошибка админ-обновления заказа: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка админ-обновления: {str(e)}")
 
 @app.patch("/api/orders/{order_id}/price")
@@ -1793,7 +4536,7 @@ async def update_order_price(order_id: int, request: Request, background_tasks:
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка обновления цены заказа: {e}")
+        logger.error("❌ Ошибка обновления цены заказа: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка обновления цены: {str(e)}")
 
 @app.post("/api/orders/{order_id}/files")
@@ -1809,19 +4552,8 @@ async def upload_order_files(
         if not order_check.data:
             raise HTTPException(status_code=404, detail="Заказ не найден")
         
-        # Создаем папку для файлов заказа
-        upload_dir = os.path.join(UPLOADS_DIR, f"order_{order_id}")
-        os.makedirs(upload_dir, exist_ok=True)
-        
         # Уже сохраненные файлы для дополнения
-        existing_files: list[str] = []
-        try:
-            raw_files = order_check.data.get('files')
-            if raw_files:
-                existing_files = json.loads(raw_files) if isinstance(raw_files, str) else list(raw_files)
-        except Exception as e:
-            print(f"⚠️ Не удалось распарсить существующие файлы: {e}")
-            existing_files = []
+        existing_files: list[str] = parse_order_files(order_check.data.get('files'))
         
         # Разрешенные типы файлов (можно расширить по необходимости)
         ALLOWED_EXTENSIONS = {
@@ -1857,11 +4589,12 @@ async def upload_order_files(
             ]
             
             for filename, file_type in files_data:
-                file_path = os.path.join(upload_dir, filename)
+                demo_content = b""
                 
                 if file_type == "demo" and filename.endswith('.docx'):
                     # Создаем демо DOCX файл
-                    with zipfile.ZipFile(file_path, 'w') as docx:
+                    docx_buffer = io.BytesIO()
+                    with zipfile.ZipFile(docx_buffer, 'w') as docx:
                         docx.writestr('[Content_Types].xml', '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
 <Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
 <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
@@ -1880,6 +4613,7 @@ async def upload_order_files(
 <Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
 <Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
 </Relationships>''')
+                    demo_content = docx_buffer.getvalue()
                         
                 elif file_type == "demo" and filename.endswith('.pdf'):
                     # Создаем демо PDF файл
@@ -1901,9 +4635,11 @@ xref 0 6
 trailer<</Size 6/Root 1 0 R>>
 startxref 467
 %%EOF"""
-                    with open(file_path, "w", encoding="utf-8") as f:
-                        f.write(content)
+                    demo_content = content.encode("utf-8")
                 
+                await asyncio.to_thread(
+                    FILE_STORAGE.put, order_file_key(order_id, filename), demo_content, guess_file_media_type(filename)
+                )
                 saved_files.append(filename)
                 
         else:
@@ -1938,26 +4674,28 @@ startxref 467
                 safe_filename = "".join(c for c in file.filename if c.isalnum() or c in (' ', '-', '_', '.')).rstrip()
                 if not safe_filename or safe_filename != file.filename:
                     safe_filename = f"file_{len(saved_files)+1}{file_extension}"
-                    print(f"⚠️ Переименован файл {file.filename} в {safe_filename} для безопасности")
+                    logger.warning("⚠️ Переименован файл %s в %s для безопасности", file.filename, safe_filename)
                 
-                # Сохраняем файл на диск
-                file_path = os.path.join(upload_dir, safe_filename)
-                
-                # Если файл с таким именем уже существует, добавляем номер
+                # Если файл с таким именем уже есть в заказе или хранилище, добавляем номер
                 counter = 1
                 original_safe_filename = safe_filename
-                while os.path.exists(file_path):
+                while (
+                    safe_filename in existing_files
+                    or safe_filename in saved_files
+                    or await asyncio.to_thread(FILE_STORAGE.stat, order_file_key(order_id, safe_filename))
+                ):
                     name, ext = os.path.splitext(original_safe_filename)
                     safe_filename = f"{name}_{counter}{ext}"
-                    file_path = os.path.join(upload_dir, safe_filename)
                     counter += 1
                 
                 try:
-                    with open(file_path, "wb") as buffer:
-                        buffer.write(file_content)
+                    # Запись в S3 — сетевой вызов, не держим им event loop
+                    await asyncio.to_thread(
+                        FILE_STORAGE.put, order_file_key(order_id, safe_filename), file_content, guess_file_media_type(safe_filename)
+                    )
                     
                     saved_files.append(safe_filename)
-                    print(f"💾 Сохранен файл: {safe_filename} ({file_size / 1024 / 1024:.1f}MB) для заказа {order_id}")
+                    logger.info("💾 Сохранен файл: %s (%.1fMB) для заказа %s", safe_filename, file_size / 1024 / 1024, order_id)
                     
                 except Exception as save_error:
                     rejected_files.append({
@@ -1966,15 +4704,17 @@ startxref 467
                     })
                     continue
         
-        # Обновляем информацию о файлах в базе данных (добавляем к существующим)
-        all_files = existing_files + saved_files
-        supabase.table('orders').update({
-            'files': json.dumps(all_files),
-            'status': 'completed',
-            'updated_at': datetime.now().isoformat()
-        }).eq('id', order_id).execute()
+        # Обновляем информацию о файлах в базе данных (добавляем к существующим).
+        # Статус completed выставит проверка файлов, когда вся партия ее пройдет.
+        # Дописываем к текущему значению в БД, а не к прочитанному в начале запроса:
+        # параллельная загрузка или проверка файлов могла его изменить
+        await asyncio.to_thread(update_order_files, order_id, saved_files)
         
-        print(f"📎 Файлы добавлены к заказу {order_id}: {saved_files}")
+        logger.info("📎 Файлы добавлены к заказу %s: %s", order_id, saved_files)
+        
+        # Проверка, превью и уведомление студента — в фоне: ответ на загрузку их не ждет
+        if saved_files:
+            queue_files_validation(order_id, saved_files, background_tasks)
         
         # Получаем обновленный заказ
         updated_order = get_order(order_id)
@@ -1983,13 +4723,10 @@ startxref 467
         updated_order['upload_results'] = {
             "saved_files": len(saved_files),
             "rejected_files": len(rejected_files),
-            "rejected_details": rejected_files
+            "rejected_details": rejected_files,
+            "validation": "pending" if saved_files else None
         }
         
-        # Отправляем уведомление пользователю только если есть сохраненные файлы
-        if saved_files:
-            enqueue_background(background_tasks, send_status_notification_to_user, updated_order, 'completed')
-        
         return updated_order
         
     except HTTPException:
@@ -2039,7 +4776,7 @@ async def download_file(order_id: int, filename: str):
     """Скачивание файла по заказу"""
     try:
         # Проверяем существование заказа и файлов
-        order = supabase.table('orders').select('files').eq('id', order_id).single().execute()
+        order = await asyncio.to_thread(supabase.table('orders').select('files').eq('id', order_id).single().execute)
         
         if not order.data:
             raise HTTPException(status_code=404, detail="Заказ не найден")
@@ -2048,59 +4785,35 @@ async def download_file(order_id: int, filename: str):
         if not files_json:
             raise HTTPException(status_code=404, detail="Файлы не найдены")
         
-        try:
-            files = json.loads(files_json) if isinstance(files_json, str) else files_json
-        except:
-            files = []
+        files = parse_order_files(files_json)
         
         if filename not in files:
             raise HTTPException(status_code=404, detail="Файл не найден")
         
-        # Путь к файлу
-        file_path = os.path.join(UPLOADS_DIR, f"order_{order_id}", filename)
-        
-        # Проверяем что файл существует
-        if not os.path.exists(file_path):
+        # Проверяем что файл есть в хранилище
+        file_key = order_file_key(order_id, filename)
+        stored = await asyncio.to_thread(FILE_STORAGE.stat, file_key)
+        if not stored:
             raise HTTPException(status_code=404, detail=f"Файл {filename} не найден на сервере")
         
-        # Определяем правильный media-type
-        if filename.endswith('.docx'):
-            media_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        elif filename.endswith('.pdf'):
-            media_type = 'application/pdf'
-        elif filename.endswith('.txt'):
-            media_type = 'text/plain; charset=utf-8'
-        elif filename.endswith('.zip'):
-            media_type = 'application/zip'
-        elif filename.endswith('.rar'):
-            media_type = 'application/x-rar-compressed'
-        elif filename.endswith('.7z'):
-            media_type = 'application/x-7z-compressed'
-        elif filename.endswith('.doc'):
-            media_type = 'application/msword'
-        elif filename.endswith('.xls'):
-            media_type = 'application/vnd.ms-excel'
-        elif filename.endswith('.xlsx'):
-            media_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        elif filename.endswith('.ppt'):
-            media_type = 'application/vnd.ms-powerpoint'
-        elif filename.endswith('.pptx'):
-            media_type = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-        elif filename.endswith('.png'):
-            media_type = 'image/png'
-        elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
-            media_type = 'image/jpeg'
-        elif filename.endswith('.gif'):
-            media_type = 'image/gif'
-        elif filename.endswith('.svg'):
-            media_type = 'image/svg+xml'
-        else:
-            media_type = 'application/octet-stream'
+        media_type = guess_file_media_type(filename)
+        local_path = FILE_STORAGE.local_path(file_key)
+        if local_path:
+            return FileResponse(
+                path=local_path,
+                filename=filename,
+                media_type=media_type
+            )
         
-        return FileResponse(
-            path=file_path,
-            filename=filename,
-            media_type=media_type
+        # Удаленное хранилище: проксируем поток, не загружая файл в память целиком
+        # (синхронный итератор Starlette читает в threadpool)
+        return StreamingResponse(
+            iter_stored_file(file_key),
+            media_type=media_type,
+            headers={
+                "Content-Length": str(stored.size),
+                "Content-Disposition": build_content_disposition(filename),
+            }
         )
         
     except HTTPException:
@@ -2108,15 +4821,100 @@ async def download_file(order_id: int, filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка скачивания файла: {str(e)}")
 
+@app.get("/api/orders/{order_id}/preview/{filename}")
+@app.get("/orders/{order_id}/preview/{filename}")
+async def get_file_preview(order_id: int, filename: str, size: str = "thumb"):
+    """Превью файла (JPEG): миниатюра (size=thumb) или первая страница/кадр (size=preview)"""
+    if size not in PREVIEW_SIZES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный размер превью: {size}")
+    
+    key = preview_key(order_id, filename, size)
+    local_path = FILE_STORAGE.local_path(key)
+    if local_path and os.path.exists(local_path):
+        return FileResponse(path=local_path, media_type="image/jpeg", headers={"Cache-Control": PREVIEW_CACHE_CONTROL})
+    if not local_path:
+        try:
+            content = await asyncio.to_thread(read_stored_file, key)
+            return Response(content=content, media_type="image/jpeg", headers={"Cache-Control": PREVIEW_CACHE_CONTROL})
+        except FileNotFoundError:
+            pass
+    
+    # Превью еще нет: проверяем, что файл принадлежит заказу, и ставим в очередь (догоняет старые загрузки)
+    not_ready_headers = {"Cache-Control": "no-store"}
+    try:
+        order = supabase.table('orders').select('files').eq('id', order_id).single().execute()
+    except Exception:
+        order = None
+    if not order or not order.data or filename not in parse_order_files(order.data.get('files')):
+        raise HTTPException(status_code=404, detail="Файл не найден", headers=not_ready_headers)
+    if not PREVIEW_ENABLED or not preview_supported(filename) or preview_failed(order_id, filename):
+        raise HTTPException(status_code=404, detail="Превью для этого файла недоступно", headers=not_ready_headers)
+    # Очередь переполнена — не ошибка: задача встанет при следующем запросе клиента
+    queue_file_preview(order_id, filename)
+    # 202, а не 404: клиент повторит запрос позже и не спрячет миниатюру навсегда
+    return JSONResponse(
+        status_code=202,
+        content={"detail": "Превью готовится"},
+        headers={**not_ready_headers, "Retry-After": "2"},
+    )
+
+@app.get("/api/orders/{order_id}/download-url/{filename}")
+@app.get("/orders/{order_id}/download-url/{filename}")
+async def get_file_download_url(order_id: int, filename: str):
+    """Ссылка для скачивания: presigned URL хранилища (клиент качает напрямую) или адрес backend"""
+    try:
+        order = supabase.table('orders').select('files').eq('id', order_id).single().execute()
+        if not order.data:
+            raise HTTPException(status_code=404, detail="Заказ не найден")
+        
+        if filename not in parse_order_files(order.data.get('files')):
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        
+        presigned_url = FILE_STORAGE.presigned_url(order_file_key(order_id, filename), filename)
+        if presigned_url:
+            return {"url": presigned_url, "presigned": True, "expires_in": S3_PRESIGNED_URL_TTL_SECONDS}
+        return {
+            "url": f"/api/orders/{order_id}/download/{urllib.parse.quote(filename)}",
+            "presigned": False,
+            "expires_in": None,
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка получения ссылки на файл: {str(e)}")
+
 # Utility функция для безопасного удаления временных файлов
 def safe_cleanup_file(filepath: str):
     """Безопасное удаление временного файла"""
     try:
         if os.path.exists(filepath):
             os.unlink(filepath)
-            print(f"🗑️ Временный файл удален: {filepath}")
+            logger.info("🗑️ Временный файл удален: %s", filepath)
     except Exception as e:
-        print(f"⚠️ Не удалось удалить временный файл {filepath}: {e}")
+        logger.warning("⚠️ Не удалось удалить временный файл %s: %s", filepath, e)
+
+def build_order_archive(order_id: int, files: List[str]) -> str:
+    """Собирает файлы заказа во временный zip и возвращает путь к нему"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as temp_zip:
+        try:
+            with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for filename in files:
+                    try:
+                        chunks = iter_stored_file(order_file_key(order_id, filename))
+                        first_chunk = next(chunks, b"")
+                    except FileNotFoundError:
+                        logger.warning("⚠️ Файл не найден: %s", filename)
+                        continue
+                    with zip_file.open(filename, 'w') as archived:
+                        archived.write(first_chunk)
+                        for chunk in chunks:
+                            archived.write(chunk)
+                    logger.debug("📦 Добавлен в архив: %s", filename)
+        except Exception:
+            safe_cleanup_file(temp_zip.name)
+            raise
+    return temp_zip.name
 
 @app.get("/api/orders/{order_id}/download-all")
 @app.get("/orders/{order_id}/download-all")
@@ -2124,7 +4922,7 @@ async def download_all_files(order_id: int, background_tasks: BackgroundTasks):
     """Скачивание всех файлов заказа в zip архиве"""
     try:
         # Проверяем существование заказа и файлов
-        order = supabase.table('orders').select('files, title').eq('id', order_id).single().execute()
+        order = await asyncio.to_thread(supabase.table('orders').select('files, title').eq('id', order_id).single().execute)
         
         if not order.data:
             raise HTTPException(status_code=404, detail="Заказ не найден")
@@ -2135,38 +4933,27 @@ async def download_all_files(order_id: int, background_tasks: BackgroundTasks):
         if not files_json:
             raise HTTPException(status_code=404, detail="Файлы не найдены")
         
-        try:
-            files = json.loads(files_json) if isinstance(files_json, str) else files_json
-        except:
-            files = []
+        files = parse_order_files(files_json)
         
         if not files:
             raise HTTPException(status_code=404, detail="Нет файлов для скачивания")
         
-        # Создаем временный zip файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as temp_zip:
-            with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for filename in files:
-                    file_path = os.path.join(UPLOADS_DIR, f"order_{order_id}", filename)
-                    if os.path.exists(file_path):
-                        zip_file.write(file_path, filename)
-                        print(f"📦 Добавлен в архив: {filename}")
-                    else:
-                        print(f"⚠️ Файл не найден: {filename}")
-            
-            # Генерируем имя для zip файла
-            safe_title = "".join(c for c in order_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            zip_filename = f"Заказ_{order_id}_{safe_title[:30]}.zip"
-            
-            # Добавляем задачу на очистку временного файла
-            background_tasks.add_task(safe_cleanup_file, temp_zip.name)
-            
-            return FileResponse(
-                path=temp_zip.name,
-                filename=zip_filename,
-                media_type='application/zip'
-            )
-            
+        # Создаем временный zip файл: чтение из хранилища и сжатие — в потоке, не в event loop
+        zip_path = await asyncio.to_thread(build_order_archive, order_id, files)
+        
+        # Генерируем имя для zip файла
+        safe_title = "".join(c for c in order_title if c.isalnum() or c in (' ', '-', '_')).rstrip()
+        zip_filename = f"Заказ_{order_id}_{safe_title[:30]}.zip"
+        
+        # Добавляем задачу на очистку временного файла
+        background_tasks.add_task(safe_cleanup_file, zip_path)
+        
+        return FileResponse(
+            path=zip_path,
+            filename=zip_filename,
+            media_type='application/zip'
+        )
+        
     except HTTPException:
         raise
     except Exception as e:
@@ -2204,19 +4991,18 @@ async def notify_payment(order_id: int, background_tasks: BackgroundTasks):
         message += f"\n\n⚠️ Проверьте поступление средств и обновите статус заказа!"
         message += f"\n\nУведомление: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
         
-        enqueue_background(background_tasks, send_notification, message)
-        print(f"💰 Отправлено уведомление об оплате заказа #{order_id}")
+        enqueue_background(background_tasks, send_notification, message, lane=NOTIFICATION_LANE_PAYMENT)
+        logger.info("💰 Отправлено уведомление об оплате заказа #%s", order_id)
         
         # Отправляем уведомление пользователю о получении заявки на оплату
         try:
             user_telegram = order['student']['telegram']
-            
-            # Получаем chat_id пользователя из БД
-            student_response = supabase.table('students').select('chat_id').eq('telegram', user_telegram).limit(1).execute()
-            
-            if student_response.data and student_response.data[0].get('chat_id'):
-                user_chat_id = student_response.data[0]['chat_id']
-                
+
+            # Получаем chat_id пользователя (из кэша или одним запросом к БД)
+            user_chat_id = resolve_chat_id(order['student'])
+
+            if user_chat_id:
+
                 notification_text = f"""
 💳 <b>Заявка на оплату получена</b>
 
@@ -2240,21 +5026,22 @@ async def notify_payment(order_id: int, background_tasks: BackgroundTasks):
                 queue_telegram_notification(
                     "sendMessage",
                     payload,
-                    f"заявка на оплату для @{user_telegram}"
+                    f"заявка на оплату для @{user_telegram}",
+                    lane=NOTIFICATION_LANE_PAYMENT
                 )
-                print(f"✅ Уведомление о заявке на оплату поставлено в очередь для @{user_telegram}")
+                logger.info("✅ Уведомление о заявке на оплату поставлено в очередь для @%s", user_telegram)
             else:
-                print(f"⚠️ Chat ID не найден для пользователя @{user_telegram}, уведомление пользователю пропущено")
+                logger.warning("⚠️ Chat ID не найден для пользователя @%s, уведомление пользователю пропущено", user_telegram)
                 
         except Exception as e:
-            print(f"❌ Ошибка отправки уведомления пользователю: {e}")
+            logger.error("❌ Ошибка отправки уведомления пользователю: %s", e)
         
         return {"status": "notification_sent", "order_id": order_id}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка отправки уведомления об оплате: {e}")
+        logger.error("❌ Ошибка отправки уведомления об оплате: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка отправки уведомления: {str(e)}")
 
 @app.post("/api/orders/{order_id}/request-revision")
@@ -2301,7 +5088,7 @@ async def request_order_revision(order_id: int, request: Request, background_tas
         message += f"\n\nЗапрос отправлен: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
         
         enqueue_background(background_tasks, send_notification, message)
-        print(f"🔄 Отправлено уведомление о запросе исправлений для заказа #{order_id}")
+        logger.info("🔄 Отправлено уведомление о запросе исправлений для заказа #%s", order_id)
         
         # Отправляем уведомление пользователю о необходимости исправлений
         updated_order = get_order(order_id)
@@ -2314,7 +5101,7 @@ async def request_order_revision(order_id: int, request: Request, background_tas
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка отправки уведомления о исправлениях: {e}")
+        logger.error("❌ Ошибка отправки уведомления о исправлениях: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка запроса исправлений: {str(e)}")
 
 @app.post("/api/test-notification")
@@ -2333,7 +5120,7 @@ async def test_notification():
         send_notification(message)
         return {"status": "success", "message": "Тестовое уведомление отправлено"}
     except Exception as e:
-        print(f"❌ Тест не прошел: {e}")
+        logger.error("❌ Тест не прошел: %s", e)
         return {"status": "error", "message": str(e)}
 
 if __name__ == "__main__":
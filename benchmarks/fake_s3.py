@@ -0,0 +1,182 @@
+"""
+Локальная замена S3 (MinIO-подобная) для проверки STORAGE_BACKEND=s3 и бенчмарков.
+
+Path-style адреса /<bucket>/<key>: PUT, GET (в том числе по presigned URL),
+HEAD и DELETE объекта. Подписи не проверяются, бакеты создаются при первой
+записи. Объекты хранятся в памяти. Отдельный запуск:
+
+    python benchmarks/fake_s3.py --port 9000
+
+Backend направляется сюда так:
+
+    STORAGE_BACKEND=s3 S3_ENDPOINT_URL=http://127.0.0.1:9000 S3_BUCKET=orders \
+    S3_ACCESS_KEY_ID=bench S3_SECRET_ACCESS_KEY=bench
+"""
+
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+
+class FakeS3Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (bucket, key) -> (тело, content-type, время изменения)
+        self.objects: Dict[Tuple[str, str], Tuple[bytes, str, float]] = {}
+        self.requests_by_method: Dict[str, int] = {}
+
+    def record(self, method: str):
+        with self.lock:
+            self.requests_by_method[method] = self.requests_by_method.get(method, 0) + 1
+
+    def put(self, bucket: str, key: str, body: bytes, content_type: str):
+        with self.lock:
+            self.objects[(bucket, key)] = (body, content_type, time.time())
+
+    def get(self, bucket: str, key: str) -> Optional[Tuple[bytes, str, float]]:
+        with self.lock:
+            return self.objects.get((bucket, key))
+
+    def delete(self, bucket: str, key: str):
+        with self.lock:
+            self.objects.pop((bucket, key), None)
+
+
+def decode_aws_chunked(raw: bytes) -> bytes:
+    """Тело с Content-Encoding: aws-chunked: <hex-размер>[;chunk-signature=...]\\r\\n<данные>\\r\\n ... 0\\r\\n<трейлеры>"""
+    body = bytearray()
+    position = 0
+    while position < len(raw):
+        line_end = raw.index(b"\r\n", position)
+        size = int(raw[position:line_end].split(b";", 1)[0], 16)
+        if size == 0:
+            break
+        start = line_end + 2
+        body += raw[start:start + size]
+        position = start + size + 2
+    return bytes(body)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeS3/1.0"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_error_xml(self, status: int, code: str, head: bool = False):
+        payload = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(0 if head else len(payload)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(payload)
+
+    def parse_target(self) -> Tuple[str, str, dict]:
+        parts = urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip("/").partition("/")
+        return unquote(bucket), unquote(key), dict(parse_qsl(parts.query))
+
+    def read_body(self) -> bytes:
+        if "chunked" in (self.headers.get("Transfer-Encoding") or "").lower():
+            raw = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";", 1)[0], 16)
+                if size == 0:
+                    # Трейлеры до пустой строки
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                raw += self.rfile.read(size)
+                self.rfile.readline()
+            raw = bytes(raw)
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+        if "aws-chunked" in (self.headers.get("Content-Encoding") or "") or \
+                (self.headers.get("x-amz-content-sha256") or "").startswith("STREAMING-"):
+            return decode_aws_chunked(raw)
+        return raw
+
+    def do_PUT(self):
+        self.server.store.record("PUT")
+        bucket, key, _ = self.parse_target()
+        body = self.read_body()
+        if not key:
+            # CreateBucket — бакеты и так создаются при первой записи
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.server.store.put(bucket, key, body, self.headers.get("Content-Type") or "binary/octet-stream")
+        self.send_response(200)
+        self.send_header("ETag", f'"{hashlib.md5(body).hexdigest()}"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_object(self, head: bool):
+        self.server.store.record("HEAD" if head else "GET")
+        bucket, key, query = self.parse_target()
+        stored = self.server.store.get(bucket, key)
+        if stored is None:
+            self.send_error_xml(404, "NoSuchKey", head=head)
+            return
+        body, content_type, modified_at = stored
+        self.send_response(200)
+        self.send_header("Content-Type", query.get("response-content-type") or content_type)
+        if query.get("response-content-disposition"):
+            self.send_header("Content-Disposition", query["response-content-disposition"])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{hashlib.md5(body).hexdigest()}"')
+        self.send_header("Last-Modified", formatdate(modified_at, usegmt=True))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_object(head=False)
+
+    def do_HEAD(self):
+        self.send_object(head=True)
+
+    def do_DELETE(self):
+        self.server.store.record("DELETE")
+        bucket, key, _ = self.parse_target()
+        self.server.store.delete(bucket, key)
+        self.send_response(204)
+        self.end_headers()
+
+
+class FakeS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store: Optional[FakeS3Store] = None):
+        super().__init__(address, FakeS3Handler)
+        self.store = store or FakeS3Store()
+
+
+def start_fake_s3(host: str = "127.0.0.1", port: int = 0,
+                  store: Optional[FakeS3Store] = None) -> Tuple[FakeS3Server, str]:
+    """Запускает сервер в фоновом потоке и возвращает (server, S3_ENDPOINT_URL)."""
+    server = FakeS3Server((host, port), store)
+    threading.Thread(target=server.serve_forever, name="fake-s3", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Локальное S3-совместимое хранилище в памяти")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+
+    fake_server = FakeS3Server((args.host, args.port))
+    print(f"S3_ENDPOINT_URL=http://{args.host}:{args.port}")
+    fake_server.serve_forever()
@@ -0,0 +1,549 @@
+"""
+In-memory замена Supabase REST (PostgREST) для бенчмарков backend.
+
+Сервер понимает ровно то подмножество протокола, которое использует
+backend/main.py через supabase-py: select со встраиванием связей
+(alias:table!inner(...)), фильтры eq/neq/gt/gte/lt/lte/like/ilike/in/is и or=(...),
+order/limit/offset, Prefer: count=exact и return=representation, HEAD-запросы,
+single() (Accept: application/vnd.pgrst.object+json), insert/update и RPC
+create_order_atomic и save_chat_ids_bulk. Данные живут в памяти процесса.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+# Внешние ключи для встраивания связей: (таблица, связанная таблица) -> колонка
+FOREIGN_KEYS = {
+    ("orders", "students"): "student_id",
+    ("orders", "subjects"): "subject_id",
+}
+
+TABLE_DEFAULTS = {
+    "students": {"chat_id": None},
+    "subjects": {"description": "", "price": 0.0},
+    "orders": {
+        "description": "",
+        "input_data": "",
+        "variant_info": "",
+        "selected_works": None,
+        "is_full_course": False,
+        "actual_price": 0.0,
+        "status": "new",
+        "is_paid": False,
+        "files": None,
+        "executor_telegram": None,
+        "payout_amount": None,
+        "payment_method": None,
+    },
+}
+
+SINGLE_OBJECT_MEDIA_TYPE = "application/vnd.pgrst.object+json"
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "or", "columns", "on_conflict"}
+ORDER_STATUSES = ["new", "waiting_payment", "in_progress", "completed", "needs_revision"]
+
+
+class PostgrestError(Exception):
+    def __init__(self, status: int, code: str, message: str, details: Optional[str] = None):
+        super().__init__(message)
+        self.status = status
+        self.body = {"code": code, "message": message, "details": details, "hint": None}
+
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def split_top_level(text: str, separator: str = ",") -> List[str]:
+    """Делит строку по разделителю вне скобок и кавычек."""
+    parts, depth, quoted, current = [], 0, False, []
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        if char == separator and depth == 0 and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    if current:
+        parts.append("".join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+
+def parse_select(select: str) -> List[tuple]:
+    """Разбирает select в список ("*",), ("column", alias, name) и ("embed", alias, table, inner, items)."""
+    items = []
+    for token in split_top_level(select or "*"):
+        if token == "*":
+            items.append(("*",))
+            continue
+        alias, _, rest = token.partition(":") if ":" in token.split("(")[0] else ("", "", token)
+        if "(" in rest:
+            head, _, inner_select = rest.partition("(")
+            table, _, hint = head.partition("!")
+            items.append(("embed", alias or table, table, hint == "inner", parse_select(inner_select[:-1])))
+        else:
+            items.append(("column", alias or rest, rest))
+    return items
+
+
+def as_text(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def parse_list(raw: str) -> List[str]:
+    inner = raw[1:-1] if raw.startswith("(") and raw.endswith(")") else raw
+    return [part[1:-1] if part.startswith('"') and part.endswith('"') else part for part in split_top_level(inner)]
+
+
+def compare(value: Any, argument: str) -> int:
+    if value is None:
+        return -1
+    try:
+        left, right = float(value), float(argument)
+    except (TypeError, ValueError):
+        left, right = as_text(value), argument
+    return (left > right) - (left < right)
+
+
+def like_to_regex(pattern: str, flags: int = 0):
+    escaped = re.escape(pattern).replace(r"\*", ".*").replace("%", ".*").replace("_", ".")
+    return re.compile(f"^{escaped}$", flags | re.DOTALL)
+
+
+def matches(row: dict, column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    operator, _, argument = expression.partition(".")
+    value = row.get(column)
+
+    if operator == "eq":
+        result = as_text(value) == argument
+    elif operator == "neq":
+        result = as_text(value) != argument
+    elif operator in ("gt", "gte", "lt", "lte"):
+        if value is None:
+            result = False
+        else:
+            order = compare(value, argument)
+            result = {"gt": order > 0, "gte": order >= 0, "lt": order < 0, "lte": order <= 0}[operator]
+    elif operator == "like":
+        result = value is not None and bool(like_to_regex(argument).match(as_text(value)))
+    elif operator == "ilike":
+        result = value is not None and bool(like_to_regex(argument, re.IGNORECASE).match(as_text(value)))
+    elif operator == "in":
+        result = as_text(value) in set(parse_list(argument))
+    elif operator == "is":
+        result = as_text(value) == argument.lower()
+    else:
+        raise PostgrestError(400, "PGRST100", f"unsupported operator: {operator}")
+    return not result if negate else result
+
+
+def matches_or(row: dict, expression: str) -> bool:
+    for condition in parse_list(expression):
+        column, _, rest = condition.partition(".")
+        if matches(row, column, rest):
+            return True
+    return False
+
+
+class FakeSupabaseStore:
+    """Таблицы students, subjects и orders в памяти плюс счетчики запросов."""
+
+    def __init__(self, rpc_enabled: bool = True):
+        self.tables: Dict[str, Dict[int, dict]] = {"students": {}, "subjects": {}, "orders": {}}
+        self.next_ids: Dict[str, int] = {name: 1 for name in self.tables}
+        self.rpc_enabled = rpc_enabled
+        self.lock = threading.RLock()
+        self.request_count = 0
+        self.requests_by_route: Dict[str, int] = {}
+
+    def insert_row(self, table: str, values: dict) -> dict:
+        row = dict(TABLE_DEFAULTS.get(table, {}))
+        row.update(values)
+        if row.get("id") is None:
+            row["id"] = self.next_ids[table]
+        self.next_ids[table] = max(self.next_ids[table], int(row["id"]) + 1)
+        row.setdefault("created_at", utc_now_iso())
+        self.tables[table][int(row["id"])] = row
+        return row
+
+    def seed(self, students: int = 500, subjects: int = 20, orders: int = 5000, seed: int = 1):
+        """Детерминированные данные: одинаковые при каждом запуске с тем же seed."""
+        rng = random.Random(seed)
+        base_time = datetime.now(timezone.utc) - timedelta(days=90)
+        with self.lock:
+            for index in range(1, subjects + 1):
+                self.insert_row("subjects", {
+                    "name": f"Предмет {index}",
+                    "description": f"Описание предмета {index}",
+                    "price": float(rng.choice([500, 1000, 1500, 2500])),
+                })
+            for index in range(1, students + 1):
+                self.insert_row("students", {
+                    "name": f"Студент {index}",
+                    "group_name": f"ГР-{index % 40:02d}",
+                    "telegram": f"bench_user_{index}",
+                    "chat_id": str(100000 + index),
+                })
+            for index in range(1, orders + 1):
+                self.insert_row("orders", {
+                    "student_id": rng.randint(1, students),
+                    "subject_id": rng.randint(1, subjects),
+                    "title": f"Работа {index}",
+                    "description": "Сгенерировано для бенчмарка " * rng.randint(1, 8),
+                    "deadline": (base_time + timedelta(days=rng.randint(30, 120))).date().isoformat(),
+                    "status": rng.choice(ORDER_STATUSES),
+                    "actual_price": float(rng.choice([500, 1000, 1500])),
+                    "is_paid": rng.random() < 0.5,
+                    "created_at": (base_time + timedelta(minutes=index)).isoformat(),
+                })
+
+    # ---- Выполнение запросов ----
+
+    def project(self, table: str, row: dict, items: List[tuple]) -> Optional[dict]:
+        result = {}
+        for item in items:
+            if item[0] == "*":
+                result.update(row)
+            elif item[0] == "column":
+                result[item[1]] = row.get(item[2])
+            else:
+                _, alias, target, inner, sub_items = item
+                foreign_key = FOREIGN_KEYS.get((table, target))
+                if foreign_key is None:
+                    raise PostgrestError(400, "PGRST200", f"Could not find a relationship between '{table}' and '{target}'")
+                related = self.tables[target].get(row.get(foreign_key))
+                if related is None:
+                    if inner:
+                        return None
+                    result[alias] = None
+                else:
+                    result[alias] = self.project(target, related, sub_items)
+        return result
+
+    def filter_rows(self, table: str, params: List[Tuple[str, str]]) -> List[dict]:
+        rows = self.tables[table]
+        filters = [(key, value) for key, value in params if key not in RESERVED_PARAMS]
+        or_filters = [value for key, value in params if key == "or"]
+
+        # Быстрый путь для id=eq.N — самый частый запрос backend — и id=in.(...) массовых операций
+        id_filter = next((value for key, value in filters if key == "id" and value.startswith("eq.")), None)
+        id_list_filter = next((value for key, value in filters if key == "id" and value.startswith("in.")), None)
+        if id_filter:
+            candidates = [rows[int(id_filter[3:])]] if id_filter[3:].isdigit() and int(id_filter[3:]) in rows else []
+        elif id_list_filter:
+            ids = {int(item) for item in parse_list(id_list_filter[3:]) if item.isdigit()}
+            candidates = [rows[row_id] for row_id in sorted(ids) if row_id in rows]
+        else:
+            candidates = list(rows.values())
+
+        return [
+            row for row in candidates
+            if all(matches(row, key, value) for key, value in filters)
+            and all(matches_or(row, value) for value in or_filters)
+        ]
+
+    @staticmethod
+    def sort_rows(rows: List[dict], order: Optional[str]) -> List[dict]:
+        for clause in reversed(split_top_level(order or "")):
+            column, _, direction = clause.partition(".")
+            descending = direction.startswith("desc")
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column) if row.get(column) is not None else 0),
+                      reverse=descending)
+        return rows
+
+    def has_inner_relations(self, table: str, row: dict, items: List[tuple]) -> bool:
+        for item in items:
+            if item[0] == "embed" and item[3]:
+                related = self.tables[item[2]].get(row.get(FOREIGN_KEYS.get((table, item[2]))))
+                if related is None or not self.has_inner_relations(item[2], related, item[4]):
+                    return False
+        return True
+
+    def select(self, table: str, params: List[Tuple[str, str]]) -> Tuple[List[dict], int]:
+        param_map = dict(params)
+        items = parse_select(param_map.get("select", "*"))
+        rows = self.sort_rows(self.filter_rows(table, params), param_map.get("order"))
+        # !inner отбрасывает строки до пагинации, а проекция нужна только для страницы
+        rows = [row for row in rows if self.has_inner_relations(table, row, items)]
+        offset = int(param_map.get("offset", 0) or 0)
+        limit = param_map.get("limit")
+        end = offset + int(limit) if limit is not None else None
+        return [self.project(table, row, items) for row in rows[offset:end]], len(rows)
+
+    def insert(self, table: str, payload: Any) -> List[dict]:
+        rows = payload if isinstance(payload, list) else [payload]
+        return [self.insert_row(table, dict(values)) for values in rows]
+
+    def update(self, table: str, params: List[Tuple[str, str]], payload: dict) -> List[dict]:
+        rows = self.filter_rows(table, params)
+        for row in rows:
+            row.update(payload)
+        return rows
+
+    def create_order_atomic(self, params: dict) -> dict:
+        """Повторяет deploy/supabase-create-order.sql."""
+        if not self.rpc_enabled:
+            raise PostgrestError(404, "PGRST202", "Could not find the function public.create_order_atomic in the schema cache")
+
+        telegram = params["p_telegram"]
+        students = self.tables["students"]
+        student = next((row for row in students.values() if row.get("telegram") == telegram), None) or \
+            next((row for row in students.values() if as_text(row.get("telegram")).lower() == telegram.lower()), None)
+        if student:
+            student.update({"name": params["p_student_name"], "group_name": params["p_student_group"], "telegram": telegram})
+            if params.get("p_chat_id"):
+                student["chat_id"] = params["p_chat_id"]
+        else:
+            student = self.insert_row("students", {
+                "name": params["p_student_name"],
+                "group_name": params["p_student_group"],
+                "telegram": telegram,
+                "chat_id": params.get("p_chat_id"),
+            })
+
+        subject_id = params.get("p_subject_id")
+        if subject_id is not None:
+            subject = self.tables["subjects"].get(int(subject_id))
+            if subject is None:
+                raise PostgrestError(400, "P0002", "subject_not_found", str(subject_id))
+        else:
+            subject = next((row for row in self.tables["subjects"].values() if row.get("name") == "Кастомный предмет"), None) or \
+                self.insert_row("subjects", {"name": "Кастомный предмет", "description": "Предмет для кастомных заказов", "price": 0.0})
+
+        order = None
+        window = int(params.get("p_duplicate_window_seconds") or 0)
+        if window > 0:
+            window_start = (datetime.now(timezone.utc) - timedelta(seconds=window)).isoformat()
+            duplicates = [
+                row for row in self.tables["orders"].values()
+                if row["student_id"] == student["id"] and row["subject_id"] == subject["id"]
+                and row["title"] == params["p_title"] and row["deadline"] == params["p_deadline"]
+                and row["created_at"] >= window_start
+            ]
+            order = max(duplicates, key=lambda row: row["created_at"]) if duplicates else None
+
+        is_duplicate = order is not None
+        if order is None:
+            selected_works = params.get("p_selected_works")
+            order = self.insert_row("orders", {
+                "student_id": student["id"],
+                "subject_id": subject["id"],
+                "title": params["p_title"],
+                "description": params.get("p_description") or "",
+                "input_data": params.get("p_input_data") or "",
+                "variant_info": params.get("p_variant_info") or "",
+                "deadline": params["p_deadline"],
+                "selected_works": json.loads(selected_works) if isinstance(selected_works, str) else selected_works,
+                "is_full_course": bool(params.get("p_is_full_course")),
+                "actual_price": float(params.get("p_actual_price") or 0.0),
+            })
+
+        return dict(
+            order,
+            student={"id": student["id"], "name": student["name"], "group": student["group_name"], "telegram": student["telegram"]},
+            subject={key: subject.get(key) for key in ("id", "name", "description", "price")},
+            is_duplicate=is_duplicate,
+        )
+
+    def save_chat_ids_bulk(self, params: dict) -> dict:
+        """Повторяет deploy/supabase-save-chat-ids.sql."""
+        if not self.rpc_enabled:
+            raise PostgrestError(404, "PGRST202", "Could not find the function public.save_chat_ids_bulk in the schema cache")
+
+        entries = {}
+        for entry in params.get("p_entries") or []:
+            if entry.get("telegram") and entry.get("chat_id"):
+                entries[entry["telegram"].lower()] = entry
+        students = self.tables["students"]
+        result, updated, inserted = [], 0, 0
+        for telegram, entry in entries.items():
+            candidates = sorted(
+                (row for row in students.values() if as_text(row.get("telegram")).lower() == telegram),
+                key=lambda row: (row.get("telegram") != telegram, row["id"])
+            )
+            if candidates:
+                student = candidates[0]
+                if student.get("chat_id") != entry["chat_id"]:
+                    student.update({"telegram": telegram, "chat_id": entry["chat_id"]})
+                    updated += 1
+            else:
+                student = self.insert_row("students", {
+                    "telegram": telegram, "chat_id": entry["chat_id"],
+                    "name": entry.get("name") or "", "group_name": "Не указана",
+                })
+                inserted += 1
+            result.append({"id": student["id"], "telegram": telegram, "chat_id": entry["chat_id"]})
+        return {"students": result, "updated": updated, "inserted": inserted}
+
+    def update_order_files(self, params: dict) -> Optional[list]:
+        """Повторяет deploy/supabase-order-files.sql."""
+        if not self.rpc_enabled:
+            raise PostgrestError(404, "PGRST202", "Could not find the function public.update_order_files in the schema cache")
+
+        order = self.tables["orders"].get(int(params["p_order_id"]))
+        if order is None:
+            return None
+        files = order.get("files") or []
+        if isinstance(files, str):
+            files = json.loads(files) if files.lstrip().startswith("[") else []
+        remove = params.get("p_remove") or []
+        result = []
+        for name in list(files) + list(params.get("p_add") or []):
+            if name not in remove and name not in result:
+                result.append(name)
+        order.update(files=result, updated_at=utc_now_iso())
+        return result
+
+
+class FakeSupabaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakePostgREST/1.0"
+    # Заголовки и тело уходят отдельными send(): без TCP_NODELAY Nagle + delayed ACK дают ~40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self) -> FakeSupabaseStore:
+        return self.server.store
+
+    def send_json(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None, include_body: bool = True):
+        payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8") if include_body else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def handle_request(self, method: str):
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        prefer = {item.strip() for item in (self.headers.get("Prefer") or "").split(",")}
+        single = SINGLE_OBJECT_MEDIA_TYPE in (self.headers.get("Accept") or "")
+
+        if not path.startswith("/rest/v1/"):
+            self.send_json(404, {"message": "not found"})
+            return
+        resource = path[len("/rest/v1/"):]
+
+        with self.store.lock:
+            self.store.request_count += 1
+            route_key = f"{method} {resource}"
+            self.store.requests_by_route[route_key] = self.store.requests_by_route.get(route_key, 0) + 1
+            try:
+                if resource.startswith("rpc/"):
+                    rpc_handlers = {
+                        "rpc/create_order_atomic": self.store.create_order_atomic,
+                        "rpc/save_chat_ids_bulk": self.store.save_chat_ids_bulk,
+                        "rpc/update_order_files": self.store.update_order_files,
+                    }
+                    if resource not in rpc_handlers:
+                        raise PostgrestError(404, "PGRST202", f"Could not find the function public.{resource[4:]}")
+                    self.send_json(200, rpc_handlers[resource](self.read_json()))
+                    return
+
+                if resource not in self.store.tables:
+                    raise PostgrestError(404, "42P01", f'relation "public.{resource}" does not exist')
+
+                if method in ("GET", "HEAD"):
+                    rows, total = self.store.select(resource, params)
+                    offset = int(dict(params).get("offset", 0) or 0)
+                    total_text = str(total) if "count=exact" in prefer else "*"
+                    content_range = f"{offset}-{offset + len(rows) - 1}/{total_text}" if rows else f"*/{total_text}"
+                    headers = {"Content-Range": content_range}
+                    if single:
+                        if len(rows) != 1:
+                            raise PostgrestError(406, "PGRST116", "JSON object requested, multiple (or no) rows returned",
+                                                 f"The result contains {len(rows)} rows")
+                        self.send_json(200, rows[0], headers, include_body=method == "GET")
+                    else:
+                        self.send_json(200, rows, headers, include_body=method == "GET")
+                elif method == "POST":
+                    rows = self.store.insert(resource, self.read_json())
+                    self.send_json(201, rows if "return=representation" in prefer else [])
+                elif method == "PATCH":
+                    rows = self.store.update(resource, params, self.read_json())
+                    self.send_json(200, rows if "return=representation" in prefer else [])
+                else:
+                    raise PostgrestError(405, "PGRST000", f"method {method} is not supported by the fake")
+            except PostgrestError as error:
+                self.send_json(error.status, error.body)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+
+class FakeSupabaseServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store: FakeSupabaseStore, latency_ms: float = 0.0):
+        super().__init__(address, FakeSupabaseHandler)
+        self.store = store
+        self.latency_seconds = max(0.0, latency_ms) / 1000
+
+
+def start_fake_supabase(store: FakeSupabaseStore, host: str = "127.0.0.1", port: int = 0,
+                        latency_ms: float = 0.0) -> Tuple[FakeSupabaseServer, str]:
+    """Запускает сервер в фоновом потоке и возвращает (server, SUPABASE_URL)."""
+    server = FakeSupabaseServer((host, port), store, latency_ms)
+    threading.Thread(target=server.serve_forever, name="fake-supabase", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="In-memory PostgREST для локальной разработки и замеров")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--no-rpc", action="store_true", help="эмулировать отсутствие функций create_order_atomic, save_chat_ids_bulk и update_order_files")
+    args = parser.parse_args()
+
+    fake_store = FakeSupabaseStore(rpc_enabled=not args.no_rpc)
+    fake_store.seed(orders=args.orders)
+    fake_server = FakeSupabaseServer(("127.0.0.1", args.port), fake_store, args.latency_ms)
+    print(f"SUPABASE_URL=http://127.0.0.1:{args.port}")
+    fake_server.serve_forever()
@@ -0,0 +1,272 @@
+"""
+Локальная замена Telegram Bot API для бенчмарков и проверки очереди уведомлений.
+
+Принимает любые методы по пути /bot<token>/<method> (JSON, form и multipart) и
+отвечает как Bot API. Неисправности настраиваются через TelegramFaults:
+задержка с разбросом, глобальный лимит RPS и случайные 429 с retry_after,
+серии 5xx («падения» на N запросов), обрывы соединения без ответа (RST)
+и 403 для пользователей, заблокировавших бота.
+
+Backend направляется сюда через TELEGRAM_API_BASE_URL, bot.py — через ту же
+переменную. Отдельный запуск:
+
+    python benchmarks/fake_telegram.py --port 8081 --rate-429 0.05 --outage-every 200 --outage-length 20
+
+Счетчики доступны на GET /__stats.
+"""
+
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+
+@dataclass
+class TelegramFaults:
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    # Глобальный лимит как у Bot API (~30 сообщений/с); 0 — без лимита
+    max_rps: float = 0.0
+    # Доля запросов, получающих 429 независимо от лимита
+    rate_429: float = 0.0
+    retry_after: int = 1
+    # Доля случайных 500
+    error_rate: float = 0.0
+    # Каждые outage_every запросов следующие outage_length получают 502/503
+    outage_every: int = 0
+    outage_length: int = 0
+    # Доля запросов, на которые соединение обрывается без ответа
+    reset_rate: float = 0.0
+    # chat_id пользователей, заблокировавших бота: send* для них получают 403
+    blocked_chat_ids: Tuple[str, ...] = ()
+    seed: Optional[int] = None
+
+
+class FakeTelegramStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls_by_method: Dict[str, int] = {}
+        self.ok_by_method: Dict[str, int] = {}
+        self.outcomes: Dict[str, int] = {"ok": 0, "429": 0, "403": 0, "5xx": 0, "reset": 0}
+        self.next_message_id = 1
+
+    def record(self, method: str, outcome: str) -> int:
+        with self.lock:
+            self.calls_by_method[method] = self.calls_by_method.get(method, 0) + 1
+            self.outcomes[outcome] += 1
+            if outcome == "ok":
+                self.ok_by_method[method] = self.ok_by_method.get(method, 0) + 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            return message_id
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.calls_by_method)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "calls_by_method": dict(self.calls_by_method),
+                "ok_by_method": dict(self.ok_by_method),
+                "outcomes": dict(self.outcomes),
+            }
+
+
+class FaultInjector:
+    """Решает исход каждого запроса; состояние общее для всех потоков сервера."""
+
+    def __init__(self, faults: TelegramFaults):
+        self.faults = faults
+        self.rng = random.Random(faults.seed)
+        self.lock = threading.Lock()
+        self.request_number = 0
+        self.tokens = max(faults.max_rps, 1.0)
+        self.tokens_updated = time.monotonic()
+
+    def latency_seconds(self) -> float:
+        with self.lock:
+            jitter = self.rng.uniform(-self.faults.latency_jitter_ms, self.faults.latency_jitter_ms)
+        return max(0.0, self.faults.latency_ms + jitter) / 1000
+
+    def decide(self) -> Tuple[str, Optional[int]]:
+        """Возвращает (исход, retry_after): ok, 429, 5xx или reset."""
+        faults = self.faults
+        with self.lock:
+            self.request_number += 1
+            if faults.reset_rate and self.rng.random() < faults.reset_rate:
+                return "reset", None
+
+            if faults.outage_every and faults.outage_length:
+                position = (self.request_number - 1) % (faults.outage_every + faults.outage_length)
+                if position >= faults.outage_every:
+                    return "5xx", None
+            if faults.error_rate and self.rng.random() < faults.error_rate:
+                return "5xx", None
+
+            if faults.max_rps:
+                now = time.monotonic()
+                self.tokens = min(faults.max_rps, self.tokens + (now - self.tokens_updated) * faults.max_rps)
+                self.tokens_updated = now
+                if self.tokens < 1.0:
+                    return "429", max(1, int((1.0 - self.tokens) / faults.max_rps + 0.999))
+                self.tokens -= 1.0
+            if faults.rate_429 and self.rng.random() < faults.rate_429:
+                return "429", faults.retry_after
+            return "ok", None
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeBotAPI/1.0"
+    # Заголовки и тело уходят отдельными send(): без TCP_NODELAY Nagle + delayed ACK дают ~40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_params(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type") or ""
+        try:
+            if content_type.startswith("application/json"):
+                return json.loads(raw or b"{}")
+            if content_type.startswith("application/x-www-form-urlencoded"):
+                return dict(parse_qsl(raw.decode("utf-8")))
+        except ValueError:
+            pass
+        return {}
+
+    def reset_connection(self):
+        """Закрывает соединение с RST, не отправив ответ."""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.close_connection = True
+
+    def handle_method(self):
+        params = self.read_params()
+        path = self.path.split("?", 1)[0].strip("/")
+        if path == "__stats":
+            self.send_json(200, dict(self.server.stats.to_dict(), faults=asdict(self.server.injector.faults)))
+            return
+
+        parts = path.split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            self.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        method = parts[1]
+
+        if method == "getUpdates":
+            # Long polling: держим запрос, но недолго, чтобы бот быстро останавливался
+            time.sleep(min(float(params.get("timeout") or 0), 2.0))
+            self.server.stats.record(method, "ok")
+            self.send_json(200, {"ok": True, "result": []})
+            return
+
+        latency = self.server.injector.latency_seconds()
+        if latency:
+            time.sleep(latency)
+
+        if method.startswith("send") and str(params.get("chat_id", "")) in self.server.injector.faults.blocked_chat_ids:
+            self.server.stats.record(method, "403")
+            self.send_json(403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+            return
+
+        outcome, retry_after = self.server.injector.decide()
+        message_id = self.server.stats.record(method, outcome)
+        if outcome == "reset":
+            self.reset_connection()
+        elif outcome == "5xx":
+            status = random.choice((500, 502, 503))
+            self.send_json(status, {"ok": False, "error_code": status, "description": "Internal Server Error"})
+        elif outcome == "429":
+            self.send_json(429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            })
+        else:
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif method.startswith("send"):
+                chat_id = params.get("chat_id", 0)
+                result = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+            else:
+                result = True
+            self.send_json(200, {"ok": True, "result": result})
+
+    do_GET = handle_method
+    do_POST = handle_method
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults: Optional[TelegramFaults] = None):
+        super().__init__(address, FakeTelegramHandler)
+        self.stats = FakeTelegramStats()
+        self.injector = FaultInjector(faults or TelegramFaults())
+
+
+def start_fake_telegram(host: str = "127.0.0.1", port: int = 0,
+                        faults: Optional[TelegramFaults] = None) -> Tuple[FakeTelegramServer, str]:
+    """Запускает сервер в фоновом потоке и возвращает (server, TELEGRAM_API_BASE_URL)."""
+    server = FakeTelegramServer((host, port), faults)
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_fault_arguments(parser, prefix: str = ""):
+    """Флаги неисправностей; prefix позволяет встроить их в другие скрипты (--telegram-...)."""
+    defaults = TelegramFaults()
+    parser.add_argument(f"--{prefix}latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument(f"--{prefix}latency-jitter-ms", type=float, default=defaults.latency_jitter_ms)
+    parser.add_argument(f"--{prefix}max-rps", type=float, default=defaults.max_rps, help="лимит запросов/с, сверх него 429")
+    parser.add_argument(f"--{prefix}rate-429", type=float, default=defaults.rate_429, help="доля случайных 429")
+    parser.add_argument(f"--{prefix}retry-after", type=int, default=defaults.retry_after)
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=defaults.error_rate, help="доля случайных 5xx")
+    parser.add_argument(f"--{prefix}outage-every", type=int, default=defaults.outage_every)
+    parser.add_argument(f"--{prefix}outage-length", type=int, default=defaults.outage_length)
+    parser.add_argument(f"--{prefix}reset-rate", type=float, default=defaults.reset_rate, help="доля обрывов соединения")
+    parser.add_argument(
+        f"--{prefix}blocked-chat-ids",
+        type=lambda value: tuple(chat_id.strip() for chat_id in value.split(",") if chat_id.strip()),
+        default=defaults.blocked_chat_ids,
+        help="chat_id через запятую, для которых send* отвечает 403",
+    )
+
+
+def faults_from_args(args, prefix: str = "", seed: Optional[int] = None) -> TelegramFaults:
+    attribute_prefix = prefix.replace("-", "_")
+    values = {name: getattr(args, f"{attribute_prefix}{name}") for name in TelegramFaults.__dataclass_fields__ if name != "seed"}
+    return TelegramFaults(seed=seed, **values)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Локальный Telegram Bot API с неисправностями")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--seed", type=int)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    fake_server = FakeTelegramServer((args.host, args.port), faults_from_args(args, seed=args.seed))
+    print(f"TELEGRAM_API_BASE_URL=http://{args.host}:{args.port}")
+    fake_server.serve_forever()
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный прогон backend против in-memory Supabase и fake Telegram Bot API.
+
+Backend запускается отдельным процессом uvicorn, поэтому генератор нагрузки
+и заглушки не делят с ним GIL. Примеры:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --scenarios list_orders,create_order --requests 1000 --concurrency 32
+    python benchmarks/run.py --json before.json
+    python benchmarks/run.py --compare before.json
+    python benchmarks/run.py --scenarios upload,download_all --storage s3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+BACKEND_DIR = os.path.join(ROOT_DIR, "backend")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_s3 import start_fake_s3  # noqa: E402
+from fake_supabase import FakeSupabaseStore, start_fake_supabase  # noqa: E402
+from fake_telegram import add_fault_arguments, faults_from_args, start_fake_telegram  # noqa: E402
+
+BENCH_BOT_TOKEN = "123456:bench-token"
+# Ключ в формате JWT: старые версии supabase-py проверяют его регулярным выражением
+BENCH_SUPABASE_KEY = "bench.bench.bench"
+BENCH_ADMIN_TOKEN = "bench-admin-token"
+STATUS_FLOW = ["new", "waiting_payment", "in_progress", "completed", "needs_revision"]
+
+SCENARIO_WEIGHTS_MIXED = {
+    "list_orders": 50,
+    "get_order": 15,
+    "create_order": 10,
+    "status_flip": 15,
+    "upload": 5,
+    "download_all": 5,
+}
+
+
+@dataclass
+class BenchContext:
+    rng: random.Random
+    students: int
+    subjects: int
+    orders: int
+    uploaded_ids: List[int] = field(default_factory=list)
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    latencies_ms: List[float]
+    errors: int
+    elapsed_seconds: float
+    supabase_calls: int
+    telegram_calls: int
+
+    def summary(self) -> Dict[str, float]:
+        count = len(self.latencies_ms)
+        ordered = sorted(self.latencies_ms)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "rps": round(count / self.elapsed_seconds, 1) if self.elapsed_seconds else 0.0,
+            "p50_ms": round(percentile(ordered, 0.50), 2),
+            "p90_ms": round(percentile(ordered, 0.90), 2),
+            "p99_ms": round(percentile(ordered, 0.99), 2),
+            "max_ms": round(ordered[-1], 2) if ordered else 0.0,
+            "supabase_calls_per_request": round(self.supabase_calls / count, 2) if count else 0.0,
+            "telegram_calls": self.telegram_calls,
+        }
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def random_student(ctx: BenchContext) -> int:
+    return ctx.rng.randint(1, ctx.students)
+
+
+def random_order_id(ctx: BenchContext) -> int:
+    return ctx.rng.randint(1, ctx.orders)
+
+
+# ---- Сценарии: каждый делает один HTTP-запрос и возвращает ответ ----
+
+async def scenario_list_orders(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    params = {"page": ctx.rng.randint(1, 20), "limit": 20, "view": ctx.rng.choice(["full", "summary"])}
+    if ctx.rng.random() < 0.25:
+        params["telegram"] = f"bench_user_{random_student(ctx)}"
+    return await client.get("/api/orders", params=params)
+
+
+async def scenario_get_order(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    return await client.get(f"/api/orders/{random_order_id(ctx)}")
+
+
+async def scenario_create_order(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    student = random_student(ctx)
+    payload = {
+        "student": {"name": f"Студент {student}", "group": f"ГР-{student % 40:02d}", "telegram": f"@bench_user_{student}"},
+        "subject_id": ctx.rng.randint(1, ctx.subjects),
+        "title": f"Бенчмарк {uuid.uuid4().hex[:8]}",
+        "description": "Нагрузочный заказ",
+        "deadline": (date.today() + timedelta(days=ctx.rng.randint(7, 60))).isoformat(),
+        "actual_price": 1000,
+    }
+    return await client.post("/api/orders", json=payload, headers={"Idempotency-Key": str(uuid.uuid4())})
+
+
+async def scenario_status_flip(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    return await client.patch(f"/api/orders/{random_order_id(ctx)}/admin", json={"status": ctx.rng.choice(STATUS_FLOW)})
+
+
+async def scenario_bulk_status(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    order_ids = ctx.rng.sample(range(1, ctx.orders + 1), k=min(20, ctx.orders))
+    return await client.patch(
+        "/api/orders/bulk",
+        json={"order_ids": order_ids, "patch": {"status": ctx.rng.choice(STATUS_FLOW)}},
+        headers={"X-Admin-Token": BENCH_ADMIN_TOKEN},
+    )
+
+
+async def scenario_upload(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    order_id = random_order_id(ctx)
+    files = [
+        ("files", ("report.pdf", ctx.rng.randbytes(64 * 1024), "application/pdf")),
+        ("files", ("notes.txt", ("строка отчета\n" * 1200).encode("utf-8"), "text/plain")),
+    ]
+    response = await client.post(f"/api/orders/{order_id}/files", files=files)
+    if response.status_code == 200:
+        ctx.uploaded_ids.append(order_id)
+    return response
+
+
+async def scenario_download_all(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    if not ctx.uploaded_ids:
+        return await scenario_upload(client, ctx)
+    return await client.get(f"/api/orders/{ctx.rng.choice(ctx.uploaded_ids)}/download-all")
+
+
+SCENARIOS: Dict[str, Callable[[httpx.AsyncClient, BenchContext], Awaitable[httpx.Response]]] = {
+    "list_orders": scenario_list_orders,
+    "get_order": scenario_get_order,
+    "create_order": scenario_create_order,
+    "status_flip": scenario_status_flip,
+    "bulk_status": scenario_bulk_status,
+    "upload": scenario_upload,
+    "download_all": scenario_download_all,
+}
+
+
+async def scenario_mixed(client: httpx.AsyncClient, ctx: BenchContext) -> httpx.Response:
+    names = list(SCENARIO_WEIGHTS_MIXED)
+    name = ctx.rng.choices(names, weights=[SCENARIO_WEIGHTS_MIXED[n] for n in names])[0]
+    return await SCENARIOS[name](client, ctx)
+
+
+SCENARIOS["mixed"] = scenario_mixed
+DEFAULT_SCENARIOS = ["list_orders", "get_order", "create_order", "status_flip", "bulk_status", "upload", "download_all", "mixed"]
+
+
+# ---- Запуск ----
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def ensure_no_root_dotenv():
+    """backend/main.py грузит корневой .env с override=True: с ним замер ушел бы в боевые Supabase/Telegram."""
+    env_path = os.path.join(ROOT_DIR, ".env")
+    if not os.path.exists(env_path):
+        return
+    with open(env_path, encoding="utf-8") as env_file:
+        keys = {line.split("=", 1)[0].strip() for line in env_file if "=" in line and not line.lstrip().startswith("#")}
+    dangerous = keys & {"SUPABASE_URL", "SUPABASE_KEY", "TELEGRAM_BOT_TOKEN", "TELEGRAM_API_BASE_URL",
+                         "STORAGE_BACKEND", "S3_ENDPOINT_URL", "S3_BUCKET"}
+    if dangerous:
+        sys.exit(f"❌ {env_path} задает {', '.join(sorted(dangerous))} и переопределит заглушки. "
+                 f"Временно переименуйте .env перед замером.")
+
+
+def start_backend(port: int, env_overrides: Dict[str, str], log_path: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update(env_overrides)
+    log_file = open(log_path, "w", encoding="utf-8")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        env=env, stdout=log_file, stderr=subprocess.STDOUT,
+    )
+
+
+def wait_for_backend(base_url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("backend завершился при запуске, см. лог")
+        try:
+            if httpx.get(f"{base_url}/", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("backend не ответил за отведенное время")
+
+
+async def run_scenario(name: str, base_url: str, ctx: BenchContext, requests_count: int, concurrency: int) -> tuple:
+    scenario = SCENARIOS[name]
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests_count
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0, limits=limits) as client:
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    response = await scenario(client, ctx)
+                    await response.aread()
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def wait_for_telegram_drain(telegram_server, settle_seconds: float, timeout: float = 30.0) -> int:
+    """Ждет, пока очередь уведомлений backend перестанет слать запросы."""
+    deadline = time.monotonic() + timeout
+    last_total = sum(telegram_server.stats.snapshot().values())
+    last_change = time.monotonic()
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        total = sum(telegram_server.stats.snapshot().values())
+        if total != last_total:
+            last_total, last_change = total, time.monotonic()
+        elif time.monotonic() - last_change >= settle_seconds:
+            break
+    return last_total
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None):
+    header = f"{'scenario':<14}{'req':>6}{'err':>5}{'rps':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'db/req':>8}{'tg':>6}"
+    print(header)
+    print("-" * len(header))
+    for name, row in results.items():
+        print(f"{name:<14}{row['requests']:>6}{row['errors']:>5}{row['rps']:>9.1f}{row['p50_ms']:>9.1f}"
+              f"{row['p90_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+              f"{row['supabase_calls_per_request']:>8.2f}{row['telegram_calls']:>6}")
+        before = (baseline or {}).get(name)
+        if before:
+            def delta(key):
+                return (row[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            print(f"{'  vs baseline':<14}{'':>11}{delta('rps'):>+8.1f}%{delta('p50_ms'):>+8.1f}%"
+                  f"{delta('p90_ms'):>+8.1f}%{delta('p99_ms'):>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк backend против локальных заглушек Supabase и Telegram")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS),
+                        help=f"через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=300, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20, help="прогревочных запросов перед каждым сценарием")
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--subjects", type=int, default=20)
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--db-latency-ms", type=float, default=5.0, help="искусственная задержка каждого запроса к Supabase")
+    add_fault_arguments(parser, prefix="telegram-")
+    parser.set_defaults(telegram_latency_ms=30.0)
+    parser.add_argument("--no-rpc", action="store_true", help="без create_order_atomic (последовательный путь создания)")
+    parser.add_argument("--storage", choices=("local", "s3"), default="local",
+                        help="хранилище файлов заказов; s3 — локальный fake_s3.py (нужен boto3)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    scenario_names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenario_names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Неизвестные сценарии: {', '.join(unknown)}")
+    ensure_no_root_dotenv()
+
+    store = FakeSupabaseStore(rpc_enabled=not args.no_rpc)
+    store.seed(students=args.students, subjects=args.subjects, orders=args.orders, seed=args.seed)
+    supabase_server, supabase_url = start_fake_supabase(store, latency_ms=args.db_latency_ms)
+    telegram_server, telegram_url = start_fake_telegram(faults=faults_from_args(args, prefix="telegram-", seed=args.seed))
+
+    storage_env = {"STORAGE_BACKEND": args.storage}
+    s3_server = None
+    if args.storage == "s3":
+        s3_server, s3_url = start_fake_s3()
+        storage_env.update({
+            "S3_ENDPOINT_URL": s3_url,
+            "S3_BUCKET": "bench-orders",
+            "S3_ACCESS_KEY_ID": "bench",
+            "S3_SECRET_ACCESS_KEY": "bench",
+        })
+
+    work_dir = tempfile.mkdtemp(prefix="bbifather-bench-")
+    port = find_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    log_path = os.path.join(work_dir, "backend.log")
+    backend = start_backend(port, {
+        **storage_env,
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_KEY": BENCH_SUPABASE_KEY,
+        "TELEGRAM_BOT_TOKEN": BENCH_BOT_TOKEN,
+        "ADMIN_API_TOKEN": BENCH_ADMIN_TOKEN,
+        "TELEGRAM_API_BASE_URL": telegram_url,
+        "TELEGRAM_PROXY_URL": "",
+        "TELEGRAM_ADMIN_CHAT_IDS": "1,2",
+        "TELEGRAM_QUEUE_MAX_SIZE": "100000",
+        "UPLOADS_DIR": os.path.join(work_dir, "uploads"),
+        "IDEMPOTENCY_DB_PATH": os.path.join(work_dir, "idempotency.sqlite3"),
+        "BROADCAST_DB_PATH": os.path.join(work_dir, "broadcasts.sqlite3"),
+        "DEAD_LETTER_DB_PATH": os.path.join(work_dir, "dead_letters.sqlite3"),
+        "LOG_LEVEL": "WARNING",
+        "SLOW_REQUEST_MS": "600000",
+        "NO_PROXY": "127.0.0.1,localhost",
+    }, log_path)
+
+    try:
+        wait_for_backend(base_url, backend)
+        if store.request_count == 0:
+            sys.exit("❌ backend не обратился к fake Supabase при запуске — проверьте окружение")
+
+        ctx = BenchContext(rng=random.Random(args.seed), students=args.students, subjects=args.subjects, orders=args.orders)
+        print(f"🏁 backend {base_url}, Supabase {supabase_url} (+{args.db_latency_ms}ms), "
+              f"Telegram {telegram_url} (+{args.telegram_latency_ms}ms), concurrency {args.concurrency}")
+
+        results: Dict[str, Dict[str, float]] = {}
+        for name in scenario_names:
+            if args.warmup:
+                asyncio.run(run_scenario(name, base_url, ctx, args.warmup, min(args.concurrency, args.warmup)))
+                wait_for_telegram_drain(telegram_server, settle_seconds=0.3)
+
+            supabase_before = store.request_count
+            telegram_before = sum(telegram_server.stats.snapshot().values())
+            latencies, errors, elapsed = asyncio.run(run_scenario(name, base_url, ctx, args.requests, args.concurrency))
+            supabase_calls = store.request_count - supabase_before
+            telegram_calls = wait_for_telegram_drain(telegram_server, settle_seconds=1.0) - telegram_before
+
+            results[name] = ScenarioResult(name, latencies, errors, elapsed, supabase_calls, telegram_calls).summary()
+
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file).get("results")
+        print()
+        print_results(results, baseline)
+
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as output:
+                json.dump({"args": vars(args), "results": results}, output, ensure_ascii=False, indent=2)
+            print(f"\n💾 Результаты сохранены в {args.json_path}")
+        if any(row["errors"] for row in results.values()):
+            print(f"\n⚠️ Были ошибки, лог backend: {log_path}")
+    finally:
+        backend.terminate()
+        try:
+            backend.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            backend.kill()
+        supabase_server.shutdown()
+        telegram_server.shutdown()
+        if s3_server:
+            s3_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
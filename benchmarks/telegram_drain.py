@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Пропускная способность и повторы очереди Telegram-уведомлений backend
+при имитации сбоев Bot API.
+
+Скрипт импортирует backend/main.py в этот же процесс, направляет его на
+fake_telegram.py с выбранными неисправностями, кладет в очередь N сообщений
+и ждет, пока очередь не опустеет (включая отложенные повторы). Примеры:
+
+    python benchmarks/telegram_drain.py --messages 500
+    python benchmarks/telegram_drain.py --messages 300 --max-rps 30 --latency-ms 40
+    python benchmarks/telegram_drain.py --outage-every 100 --outage-length 50 --reset-rate 0.02
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_telegram import add_fault_arguments, faults_from_args, start_fake_telegram  # noqa: E402
+from run import BACKEND_DIR, BENCH_BOT_TOKEN, ensure_no_root_dotenv  # noqa: E402
+
+
+def pending_retry_timers() -> int:
+    """Повторы backend откладывает через threading.Timer — пока они живы, очередь не пуста."""
+    return sum(1 for thread in threading.enumerate() if isinstance(thread, threading.Timer) and thread.is_alive())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер очереди Telegram-уведомлений под сбоями Bot API")
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--timeout", type=float, default=300.0, help="максимальное время ожидания, с")
+    parser.add_argument("--seed", type=int, default=1)
+    add_fault_arguments(parser)
+    parser.set_defaults(latency_ms=30.0)
+    args = parser.parse_args()
+    ensure_no_root_dotenv()
+
+    telegram_server, telegram_url = start_fake_telegram(faults=faults_from_args(args, seed=args.seed))
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_BOT_TOKEN,
+        "TELEGRAM_API_BASE_URL": telegram_url,
+        "TELEGRAM_PROXY_URL": "",
+        "TELEGRAM_QUEUE_MAX_SIZE": str(max(args.messages * 2, 10)),
+        "TELEGRAM_QUEUE_RETRY_BASE_SECONDS": os.getenv("TELEGRAM_QUEUE_RETRY_BASE_SECONDS", "1"),
+        "TELEGRAM_QUEUE_RETRY_MAX_SECONDS": os.getenv("TELEGRAM_QUEUE_RETRY_MAX_SECONDS", "5"),
+        "SUPABASE_URL": "",
+        "SUPABASE_KEY": "",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "ERROR"),
+        "NO_PROXY": "127.0.0.1,localhost",
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    import main as backend  # noqa: E402
+
+    if backend.TELEGRAM_API_BASE_URL != telegram_url:
+        sys.exit("❌ backend не использует fake Telegram — проверьте окружение")
+
+    backend.start_log_listener()
+    backend.start_telegram_notification_worker()
+    started = time.perf_counter()
+    enqueued = sum(
+        backend.queue_telegram_notification(
+            "sendMessage",
+            {"chat_id": str(100000 + index), "text": f"Уведомление #{index}"},
+            f"drain #{index}",
+        )
+        for index in range(args.messages)
+    )
+
+    deadline = time.monotonic() + args.timeout
+    first_pass_seconds = None
+    while time.monotonic() < deadline:
+        queue_idle = backend.TELEGRAM_NOTIFICATION_QUEUE.unfinished_tasks == 0
+        if queue_idle and first_pass_seconds is None:
+            first_pass_seconds = time.perf_counter() - started
+        if queue_idle and pending_retry_timers() == 0:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    timed_out = time.monotonic() >= deadline
+
+    backend.stop_telegram_notification_worker()
+    backend.stop_log_listener()
+    telegram_server.shutdown()
+
+    stats = telegram_server.stats.to_dict()
+    delivered = stats["ok_by_method"].get("sendMessage", 0)
+    requests_total = stats["calls_by_method"].get("sendMessage", 0)
+    print(f"📬 Поставлено в очередь: {enqueued}/{args.messages}")
+    print(f"✅ Доставлено: {delivered}  ❌ Потеряно: {enqueued - delivered}")
+    print(f"⏱️ Время до пустой очереди: {elapsed:.2f}s"
+          + (f" (первый проход {first_pass_seconds:.2f}s)" if first_pass_seconds else "")
+          + (" — прервано по --timeout" if timed_out else ""))
+    print(f"🚀 Пропускная способность: {delivered / elapsed:.1f} сообщений/с" if elapsed else "")
+    print(f"🔁 HTTP-запросов на доставленное сообщение: {requests_total / delivered:.2f}" if delivered else "🔁 Ничего не доставлено")
+    print(f"📊 Ответы fake Bot API: {stats['outcomes']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,27 @@ Telegram Bot для BBI Father
 
 import os
 import asyncio
+import hmac
+import importlib.util
 import logging
-import requests
 import re
 import socket
+import sqlite3
 import time
 import urllib.parse
 import inspect
-from typing import Optional, List, Set
-
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Dict, Optional, List, Set
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo, BotCommand
 from telegram.error import NetworkError, TelegramError, TimedOut
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
@@ -70,6 +79,8 @@ API_BASE_URL = (
     or os.getenv("INTERNAL_API_BASE_URL")
     or "http://127.0.0.1:8000/api"
 )
+# Токен админских API backend (тот же ADMIN_API_TOKEN): нужен для обновления клавиатур
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "").strip() or os.getenv("BROADCAST_ADMIN_TOKEN", "").strip()
 # Массовое обновление клавиатур было одноразовой миграцией. Не запускаем его при старте,
 # даже если старая переменная осталась в .env.
 FORCE_REFRESH_BOT_USERS_ON_STARTUP = False
@@ -77,16 +88,61 @@ FORCE_REFRESH_STARTUP_DELAY_SECONDS = float(os.getenv("FORCE_REFRESH_STARTUP_DEL
 UPDATE_BOT_COMMANDS_ON_STARTUP = os.getenv("UPDATE_BOT_COMMANDS_ON_STARTUP", "false").lower() == "true"
 TELEGRAM_FORCE_IPV4 = os.getenv("TELEGRAM_FORCE_IPV4", "true").lower() == "true"
 TELEGRAM_PROXY_URL = os.getenv("TELEGRAM_PROXY_URL", "").strip()
+# Общий с backend адрес Bot API: позволяет направить бота в локальный stand-in
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").strip().rstrip("/") or "https://api.telegram.org"
+# Общий с backend шлюз Bot API (telegram_gateway.py): при нем бот не держит свой пул и proxy к Telegram
+TELEGRAM_GATEWAY_URL = os.getenv("TELEGRAM_GATEWAY_URL", "").strip().rstrip("/")
+TELEGRAM_CLIENT_BASE_URL = TELEGRAM_GATEWAY_URL or TELEGRAM_API_BASE_URL
 TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
 TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "8"))
 TELEGRAM_GET_UPDATES_READ_TIMEOUT = float(os.getenv("TELEGRAM_GET_UPDATES_READ_TIMEOUT", "60"))
 TELEGRAM_SEND_RETRIES = max(1, int(os.getenv("TELEGRAM_SEND_RETRIES", "1")))
 TELEGRAM_SEND_RETRY_DELAY_SECONDS = max(0.5, float(os.getenv("TELEGRAM_SEND_RETRY_DELAY_SECONDS", "1")))
-BACKEND_FAILURE_COOLDOWN_SECONDS = max(0.0, float(os.getenv("BACKEND_FAILURE_COOLDOWN_SECONDS", "60")))
+# Предохранитель запросов в backend: доля ошибок в окне последних запросов размыкает цепь,
+# пробы идут через BACKEND_BREAKER_OPEN_SECONDS с удвоением до BACKEND_FAILURE_COOLDOWN_SECONDS
+BACKEND_FAILURE_COOLDOWN_SECONDS = max(1.0, float(os.getenv("BACKEND_FAILURE_COOLDOWN_SECONDS", "60")))
+BACKEND_BREAKER_OPEN_SECONDS = min(BACKEND_FAILURE_COOLDOWN_SECONDS, max(0.5, float(os.getenv("BACKEND_BREAKER_OPEN_SECONDS", "2"))))
+BACKEND_BREAKER_WINDOW = max(1, int(os.getenv("BACKEND_BREAKER_WINDOW", "20")))
+BACKEND_BREAKER_MIN_CALLS = min(BACKEND_BREAKER_WINDOW, max(1, int(os.getenv("BACKEND_BREAKER_MIN_CALLS", "5"))))
+BACKEND_BREAKER_FAILURE_RATE = min(1.0, max(0.05, float(os.getenv("BACKEND_BREAKER_FAILURE_RATE", "0.5"))))
+# Сколько отложенных действий хранится до восстановления backend
+BACKEND_DEFERRED_MAX_SIZE = max(1, int(os.getenv("BACKEND_DEFERRED_MAX_SIZE", "50")))
 CHAT_ID_SYNC_TTL_SECONDS = max(0.0, float(os.getenv("CHAT_ID_SYNC_TTL_SECONDS", "3600")))
+# Кэш синхронизированных chat_id переживает перезапуски: SQLite рядом с ботом (пустой путь — только память)
+CHAT_ID_SYNC_CACHE_PATH = os.getenv(
+    "CHAT_ID_SYNC_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_id_sync_cache.sqlite3")
+).strip()
+CHAT_ID_SYNC_CACHE_MAX_ENTRIES = max(100, int(os.getenv("CHAT_ID_SYNC_CACHE_MAX_ENTRIES", "50000")))
+CHAT_ID_SYNC_FLUSH_INTERVAL_SECONDS = max(1.0, float(os.getenv("CHAT_ID_SYNC_FLUSH_INTERVAL_SECONDS", "30")))
+# chat_id отправляются в backend пачками раз в интервал (или раньше, когда набралась полная пачка)
+CHAT_ID_SYNC_BATCH_INTERVAL_SECONDS = max(0.5, float(os.getenv("CHAT_ID_SYNC_BATCH_INTERVAL_SECONDS", "5")))
+CHAT_ID_SYNC_BATCH_MAX_SIZE = min(500, max(1, int(os.getenv("CHAT_ID_SYNC_BATCH_MAX_SIZE", "200"))))
+CHAT_ID_SYNC_PENDING_MAX = max(CHAT_ID_SYNC_BATCH_MAX_SIZE, int(os.getenv("CHAT_ID_SYNC_PENDING_MAX", "5000")))
 BOT_START_MAX_RETRIES = max(1, int(os.getenv("BOT_START_MAX_RETRIES", "8")))
 BOT_START_RETRY_DELAY_SECONDS = max(1.0, float(os.getenv("BOT_START_RETRY_DELAY_SECONDS", "5")))
 BOT_BOOTSTRAP_RETRIES = int(os.getenv("BOT_BOOTSTRAP_RETRIES", "10"))
+# Режим получения обновлений: polling (getUpdates) или webhook (Telegram сам присылает POST)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower() or "polling"
+# Публичный https-адрес webhook, например https://bbifather.site/telegram/webhook
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").strip()
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "").strip()
+TELEGRAM_WEBHOOK_LISTEN = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "127.0.0.1").strip()
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8090"))
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = min(100, max(1, int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))))
+# Сколько обновлений разных чатов обрабатывается одновременно; внутри одного чата — строго по порядку
+TELEGRAM_UPDATE_CONCURRENCY = max(1, int(os.getenv("TELEGRAM_UPDATE_CONCURRENCY", "8")))
+# Метрики обработчиков: порог медленного update и период сводки в лог (0 — не писать)
+BOT_SLOW_HANDLER_MS = max(0.0, float(os.getenv("BOT_SLOW_HANDLER_MS", "2000")))
+BOT_METRICS_LOG_INTERVAL_SECONDS = max(0.0, float(os.getenv("BOT_METRICS_LOG_INTERVAL_SECONDS", "300")))
+HANDLER_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Один пул соединений к backend на весь процесс: keep-alive вместо нового TCP/TLS на каждое нажатие
+BACKEND_MAX_CONNECTIONS = max(1, int(os.getenv("BACKEND_MAX_CONNECTIONS", "10")))
+BACKEND_KEEPALIVE_EXPIRY_SECONDS = max(1.0, float(os.getenv("BACKEND_KEEPALIVE_EXPIRY_SECONDS", "30")))
+# HTTP/2 работает только для https-адреса backend и при установленном пакете h2
+BACKEND_HTTP2 = (
+    os.getenv("BACKEND_HTTP2", "true").lower() == "true"
+    and importlib.util.find_spec("h2") is not None
+)
 
 if TELEGRAM_FORCE_IPV4:
     _original_getaddrinfo = socket.getaddrinfo
@@ -100,6 +156,8 @@ if TELEGRAM_FORCE_IPV4:
 
 def get_telegram_proxy_url() -> str:
     """Использует DNS-разрешение SOCKS-прокси, а не заблокированный маршрут VPS."""
+    if TELEGRAM_GATEWAY_URL:
+        return ""
     if TELEGRAM_PROXY_URL.startswith("socks5://"):
         return f"socks5h://{TELEGRAM_PROXY_URL[len('socks5://'):]}"
     return TELEGRAM_PROXY_URL
@@ -107,17 +165,366 @@ def get_telegram_proxy_url() -> str:
 if not BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не задан в .env файле!")
 
+def describe_update(update: object) -> str:
+    """Метка update для метрик: команда, текст или тип"""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    message = update.effective_message
+    if message and message.text:
+        if message.text.startswith("/"):
+            return message.text.split()[0].split("@")[0]
+        return "text"
+    if update.callback_query:
+        return "callback_query"
+    return "other"
+
+class HandlerLatencyStats:
+    """Гистограммы ожидания и обработки update по меткам describe_update."""
+
+    def __init__(self):
+        self.stats: Dict[str, dict] = {}
+        self.in_flight = 0
+
+    def record(self, label: str, wait_ms: float, handle_ms: float):
+        stats = self.stats.setdefault(label, {
+            "count": 0, "sum_ms": 0.0, "max_ms": 0.0, "wait_sum_ms": 0.0, "wait_max_ms": 0.0,
+            "buckets": [0] * (len(HANDLER_LATENCY_BUCKETS_MS) + 1),
+        })
+        stats["count"] += 1
+        stats["sum_ms"] += handle_ms
+        stats["max_ms"] = max(stats["max_ms"], handle_ms)
+        stats["wait_sum_ms"] += wait_ms
+        stats["wait_max_ms"] = max(stats["wait_max_ms"], wait_ms)
+        bucket = next((index for index, bound in enumerate(HANDLER_LATENCY_BUCKETS_MS) if handle_ms <= bound), len(HANDLER_LATENCY_BUCKETS_MS))
+        stats["buckets"][bucket] += 1
+
+    @staticmethod
+    def percentile(buckets: List[int], count: int, fraction: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает перцентиль"""
+        if not count:
+            return None
+        threshold = count * fraction
+        seen = 0
+        for index, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= threshold:
+                return float(HANDLER_LATENCY_BUCKETS_MS[index]) if index < len(HANDLER_LATENCY_BUCKETS_MS) else None
+        return None
+
+    def snapshot(self) -> dict:
+        handlers = {}
+        for label, stats in sorted(self.stats.items()):
+            count = stats["count"]
+            handlers[label] = {
+                "count": count,
+                "avg_ms": round(stats["sum_ms"] / count, 1),
+                "p50_ms": self.percentile(stats["buckets"], count, 0.5),
+                "p99_ms": self.percentile(stats["buckets"], count, 0.99),
+                "max_ms": round(stats["max_ms"], 1),
+                "avg_wait_ms": round(stats["wait_sum_ms"] / count, 1),
+                "max_wait_ms": round(stats["wait_max_ms"], 1),
+            }
+        return {"in_flight": self.in_flight, "handlers": handlers}
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка update разных чатов с сохранением порядка внутри чата.
+
+    Семафор PTB берется раньше do_process_update, поэтому общий лимит держим свой и
+    берем его уже после блокировки чата: очередь сообщений одного пользователя не
+    занимает слоты, нужные другим чатам. Lock в asyncio отдает блокировку в порядке
+    ожидания, а задачи PTB создает в порядке поступления update.
+    """
+
+    # Потолок для семафора PTB: реальный лимит — self.concurrency
+    MAX_PENDING_UPDATES = 10000
+
+    def __init__(self, concurrency: int, stats: HandlerLatencyStats):
+        super().__init__(self.MAX_PENDING_UPDATES)
+        self.concurrency = concurrency
+        self.stats = stats
+        self.chat_locks: Dict[int, list] = {}
+        self.slots: Optional[asyncio.Semaphore] = None
+
+    async def initialize(self) -> None:
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.chat_locks.clear()
+
+    async def shutdown(self) -> None:
+        self.chat_locks.clear()
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        received_at = time.perf_counter()
+        chat = update.effective_chat if isinstance(update, Update) else None
+        chat_key = chat.id if chat else None
+
+        entry = None
+        if chat_key is not None:
+            # [lock, число ожидающих]: блокировка удаляется, когда чат больше никого не ждет
+            entry = self.chat_locks.setdefault(chat_key, [asyncio.Lock(), 0])
+            entry[1] += 1
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self.slots:
+                    started_at = time.perf_counter()
+                    self.stats.in_flight += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.stats.in_flight -= 1
+                        finished_at = time.perf_counter()
+                        self.record(update, chat_key, (started_at - received_at) * 1000, (finished_at - started_at) * 1000)
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self.chat_locks.pop(chat_key, None)
+
+    def record(self, update: object, chat_key: Optional[int], wait_ms: float, handle_ms: float):
+        label = describe_update(update)
+        self.stats.record(label, wait_ms, handle_ms)
+        if BOT_SLOW_HANDLER_MS and handle_ms >= BOT_SLOW_HANDLER_MS:
+            logger.warning(f"🐢 Медленная обработка {label} в чате {chat_key}: {handle_ms:.0f}ms (ожидание {wait_ms:.0f}ms)")
+
+class BackendCircuitBreaker:
+    """Предохранитель для запросов бота в backend.
+
+    closed — запросы идут, исходы пишутся в окно последних BACKEND_BREAKER_WINDOW;
+    при доле ошибок не ниже порога цепь размыкается. open — запросы не отправляются
+    open_seconds. half_open — пропускается ровно одна проба: успех замыкает цепь,
+    ошибка снова размыкает ее на вдвое больший срок (до BACKEND_FAILURE_COOLDOWN_SECONDS).
+
+    allow_request выдает билет, и исход учитывается только по нему: пробой считается
+    лишь запрос, пропущенный как проба, а ответы запросов, начатых до размыкания цепи
+    (билет прежнего поколения), игнорируются — иначе поздние ошибки удлиняли бы паузу,
+    а поздний успех замыкал бы цепь при лежащем backend.
+    Весь доступ — из одного event loop, блокировки не нужны.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    PROBE_TICKET = -1
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.outcomes: deque = deque(maxlen=BACKEND_BREAKER_WINDOW)
+        self.open_seconds = BACKEND_BREAKER_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        # Растет при каждом размыкании; билет обычного запроса — поколение на момент отправки
+        self.generation = 0
+
+    def retry_after(self) -> float:
+        if self.state == self.OPEN:
+            return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+        if self.state == self.HALF_OPEN and self.probe_in_flight:
+            return min(1.0, self.open_seconds)
+        return 0.0
+
+    def allow_request(self) -> Optional[int]:
+        """Билет для record_success/record_failure или None, если запрос отправлять нельзя."""
+        if self.state == self.CLOSED:
+            return self.generation
+        if self.state == self.OPEN:
+            if self.retry_after() > 0:
+                return None
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+        if self.probe_in_flight:
+            return None
+        self.probe_in_flight = True
+        return self.PROBE_TICKET
+
+    def release_probe(self, ticket: int):
+        """Запрос завершился без ответа о здоровье backend (например, занят пул)."""
+        if ticket == self.PROBE_TICKET and self.state == self.HALF_OPEN:
+            self.probe_in_flight = False
+
+    def record_success(self, ticket: int) -> bool:
+        """True, если этот успех замкнул цепь."""
+        if ticket == self.PROBE_TICKET:
+            if self.state != self.HALF_OPEN:
+                return False
+            self.state = self.CLOSED
+            self.probe_in_flight = False
+            self.open_seconds = BACKEND_BREAKER_OPEN_SECONDS
+            self.outcomes.clear()
+            return True
+        if self.state == self.CLOSED and ticket == self.generation:
+            self.outcomes.append(True)
+        return False
+
+    def record_failure(self, ticket: int) -> bool:
+        """True, если эта ошибка разомкнула замкнутую цепь."""
+        if ticket == self.PROBE_TICKET:
+            if self.state == self.HALF_OPEN:
+                # Неудачная проба: ждем дольше
+                self.open_seconds = min(self.open_seconds * 2, BACKEND_FAILURE_COOLDOWN_SECONDS)
+                self.trip()
+            return False
+        if self.state != self.CLOSED or ticket != self.generation:
+            return False
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= BACKEND_BREAKER_MIN_CALLS and failures / len(self.outcomes) >= BACKEND_BREAKER_FAILURE_RATE:
+            self.trip()
+            self.times_opened += 1
+            return True
+        return False
+
+    def trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.generation += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "recent_failures": self.outcomes.count(False),
+            "recent_calls": len(self.outcomes),
+            "times_opened": self.times_opened,
+        }
+
+class ChatIdSyncCache:
+    """LRU пользователей, чей chat_id уже сохранен в backend.
+
+    Чтение и запись идут в памяти; изменения копятся в dirty и периодически
+    сбрасываются в SQLite (write-behind), так что после деплоя бот не повторяет
+    save-chat-id для всех, кто недавно писал. Время хранится как time.time(),
+    чтобы TTL работал и между запусками.
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self.dirty: Dict[str, tuple[str, float]] = {}
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS chat_id_sync (
+                user_id TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_chat_id_sync_synced_at ON chat_id_sync(synced_at)")
+        return connection
+
+    def load(self):
+        """Поднимает в память самые свежие непросроченные записи."""
+        if not self.path:
+            return
+        try:
+            connection = self.connect()
+            try:
+                rows = connection.execute(
+                    "SELECT user_id, value, synced_at FROM chat_id_sync WHERE synced_at >= ? "
+                    "ORDER BY synced_at DESC LIMIT ?",
+                    (time.time() - self.ttl_seconds, self.max_entries)
+                ).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Кэш chat_id не загружен, начинаем с пустого: {e}")
+            return
+        for user_id, value, synced_at in reversed(rows):
+            self.entries[user_id] = (value, synced_at)
+        if rows:
+            logger.info(f"💾 Загружено {len(rows)} записей кэша chat_id")
+
+    def is_fresh(self, user_id: str, value: str) -> bool:
+        cached = self.entries.get(user_id)
+        if cached is None or cached[0] != value or self.ttl_seconds <= 0:
+            return False
+        if time.time() - cached[1] >= self.ttl_seconds:
+            return False
+        self.entries.move_to_end(user_id)
+        return True
+
+    def remember(self, user_id: str, value: str):
+        record = (value, time.time())
+        self.entries[user_id] = record
+        self.entries.move_to_end(user_id)
+        self.dirty[user_id] = record
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def write(self, records: Dict[str, tuple[str, float]]):
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT INTO chat_id_sync (user_id, value, synced_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET value = excluded.value, synced_at = excluded.synced_at",
+                [(user_id, value, synced_at) for user_id, (value, synced_at) in records.items()]
+            )
+            connection.execute("DELETE FROM chat_id_sync WHERE synced_at < ?", (time.time() - self.ttl_seconds,))
+            connection.execute(
+                "DELETE FROM chat_id_sync WHERE user_id IN ("
+                "SELECT user_id FROM chat_id_sync ORDER BY synced_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения на диск; при ошибке вернет их в dirty."""
+        if not self.path or not self.dirty:
+            return
+        records, self.dirty = self.dirty, {}
+        try:
+            await asyncio.to_thread(self.write, records)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Не удалось записать кэш chat_id ({len(records)} записей): {e}")
+            for user_id, record in records.items():
+                self.dirty.setdefault(user_id, record)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(CHAT_ID_SYNC_FLUSH_INTERVAL_SECONDS)
+            await self.flush()
+
 class BBIFatherBot:
     def __init__(self):
         self.app: Optional[Application] = None
         self._is_running = False
-        self._backend_unavailable_until = 0.0
-        self._chat_id_sync_cache: dict[str, tuple[str, float]] = {}
+        self.backend_breaker = BackendCircuitBreaker()
+        # действие -> (url, тело, таймаут, действие): повторяются после восстановления backend
+        self._deferred_backend_calls: "OrderedDict[str, tuple]" = OrderedDict()
+        self._backend_probe_task: Optional[asyncio.Task] = None
+        self._chat_id_sync_cache = ChatIdSyncCache(CHAT_ID_SYNC_CACHE_PATH, CHAT_ID_SYNC_CACHE_MAX_ENTRIES, CHAT_ID_SYNC_TTL_SECONDS)
+        self._chat_id_sync_cache.load()
+        self._chat_id_flush_task: Optional[asyncio.Task] = None
+        # user_id -> (значение для кэша, тело записи для backend); порядок — порядок наблюдений
+        self._pending_chat_ids: "OrderedDict[str, tuple[str, dict]]" = OrderedDict()
+        # Уменьшается, если backend ответил 413 (его SAVE_CHAT_IDS_MAX_ENTRIES меньше нашего)
+        self._chat_id_batch_max_size = CHAT_ID_SYNC_BATCH_MAX_SIZE
+        self._chat_id_batch_ready: Optional[asyncio.Event] = None
+        self._chat_id_batch_task: Optional[asyncio.Task] = None
+        self._backend_client: Optional[httpx.AsyncClient] = None
+        self.handler_stats = HandlerLatencyStats()
+        self._metrics_task: Optional[asyncio.Task] = None
 
     def build_application(self):
-        builder = Application.builder().token(BOT_TOKEN).post_init(self.on_post_init)
+        builder = Application.builder().token(BOT_TOKEN).post_init(self.on_post_init).post_shutdown(self.on_post_shutdown)
+        builder = builder.base_url(f"{TELEGRAM_CLIENT_BASE_URL}/bot").base_file_url(f"{TELEGRAM_CLIENT_BASE_URL}/file/bot")
         builder = builder.request(self.create_telegram_request(read_timeout=TELEGRAM_READ_TIMEOUT))
         builder = builder.get_updates_request(self.create_telegram_request(read_timeout=TELEGRAM_GET_UPDATES_READ_TIMEOUT))
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(TELEGRAM_UPDATE_CONCURRENCY, self.handler_stats))
         self.app = builder.build()
         self.setup_handlers()
         self.app.add_error_handler(self.handle_error)
@@ -149,10 +556,41 @@ class BBIFatherBot:
 
         return HTTPXRequest(**kwargs)
 
+    def get_backend_client(self) -> httpx.AsyncClient:
+        """Общий клиент backend; создается в event loop приложения."""
+        if self._backend_client is None or self._backend_client.is_closed:
+            # Лимит соединений ограничивает и параллельность: лишние запросы ждут свободное соединение
+            self._backend_client = httpx.AsyncClient(
+                http2=BACKEND_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=BACKEND_MAX_CONNECTIONS,
+                    max_keepalive_connections=BACKEND_MAX_CONNECTIONS,
+                    keepalive_expiry=BACKEND_KEEPALIVE_EXPIRY_SECONDS,
+                ),
+                headers={"User-Agent": "bbifather-bot"},
+            )
+        return self._backend_client
+
+    async def close_backend_client(self):
+        if self._backend_client is not None:
+            await self._backend_client.aclose()
+            self._backend_client = None
+
     async def on_post_init(self, application: Application):
         """Действия сразу после запуска приложения."""
-        if TELEGRAM_PROXY_URL:
+        self.get_backend_client()
+        if BOT_METRICS_LOG_INTERVAL_SECONDS > 0:
+            self._metrics_task = asyncio.create_task(self.log_handler_metrics_periodically())
+        if CHAT_ID_SYNC_CACHE_PATH:
+            self._chat_id_flush_task = asyncio.create_task(self._chat_id_sync_cache.flush_periodically())
+        self._chat_id_batch_ready = asyncio.Event()
+        self._chat_id_batch_task = asyncio.create_task(self.sync_chat_ids_periodically())
+        if TELEGRAM_GATEWAY_URL:
+            logger.info(f"🚦 Telegram API через общий шлюз {TELEGRAM_GATEWAY_URL}")
+        elif TELEGRAM_PROXY_URL:
             logger.info("🌐 Telegram API использует настроенный proxy")
+        if TELEGRAM_API_BASE_URL != "https://api.telegram.org":
+            logger.info(f"🧪 Telegram API направлен на {TELEGRAM_API_BASE_URL}")
 
         if UPDATE_BOT_COMMANDS_ON_STARTUP:
             try:
@@ -172,6 +610,40 @@ class BBIFatherBot:
         if FORCE_REFRESH_BOT_USERS_ON_STARTUP:
             asyncio.create_task(self.force_refresh_all_users_keyboards_after_delay())
 
+    async def on_post_shutdown(self, application: Application):
+        """Закрывает соединения с backend при остановке или перезапуске приложения."""
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self._backend_probe_task:
+            self._backend_probe_task.cancel()
+            self._backend_probe_task = None
+        if self._deferred_backend_calls:
+            logger.warning(f"⚠️ При остановке не выполнено отложенных действий backend: {len(self._deferred_backend_calls)}")
+        if self._chat_id_batch_task:
+            self._chat_id_batch_task.cancel()
+            self._chat_id_batch_task = None
+        # Накопленное за последний интервал отправляем до закрытия клиента backend
+        await self.flush_pending_chat_ids()
+        if self._chat_id_flush_task:
+            self._chat_id_flush_task.cancel()
+            self._chat_id_flush_task = None
+        await self._chat_id_sync_cache.flush()
+        await self.close_backend_client()
+
+    async def log_handler_metrics_periodically(self):
+        """Сводка задержек обработчиков в лог: в polling-режиме другого способа посмотреть ее нет."""
+        while True:
+            await asyncio.sleep(BOT_METRICS_LOG_INTERVAL_SECONDS)
+            snapshot = self.handler_stats.snapshot()
+            if not snapshot["handlers"]:
+                continue
+            summary = ", ".join(
+                f"{label}: {stats['count']} шт, p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms, max {stats['max_ms']}ms"
+                for label, stats in snapshot["handlers"].items()
+            )
+            logger.info(f"📊 Обработчики: {summary}")
+
     async def force_refresh_all_users_keyboards_after_delay(self):
         """Обновляет клавиатуры после старта polling, не блокируя запуск бота."""
         if FORCE_REFRESH_STARTUP_DELAY_SECONDS > 0:
@@ -195,36 +667,123 @@ class BBIFatherBot:
             return api_url[:-4]
         return api_url
 
-    def backend_sync_is_paused(self) -> bool:
-        """Проверяет, стоит ли временно пропустить синхронизацию с backend."""
-        return time.monotonic() < self._backend_unavailable_until
+    def defer_backend_call(
+        self, url: str, json_payload: dict, timeout: float, action: str, headers: Optional[dict] = None
+    ):
+        """Откладывает действие до восстановления backend; повтор того же действия заменяет старое."""
+        self._deferred_backend_calls.pop(action, None)
+        self._deferred_backend_calls[action] = (url, json_payload, timeout, action, headers)
+        while len(self._deferred_backend_calls) > BACKEND_DEFERRED_MAX_SIZE:
+            _, (_, _, _, dropped_action, _) = self._deferred_backend_calls.popitem(last=False)
+            logger.warning(f"⚠️ Очередь отложенных действий backend заполнена, отброшено '{dropped_action}'")
+
+    def record_backend_failure(self, ticket: int):
+        if self.backend_breaker.record_failure(ticket):
+            logger.warning(
+                f"🔌 Backend недоступен: запросы приостановлены, проба через {self.backend_breaker.open_seconds:.0f} сек"
+            )
+        self.ensure_backend_probe()
 
-    def pause_backend_sync(self):
-        """Ставит короткую паузу после сетевой ошибки backend, чтобы бот продолжал отвечать."""
-        if BACKEND_FAILURE_COOLDOWN_SECONDS > 0:
-            self._backend_unavailable_until = time.monotonic() + BACKEND_FAILURE_COOLDOWN_SECONDS
+    def record_backend_success(self, ticket: int):
+        if self.backend_breaker.record_success(ticket):
+            self.on_backend_recovered()
 
-    async def post_to_backend(self, url: str, json_payload: dict, timeout: float, action: str) -> Optional[requests.Response]:
-        """Выполняет POST в backend без влияния на обработку Telegram-сообщений."""
-        if self.backend_sync_is_paused():
-            logger.warning(f"⏸️ Backend недоступен, пропускаем действие '{action}' до следующей попытки")
+    def ensure_backend_probe(self):
+        """Пока цепь разомкнута, backend проверяется в фоне, не дожидаясь новых сообщений."""
+        if self.backend_breaker.state == BackendCircuitBreaker.CLOSED:
+            return
+        if self._backend_probe_task is None or self._backend_probe_task.done():
+            self._backend_probe_task = asyncio.create_task(self.probe_backend_until_recovered())
+
+    async def probe_backend_until_recovered(self):
+        health_url = f"{self.get_api_base_url()}/health"
+        while self.backend_breaker.state != BackendCircuitBreaker.CLOSED:
+            await asyncio.sleep(max(0.1, self.backend_breaker.retry_after()))
+            ticket = self.backend_breaker.allow_request()
+            if ticket is None:
+                continue
+            try:
+                response = await self.get_backend_client().get(health_url, timeout=5)
+            except httpx.PoolTimeout:
+                self.backend_breaker.release_probe(ticket)
+                continue
+            except httpx.HTTPError as e:
+                self.backend_breaker.record_failure(ticket)
+                logger.info(f"🔌 Проба backend неудачна, следующая через {self.backend_breaker.open_seconds:.0f} сек: {e!r}")
+                continue
+            if response.status_code >= 500:
+                self.backend_breaker.record_failure(ticket)
+            else:
+                self.record_backend_success(ticket)
+
+    def on_backend_recovered(self):
+        logger.info(f"✅ Backend снова доступен, повторяем отложенные действия: {len(self._deferred_backend_calls)}")
+        if self._deferred_backend_calls:
+            asyncio.create_task(self.replay_deferred_backend_calls())
+        if self._chat_id_batch_ready:
+            self._chat_id_batch_ready.set()
+
+    async def replay_deferred_backend_calls(self):
+        while self._deferred_backend_calls and self.backend_breaker.state == BackendCircuitBreaker.CLOSED:
+            _, (url, json_payload, timeout, action, headers) = self._deferred_backend_calls.popitem(last=False)
+            response = await self.post_to_backend(url, json_payload, timeout, action, defer=True, headers=headers)
+            if response is not None and response.status_code < 400:
+                logger.info(f"✅ Отложенное действие '{action}' выполнено")
+
+    async def post_to_backend(
+        self,
+        url: str,
+        json_payload: dict,
+        timeout: float,
+        action: str,
+        defer: bool = False,
+        headers: Optional[dict] = None,
+    ) -> Optional[httpx.Response]:
+        """Выполняет POST в backend без влияния на обработку Telegram-сообщений.
+
+        При разомкнутой цепи запрос не отправляется; с defer=True действие
+        откладывается и повторяется после восстановления backend.
+        """
+        ticket = self.backend_breaker.allow_request()
+        if ticket is None:
+            if defer:
+                self.defer_backend_call(url, json_payload, timeout, action, headers)
+                logger.warning(f"⏸️ Backend недоступен, действие '{action}' отложено до восстановления")
+            else:
+                logger.warning(f"⏸️ Backend недоступен, пропускаем действие '{action}' до следующей попытки")
+            self.ensure_backend_probe()
             return None
 
         try:
-            return await asyncio.to_thread(
-                requests.post,
-                url,
-                json=json_payload,
-                timeout=timeout
-            )
-        except requests.exceptions.RequestException as e:
-            self.pause_backend_sync()
-            logger.warning(f"⚠️ Backend недоступен при действии '{action}': {e}")
+            response = await self.get_backend_client().post(url, json=json_payload, timeout=timeout, headers=headers)
+        except httpx.PoolTimeout:
+            # Backend жив, просто все соединения пула заняты — на предохранитель не влияет
+            self.backend_breaker.release_probe(ticket)
+            logger.warning(f"⏳ Нет свободного соединения к backend для действия '{action}'")
+            return None
+        except httpx.HTTPError as e:
+            self.record_backend_failure(ticket)
+            if defer:
+                self.defer_backend_call(url, json_payload, timeout, action, headers)
+            logger.warning(f"⚠️ Backend недоступен при действии '{action}': {e!r}")
             return None
         except Exception as e:
+            self.backend_breaker.release_probe(ticket)
             logger.error(f"❌ Ошибка backend-запроса '{action}': {e}")
             return None
 
+        if response.status_code >= 500:
+            # 502/503/504 от nginx во время перезапуска backend — тот же отказ
+            self.record_backend_failure(ticket)
+            if defer:
+                self.defer_backend_call(url, json_payload, timeout, action, headers)
+        else:
+            self.record_backend_success(ticket)
+            if defer:
+                # Действие выполнено сейчас — отложенная копия больше не нужна
+                self._deferred_backend_calls.pop(action, None)
+        return response
+
     def remember_admin_chat_id(self, user):
         """Добавляет chat_id админа по username даже если backend сейчас недоступен."""
         try:
@@ -278,6 +837,9 @@ class BBIFatherBot:
 
     async def force_refresh_all_users_keyboards(self):
         """Принудительное обновление клавиатуры для всех пользователей в базе."""
+        if not ADMIN_API_TOKEN:
+            logger.warning("⚠️ ADMIN_API_TOKEN не задан, обновление меню пользователей пропущено")
+            return
         refresh_urls = [
             f"{self.get_api_base_url()}/bot/force-refresh-keyboards",
             f"{self.get_backend_root_url()}/api/bot/force-refresh-keyboards"
@@ -294,7 +856,9 @@ class BBIFatherBot:
                         refresh_url,
                         {"silent": True},
                         20,
-                        "force-refresh-keyboards"
+                        "force-refresh-keyboards",
+                        defer=True,
+                        headers={"X-Admin-Token": ADMIN_API_TOKEN}
                     )
                     if response is None:
                         continue
@@ -436,7 +1000,7 @@ class BBIFatherBot:
         )
 
     async def save_user_chat_id(self, user):
-        """Сохранение chat_id пользователя для отправки уведомлений"""
+        """Ставит chat_id пользователя в очередь на пакетную отправку в backend"""
         self.remember_admin_chat_id(user)
 
         if not user.username:
@@ -445,41 +1009,99 @@ class BBIFatherBot:
 
         cache_key = str(user.id)
         cache_value = f"{user.username.lower()}:{user.id}"
-        cached_value, cached_at = self._chat_id_sync_cache.get(cache_key, ("", 0.0))
-        if (
-            cached_value == cache_value
-            and CHAT_ID_SYNC_TTL_SECONDS > 0
-            and time.monotonic() - cached_at < CHAT_ID_SYNC_TTL_SECONDS
-        ):
+        if self._chat_id_sync_cache.is_fresh(cache_key, cache_value):
             return
-            
-        try:
-            full_url = f"{self.get_api_base_url()}/save-chat-id"
-            logger.info(f"🌐 Отправляем chat_id на: {full_url}")
-
-            # Выполняем блокирующий HTTP-запрос в отдельном потоке, чтобы не блокировать event loop
-            response = await self.post_to_backend(
-                full_url,
-                {
-                    "telegram_username": user.username,
-                    "chat_id": user.id,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name or ""
-                },
-                5,
-                "save-chat-id"
-            )
-            if response is None:
+
+        self._pending_chat_ids.pop(cache_key, None)
+        self._pending_chat_ids[cache_key] = (cache_value, {
+            "telegram_username": user.username,
+            "chat_id": user.id,
+            "first_name": user.first_name,
+            "last_name": user.last_name or ""
+        })
+        while len(self._pending_chat_ids) > CHAT_ID_SYNC_PENDING_MAX:
+            self._pending_chat_ids.popitem(last=False)
+        if len(self._pending_chat_ids) >= self._chat_id_batch_max_size and self._chat_id_batch_ready:
+            self._chat_id_batch_ready.set()
+
+    async def sync_chat_ids_periodically(self):
+        """Раз в интервал отправляет накопленные chat_id одним запросом."""
+        while True:
+            try:
+                await asyncio.wait_for(self._chat_id_batch_ready.wait(), timeout=CHAT_ID_SYNC_BATCH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._chat_id_batch_ready.clear()
+            await self.flush_pending_chat_ids()
+
+    async def flush_pending_chat_ids(self):
+        """Отправляет очередь chat_id пачками; записи с временной ошибкой возвращаются в очередь."""
+        while self._pending_chat_ids:
+            batch = []
+            while self._pending_chat_ids and len(batch) < self._chat_id_batch_max_size:
+                batch.append(self._pending_chat_ids.popitem(last=False))
+            failed = await self.send_chat_id_batch(batch)
+            if failed:
+                for cache_key, pending in reversed(failed):
+                    # Более свежее наблюдение, пришедшее во время запроса, не затираем
+                    if cache_key not in self._pending_chat_ids and len(self._pending_chat_ids) < CHAT_ID_SYNC_PENDING_MAX:
+                        self._pending_chat_ids[cache_key] = pending
+                        self._pending_chat_ids.move_to_end(cache_key, last=False)
                 return
 
+    @staticmethod
+    def is_permanent_backend_error(status_code: int) -> bool:
+        """4xx, кроме timeout и 429, повтор не исправит: такие записи отбрасываем."""
+        return 400 <= status_code < 500 and status_code not in (408, 429)
+
+    async def send_chat_id_batch(self, batch: List[tuple]) -> List[tuple]:
+        """Отправляет пачку chat_id; возвращает записи, которые нужно повторить позже."""
+        full_url = f"{self.get_api_base_url()}/save-chat-ids"
+        response = await self.post_to_backend(
+            full_url,
+            {"entries": [payload for _, (_, payload) in batch]},
+            10,
+            "save-chat-ids"
+        )
+        if response is not None and response.status_code == 404:
+            return await self.send_chat_ids_one_by_one(batch)
+        if response is None:
+            return batch
+        if response.status_code == 413 and len(batch) > 1:
+            half = len(batch) // 2
+            self._chat_id_batch_max_size = min(self._chat_id_batch_max_size, half)
+            logger.warning(f"⚠️ Backend не принял пачку chat_id из {len(batch)}, дальше отправляем по {half}")
+            failed = await self.send_chat_id_batch(batch[:half])
+            return failed + await self.send_chat_id_batch(batch[half:])
+        if self.is_permanent_backend_error(response.status_code):
+            logger.error(f"❌ Backend отклонил пачку chat_id ({len(batch)}) с кодом {response.status_code}, пачка отброшена: {response.text}")
+            return []
+        if response.status_code != 200:
+            logger.warning(f"⚠️ Не удалось сохранить пачку chat_id ({len(batch)}): {response.text}")
+            return batch
+
+        for cache_key, (cache_value, _) in batch:
+            self._chat_id_sync_cache.remember(cache_key, cache_value)
+        logger.info(f"✅ Сохранено chat_id: {len(batch)}")
+        return []
+
+    async def send_chat_ids_one_by_one(self, batch: List[tuple]) -> List[tuple]:
+        """Backend без /save-chat-ids (старая версия): прежний запрос на каждого пользователя"""
+        full_url = f"{self.get_api_base_url()}/save-chat-id"
+        failed = []
+        for index, (cache_key, (cache_value, payload)) in enumerate(batch):
+            response = await self.post_to_backend(full_url, payload, 5, "save-chat-id")
+            if response is None:
+                # Backend недоступен: остаток пачки повторим целиком
+                return failed + batch[index:]
             if response.status_code == 200:
-                self._chat_id_sync_cache[cache_key] = (cache_value, time.monotonic())
-                logger.info(f"✅ Chat ID сохранен для @{user.username}")
+                self._chat_id_sync_cache.remember(cache_key, cache_value)
+            elif self.is_permanent_backend_error(response.status_code):
+                logger.error(f"❌ Backend отклонил chat_id с кодом {response.status_code}, запись отброшена: {response.text}")
             else:
                 logger.warning(f"⚠️ Не удалось сохранить chat_id: {response.text}")
-
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения chat_id: {e}")
+                failed.append(batch[index])
+        return failed
 
     async def send_rules(self, update: Update, context: ContextTypes.DEFAULT_TYPE, edit: bool = False):
         """Отправка правил пользования сервисом"""
@@ -708,9 +1330,86 @@ class BBIFatherBot:
 
 
 
+    def get_webhook_path(self) -> str:
+        return urllib.parse.urlsplit(TELEGRAM_WEBHOOK_URL).path or "/"
+
+    def create_webhook_app(self) -> Starlette:
+        """HTTP-приемник webhook: проверяет секрет и сразу кладет update в очередь приложения."""
+
+        async def receive_update(request: Request):
+            received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received_secret, TELEGRAM_WEBHOOK_SECRET):
+                logger.warning(f"🚫 Webhook-запрос с неверным секретом от {request.client.host if request.client else 'unknown'}")
+                return PlainTextResponse("Forbidden", status_code=403)
+            try:
+                payload = await request.json()
+            except ValueError:
+                return PlainTextResponse("Bad Request", status_code=400)
+
+            # Ответ Telegram не ждет обработки: медленный обработчик не задерживает доставку следующих update
+            await self.app.update_queue.put(Update.de_json(data=payload, bot=self.app.bot))
+            return PlainTextResponse("OK")
+
+        async def health(request: Request):
+            return JSONResponse({"status": "ok", "mode": "webhook", "pending_updates": self.app.update_queue.qsize()})
+
+        async def metrics(request: Request):
+            return JSONResponse(dict(
+                self.handler_stats.snapshot(),
+                concurrency=TELEGRAM_UPDATE_CONCURRENCY,
+                backend=dict(self.backend_breaker.snapshot(), deferred=len(self._deferred_backend_calls)),
+            ))
+
+        return Starlette(routes=[
+            Route(self.get_webhook_path(), receive_update, methods=["POST"]),
+            Route("/healthz", health, methods=["GET"]),
+            Route("/metrics", metrics, methods=["GET"]),
+        ])
+
+    async def run_webhook(self):
+        """Webhook-режим: Telegram присылает update на локальный Starlette-приемник за nginx."""
+        webserver = uvicorn.Server(uvicorn.Config(
+            app=self.create_webhook_app(),
+            host=TELEGRAM_WEBHOOK_LISTEN,
+            port=TELEGRAM_WEBHOOK_PORT,
+            log_level="warning",
+            access_log=False,
+            use_colors=False,
+        ))
+        # run_webhook PTB требует tornado; свой приемник управляет жизненным циклом вручную,
+        # поэтому post_init/post_shutdown вызываются здесь явно
+        async with self.app:
+            await self.on_post_init(self.app)
+            await self.app.bot.set_webhook(
+                url=TELEGRAM_WEBHOOK_URL,
+                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info(
+                f"🪝 Webhook установлен: {TELEGRAM_WEBHOOK_URL}, "
+                f"приемник {TELEGRAM_WEBHOOK_LISTEN}:{TELEGRAM_WEBHOOK_PORT}"
+            )
+            await self.app.start()
+            try:
+                await webserver.serve()
+            finally:
+                await self.app.stop()
+                await self.on_post_shutdown(self.app)
+
+    def validate_webhook_settings(self):
+        if not TELEGRAM_WEBHOOK_URL.startswith("https://") and TELEGRAM_API_BASE_URL == "https://api.telegram.org":
+            raise ValueError("Для BOT_MODE=webhook задайте TELEGRAM_WEBHOOK_URL с https://")
+        if not re.fullmatch(r"[A-Za-z0-9_-]{16,256}", TELEGRAM_WEBHOOK_SECRET):
+            raise ValueError("Для BOT_MODE=webhook задайте TELEGRAM_WEBHOOK_SECRET: 16-256 символов A-Z, a-z, 0-9, _ и -")
+
     def run(self):
         """Запуск бота"""
         logger.info("🤖 Запуск BBI Father Telegram Bot...")
+        if BOT_MODE == "webhook":
+            self.validate_webhook_settings()
+        elif BOT_MODE != "polling":
+            logger.warning(f"⚠️ Неизвестный BOT_MODE={BOT_MODE}, используем polling")
         attempt = 0
 
         while attempt < BOT_START_MAX_RETRIES:
@@ -718,6 +1417,10 @@ class BBIFatherBot:
             try:
                 self.build_application()
                 self._is_running = True
+                if BOT_MODE == "webhook":
+                    logger.info(f"🚀 Старт webhook: попытка {attempt}/{BOT_START_MAX_RETRIES}")
+                    asyncio.run(self.run_webhook())
+                    return
                 logger.info(f"🚀 Старт polling: попытка {attempt}/{BOT_START_MAX_RETRIES}")
                 self.app.run_polling(
                     drop_pending_updates=False,
@@ -0,0 +1,14 @@
+-- Рассылки (POST /api/broadcasts и обновление клавиатур).
+-- Выполните в Supabase SQL Editor. Backend помечает студентов, заблокировавших бота
+-- (Telegram ответил 403), и не выбирает их в следующих рассылках. Отметка снимается,
+-- когда пользователь снова пишет боту и его chat_id сохраняется заново.
+-- Без колонки backend хранит отметки только в локальной SQLite (BROADCAST_DB_PATH).
+
+ALTER TABLE students ADD COLUMN IF NOT EXISTS bot_blocked_at TIMESTAMPTZ;
+
+-- Рассылка идет страницами по id среди студентов с chat_id и без блокировки
+CREATE INDEX IF NOT EXISTS idx_students_broadcast_recipients
+    ON students(id)
+    WHERE chat_id IS NOT NULL AND bot_blocked_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_students_chat_id ON students(chat_id);
@@ -0,0 +1,120 @@
+-- Атомарное создание заказа для POST /api/orders.
+-- Выполните в Supabase SQL Editor. Backend вызывает функцию через supabase.rpc
+-- и автоматически возвращается к последовательным запросам, если её нет.
+--
+-- Одна транзакция выполняет: поиск/обновление/создание студента, проверку предмета
+-- (или создание «Кастомный предмет»), проверку дубликата за последние N секунд,
+-- вставку заказа и возврат заказа вместе со студентом и предметом.
+-- Advisory-lock по telegram закрывает гонку двух одновременных одинаковых запросов.
+
+CREATE OR REPLACE FUNCTION create_order_atomic(
+    p_student_name TEXT,
+    p_student_group TEXT,
+    p_telegram TEXT,
+    p_chat_id TEXT,
+    p_subject_id BIGINT,
+    p_title TEXT,
+    p_description TEXT,
+    p_input_data TEXT,
+    p_variant_info TEXT,
+    p_deadline DATE,
+    p_selected_works JSONB,
+    p_is_full_course BOOLEAN,
+    p_actual_price NUMERIC,
+    p_duplicate_window_seconds INTEGER DEFAULT 120
+) RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_student students%ROWTYPE;
+    v_subject subjects%ROWTYPE;
+    v_order_id BIGINT;
+    v_duplicate BOOLEAN := false;
+BEGIN
+    -- Заказы одного студента создаются строго по очереди
+    PERFORM pg_advisory_xact_lock(hashtext('create_order:' || lower(p_telegram)));
+
+    SELECT * INTO v_student FROM students WHERE telegram = p_telegram LIMIT 1;
+    IF NOT FOUND THEN
+        -- Старые записи могли сохранить telegram в другом регистре
+        SELECT * INTO v_student FROM students WHERE lower(telegram) = lower(p_telegram) LIMIT 1;
+    END IF;
+
+    IF FOUND THEN
+        UPDATE students
+        SET name = p_student_name,
+            group_name = p_student_group,
+            telegram = p_telegram,
+            chat_id = COALESCE(p_chat_id, chat_id)
+        WHERE id = v_student.id
+        RETURNING * INTO v_student;
+    ELSE
+        INSERT INTO students (name, group_name, telegram, chat_id)
+        VALUES (p_student_name, p_student_group, p_telegram, p_chat_id)
+        RETURNING * INTO v_student;
+    END IF;
+
+    IF p_subject_id IS NOT NULL THEN
+        SELECT * INTO v_subject FROM subjects WHERE id = p_subject_id;
+        IF NOT FOUND THEN
+            -- Откатывает и изменения студента
+            RAISE EXCEPTION 'subject_not_found' USING ERRCODE = 'P0002', DETAIL = p_subject_id::TEXT;
+        END IF;
+    ELSE
+        SELECT * INTO v_subject FROM subjects WHERE name = 'Кастомный предмет' LIMIT 1;
+        IF NOT FOUND THEN
+            INSERT INTO subjects (name, description, price)
+            VALUES ('Кастомный предмет', 'Предмет для кастомных заказов', 0.0)
+            RETURNING * INTO v_subject;
+        END IF;
+    END IF;
+
+    -- Окно 0 отключает эвристику: запрос пришел с Idempotency-Key
+    IF COALESCE(p_duplicate_window_seconds, 0) > 0 THEN
+        SELECT id INTO v_order_id
+        FROM orders
+        WHERE student_id = v_student.id
+          AND subject_id = v_subject.id
+          AND title = p_title
+          AND deadline = p_deadline
+          AND created_at >= NOW() - make_interval(secs => p_duplicate_window_seconds)
+        ORDER BY created_at DESC
+        LIMIT 1;
+    END IF;
+
+    IF v_order_id IS NOT NULL THEN
+        v_duplicate := true;
+    ELSE
+        INSERT INTO orders (
+            student_id, subject_id, title, description, input_data, variant_info, deadline,
+            selected_works, is_full_course, actual_price, status, executor_telegram, payout_amount
+        )
+        VALUES (
+            v_student.id, v_subject.id, p_title, COALESCE(p_description, ''), COALESCE(p_input_data, ''),
+            COALESCE(p_variant_info, ''), p_deadline, p_selected_works, COALESCE(p_is_full_course, false),
+            COALESCE(p_actual_price, 0.0), 'new', NULL, NULL
+        )
+        RETURNING id INTO v_order_id;
+    END IF;
+
+    -- Форма ответа совпадает с ORDER_JOINED_SELECT в backend/main.py
+    RETURN (
+        SELECT to_jsonb(o) || jsonb_build_object(
+            'student', jsonb_build_object(
+                'id', s.id, 'name', s.name, 'group', s.group_name, 'telegram', s.telegram
+            ),
+            'subject', jsonb_build_object(
+                'id', sb.id, 'name', sb.name, 'description', sb.description, 'price', sb.price
+            ),
+            'is_duplicate', v_duplicate
+        )
+        FROM orders o
+        JOIN students s ON s.id = o.student_id
+        JOIN subjects sb ON sb.id = o.subject_id
+        WHERE o.id = v_order_id
+    );
+END;
+$$;
+
+-- Ускоряет проверку дубликатов внутри функции
+CREATE INDEX IF NOT EXISTS idx_orders_student_created_at ON orders(student_id, created_at DESC);
@@ -0,0 +1,44 @@
+-- Атомарное изменение списка файлов заказа (orders.files).
+-- Выполните в Supabase SQL Editor. Backend вызывает функцию через supabase.rpc
+-- и автоматически возвращается к select + update, если её нет.
+--
+-- Загрузка файлов добавляет имена, а фоновая проверка убирает отклоненные. Одним
+-- UPDATE список пересчитывается из текущего значения строки, поэтому параллельная
+-- загрузка в тот же заказ не теряет свои файлы. Старый формат (JSON-строка внутри
+-- jsonb) приводится к массиву. Возвращает новый список или NULL, если заказа нет.
+
+CREATE OR REPLACE FUNCTION update_order_files(
+    p_order_id BIGINT,
+    p_add JSONB DEFAULT '[]'::jsonb,
+    p_remove JSONB DEFAULT '[]'::jsonb
+)
+RETURNS JSONB
+LANGUAGE sql
+AS $$
+    UPDATE orders o
+    SET files = (
+            SELECT COALESCE(jsonb_agg(kept.name ORDER BY kept.position), '[]'::jsonb)
+            FROM (
+                SELECT f.name, min(f.position) AS position
+                FROM (
+                    SELECT e AS name, n AS position
+                    FROM jsonb_array_elements(
+                        CASE
+                            WHEN jsonb_typeof(o.files) = 'array' THEN o.files
+                            WHEN jsonb_typeof(o.files) = 'string' AND left(btrim(o.files #>> '{}'), 1) = '['
+                                THEN (o.files #>> '{}')::jsonb
+                            ELSE '[]'::jsonb
+                        END
+                    ) WITH ORDINALITY AS current_files(e, n)
+                    UNION ALL
+                    SELECT e, 1000000 + n
+                    FROM jsonb_array_elements(COALESCE(p_add, '[]'::jsonb)) WITH ORDINALITY AS added(e, n)
+                ) f
+                WHERE NOT COALESCE(p_remove, '[]'::jsonb) @> jsonb_build_array(f.name)
+                GROUP BY f.name
+            ) kept
+        ),
+        updated_at = now()
+    WHERE o.id = p_order_id
+    RETURNING o.files;
+$$;
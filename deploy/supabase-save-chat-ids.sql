@@ -0,0 +1,59 @@
+-- Пакетное сохранение chat_id для POST /api/save-chat-ids.
+-- Выполните в Supabase SQL Editor. Backend вызывает функцию через supabase.rpc
+-- и автоматически возвращается к обычным запросам PostgREST, если её нет.
+--
+-- Один оператор с data-modifying CTE: сопоставляет пачку {telegram, chat_id, name}
+-- со студентами (сначала точное совпадение telegram, затем без учета регистра),
+-- обновляет chat_id у найденных, если он изменился, и создает недостающих студентов.
+
+CREATE OR REPLACE FUNCTION save_chat_ids_bulk(p_entries JSONB)
+RETURNS JSONB
+LANGUAGE sql
+AS $$
+    WITH input AS (
+        -- Повтор одного telegram в пачке: побеждает последняя запись
+        SELECT DISTINCT ON (lower(e->>'telegram'))
+            lower(e->>'telegram') AS telegram,
+            e->>'chat_id' AS chat_id,
+            COALESCE(e->>'name', '') AS name
+        FROM jsonb_array_elements(p_entries) WITH ORDINALITY AS t(e, n)
+        WHERE COALESCE(e->>'telegram', '') <> '' AND COALESCE(e->>'chat_id', '') <> ''
+        ORDER BY lower(e->>'telegram'), n DESC
+    ),
+    matched AS (
+        SELECT DISTINCT ON (i.telegram) s.id, i.telegram, i.chat_id, s.chat_id AS old_chat_id
+        FROM input i
+        JOIN students s ON lower(s.telegram) = i.telegram
+        ORDER BY i.telegram, (s.telegram = i.telegram) DESC, s.id
+    ),
+    updated AS (
+        UPDATE students s
+        SET telegram = m.telegram,
+            chat_id = m.chat_id
+        FROM matched m
+        WHERE s.id = m.id AND s.chat_id IS DISTINCT FROM m.chat_id
+        RETURNING s.id
+    ),
+    inserted AS (
+        INSERT INTO students (telegram, chat_id, name, group_name)
+        SELECT i.telegram, i.chat_id, i.name, 'Не указана'
+        FROM input i
+        WHERE NOT EXISTS (SELECT 1 FROM matched m WHERE m.telegram = i.telegram)
+        RETURNING id, telegram, chat_id
+    )
+    SELECT jsonb_build_object(
+        'students', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('id', r.id, 'telegram', r.telegram, 'chat_id', r.chat_id))
+            FROM (
+                SELECT id, telegram, chat_id FROM matched
+                UNION ALL
+                SELECT id, telegram, chat_id FROM inserted
+            ) r
+        ), '[]'::jsonb),
+        'updated', (SELECT count(*) FROM updated),
+        'inserted', (SELECT count(*) FROM inserted)
+    );
+$$;
+
+-- Сопоставление без учета регистра внутри функции
+CREATE INDEX IF NOT EXISTS idx_students_telegram_lower ON students(lower(telegram));
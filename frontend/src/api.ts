@@ -26,7 +26,15 @@ export const getSubjects = async (): Promise<Subject[]> => {
 };
 
 // Orders API
-export const getOrders = async (page: number = 1, limit: number = 10, telegram?: string | null): Promise<OrderListResponse> => {
+// summary — облегченная проекция для списков без длинных текстовых полей; детали дает getOrder
+export type OrderListView = 'full' | 'summary';
+
+export const getOrders = async (
+  page: number = 1,
+  limit: number = 10,
+  telegram?: string | null,
+  view: OrderListView = 'full'
+): Promise<OrderListResponse> => {
   const params = new URLSearchParams({
     page: String(page),
     limit: String(limit),
@@ -34,19 +42,26 @@ export const getOrders = async (page: number = 1, limit: number = 10, telegram?:
   if (telegram) {
     params.set('telegram', telegram);
   }
+  if (view !== 'full') {
+    params.set('view', view);
+  }
   const response = await api.get(`/api/orders?${params.toString()}`);
   return response.data;
 };
 
 // Получить все заказы без ограничения 100 записей (используется пагинация)
-export const getAllOrders = async (telegram?: string | null, pageSize: number = 200): Promise<Order[]> => {
+export const getAllOrders = async (
+  telegram?: string | null,
+  pageSize: number = 200,
+  view: OrderListView = 'full'
+): Promise<Order[]> => {
   const limit = Math.max(1, Math.min(pageSize, 1000)); // защитимся от слишком маленьких/больших значений
   let page = 1;
   let allOrders: Order[] = [];
   let total = 0;
 
   while (true) {
-    const response = await getOrders(page, limit, telegram ?? undefined);
+    const response = await getOrders(page, limit, telegram ?? undefined, view);
     allOrders = allOrders.concat(response.orders);
     total = response.total || allOrders.length;
 
@@ -66,8 +81,18 @@ export const getOrder = async (id: number): Promise<Order> => {
   return response.data;
 };
 
-export const createOrder = async (orderData: CreateOrderRequest): Promise<Order> => {
-  const response = await api.post('/api/orders', orderData);
+// Ключ повторяется при повторной отправке той же формы, и backend вернет уже созданный заказ
+export const createIdempotencyKey = (): string => {
+  if (typeof window.crypto?.randomUUID === 'function') {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+};
+
+export const createOrder = async (orderData: CreateOrderRequest, idempotencyKey?: string): Promise<Order> => {
+  const response = await api.post('/api/orders', orderData, {
+    headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : undefined,
+  });
   return response.data;
 };
 
@@ -119,7 +144,23 @@ export const uploadOrderFiles = async (id: number, files: FileList): Promise<Ord
   return response.data;
 };
 
+// Совпадает со STORAGE_BACKEND backend: только для S3 есть presigned URL
+const STORAGE_BACKEND = (process.env.REACT_APP_STORAGE_BACKEND || 'local').trim().toLowerCase();
+
 export const downloadFile = async (orderId: number, filename: string): Promise<void> => {
+  // Если файлы лежат в S3, скачиваем напрямую из хранилища по presigned URL
+  if (STORAGE_BACKEND === 's3') {
+    const linkInfo = await api.get(`/api/orders/${orderId}/download-url/${encodeURIComponent(filename)}`);
+    if (linkInfo.data?.presigned) {
+      const link = document.createElement('a');
+      link.href = linkInfo.data.url;
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      return;
+    }
+  }
+
   const response = await api.get(`/api/orders/${orderId}/download/${filename}`, {
     responseType: 'blob',
   });
@@ -135,6 +176,13 @@ export const downloadFile = async (orderId: number, filename: string): Promise<v
   window.URL.revokeObjectURL(url);
 };
 
+// Превью строится в фоне после загрузки; пока его нет, сервер отвечает 202 с Retry-After,
+// а 404 — только если превью для файла не будет
+export const PREVIEWABLE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.pdf'];
+
+export const getFilePreviewUrl = (orderId: number, filename: string, size: 'thumb' | 'preview' = 'thumb'): string =>
+  `${API_BASE_URL}/api/orders/${orderId}/preview/${encodeURIComponent(filename)}?size=${size}`;
+
 export const downloadAllFiles = async (orderId: number): Promise<void> => {
   const response = await api.get(`/api/orders/${orderId}/download-all`, {
     responseType: 'blob',
@@ -188,6 +236,20 @@ export const updateOrderAdmin = async (id: number, payload: Partial<Order>): Pro
   return response.data;
 };
 
+// Админ: массовое обновление заказов (статус, цена, оплата, исполнитель); нужен ADMIN_API_TOKEN backend
+export const bulkUpdateOrders = async (
+  orderIds: number[],
+  patch: Pick<Partial<Order>, 'status' | 'actual_price' | 'is_paid' | 'executor_telegram' | 'payout_amount' | 'payment_method'>,
+  adminToken: string
+): Promise<{ orders: Order[]; updated: number; missing_ids: number[] }> => {
+  const response = await api.patch(
+    '/api/orders/bulk',
+    { order_ids: orderIds, patch },
+    { headers: { 'X-Admin-Token': adminToken } }
+  );
+  return response.data;
+};
+
 // Админ/исполнитель: установка/снятие исполнителя и суммы к выплате
 export const updateOrderExecutor = async (
   id: number,
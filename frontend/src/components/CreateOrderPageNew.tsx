@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import {
   Box,
@@ -32,7 +32,7 @@ import {
   Remove
 } from '@mui/icons-material';
 import { Subject } from '../types';
-import { getSubjects, createOrder } from '../api';
+import { getSubjects, createOrder, createIdempotencyKey } from '../api';
 import { 
   coursesData, 
   subjectsData, 
@@ -52,6 +52,8 @@ const CreateOrderPage: React.FC = () => {
   const navigate = useNavigate();
   const [subjects, setSubjects] = useState<Subject[]>([]);
   const [loading, setLoading] = useState(false);
+  // Один ключ на форму: повторная отправка после сетевой ошибки не создаст дубликат
+  const idempotencyKeyRef = useRef<string>(createIdempotencyKey());
   const [error, setError] = useState<string>('');
   const [activeStep, setActiveStep] = useState(0);
   
@@ -299,7 +301,7 @@ const CreateOrderPage: React.FC = () => {
         actual_price: getTotalPrice() || 0,
       };
 
-      await createOrder(orderData);
+      await createOrder(orderData, idempotencyKeyRef.current);
       
       // Уведомление об успехе
       if (isInTelegram) {
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { Link, useSearchParams } from 'react-router-dom';
 import {
   Box,
@@ -25,7 +25,7 @@ import {
   Logout as LogoutIcon,
 } from '@mui/icons-material';
 import { Order, OrderStatus, OrderPaymentDetails } from '../types';
-import { getAllOrders, downloadAllFiles, sendFilesToTelegram, api, requestOrderRevision } from '../api';
+import { getAllOrders, downloadAllFiles, sendFilesToTelegram, api, requestOrderRevision, getFilePreviewUrl, PREVIEWABLE_EXTENSIONS } from '../api';
 import { format, differenceInDays } from 'date-fns';
 import { ru } from 'date-fns/locale';
 import { useTelegramWebApp } from '../hooks/useTelegramWebApp';
@@ -39,6 +39,68 @@ const statusConfig: Partial<Record<OrderStatus, { color: any; label: string; ico
   [OrderStatus.NEEDS_REVISION]: { color: 'error', label: 'Нужны исправления', icon: '🔄', progress: 80 },
 };
 
+// Превью строится в фоне: пока сервер отвечает 202, повторяем запрос с растущей паузой.
+// Миниатюру прячем только на настоящую ошибку (404/5xx) или после исчерпания попыток.
+const PREVIEW_RETRY_LIMIT = 6;
+const PREVIEW_RETRY_MAX_DELAY_MS = 30000;
+
+const PreviewThumbnail: React.FC<{ orderId: number; name: string }> = ({ orderId, name }) => {
+  const [attempt, setAttempt] = useState(0);
+  const [hidden, setHidden] = useState(false);
+  const retryTimer = useRef<number | undefined>(undefined);
+
+  useEffect(() => () => window.clearTimeout(retryTimer.current), []);
+
+  const thumbUrl = getFilePreviewUrl(orderId, name);
+
+  const scheduleRetry = (delayMs: number) => {
+    if (attempt >= PREVIEW_RETRY_LIMIT) {
+      setHidden(true);
+      return;
+    }
+    retryTimer.current = window.setTimeout(() => setAttempt(current => current + 1), delayMs);
+  };
+
+  const handleError = async () => {
+    const backoffMs = (seconds: number) => Math.min(seconds * 1000 * 2 ** attempt, PREVIEW_RETRY_MAX_DELAY_MS);
+    try {
+      // <img> не видит код ответа: уточняем, готовится превью или его не будет
+      const response = await fetch(thumbUrl, { cache: 'no-store' });
+      if (response.status === 202) {
+        scheduleRetry(backoffMs(Number(response.headers.get('Retry-After')) || 2));
+      } else if (response.ok) {
+        // Превью успело появиться между запросами
+        scheduleRetry(0);
+      } else {
+        setHidden(true);
+      }
+    } catch (error) {
+      scheduleRetry(backoffMs(2));
+    }
+  };
+
+  if (hidden) {
+    return null;
+  }
+
+  return (
+    <a
+      href={getFilePreviewUrl(orderId, name, 'preview')}
+      target="_blank"
+      rel="noopener noreferrer"
+      title={name}
+    >
+      <img
+        src={attempt ? `${thumbUrl}&attempt=${attempt}` : thumbUrl}
+        alt={name}
+        loading="lazy"
+        style={{ width: 64, height: 64, objectFit: 'cover', borderRadius: 4, display: 'block' }}
+        onError={handleError}
+      />
+    </a>
+  );
+};
+
 const OrdersPage: React.FC = () => {
   const [orders, setOrders] = useState<Order[]>([]);
   const [loading, setLoading] = useState(true);
@@ -104,7 +166,7 @@ const OrdersPage: React.FC = () => {
       setLoading(true);
       try {
         const userToFetch = isAdminView ? null : currentUser;
-      const fetchedOrders = await getAllOrders(userToFetch);
+      const fetchedOrders = await getAllOrders(userToFetch, 200, 'summary');
       setOrders(fetchedOrders);
       } catch (error) {
         console.error('Ошибка загрузки заказов:', error);
@@ -749,6 +811,15 @@ const OrdersPage: React.FC = () => {
                        <Box display="flex" flexDirection="column" gap={1}>
                          {order.files && order.files.length > 0 && (
                            <>
+                             {/* Миниатюры: несколько КБ вместо скачивания файла целиком */}
+                             <Box display="flex" gap={1} flexWrap="wrap">
+                               {order.files
+                                 .filter(name => PREVIEWABLE_EXTENSIONS.some(ext => name.toLowerCase().endsWith(ext)))
+                                 .map(name => (
+                                   <PreviewThumbnail key={name} orderId={order.id!} name={name} />
+                                 ))}
+                             </Box>
+
                              {/* Основная кнопка - отправить в Telegram */}
                              {!isAdminView && currentUser && (
                                <Button 
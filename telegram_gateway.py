@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Общий шлюз Telegram Bot API для backend и бота
+
+Оба процесса ходят в Bot API через этот локальный сервис (TELEGRAM_GATEWAY_URL),
+а он держит на токен один пул соединений к Telegram (через TELEGRAM_PROXY_URL),
+один token bucket для отправки сообщений и одно состояние 429: если Telegram
+ответил Too Many Requests одному процессу, пауза действует и для другого.
+
+Запросы пересылаются как есть: /bot<token>/<метод> и /file/bot<token>/<путь>.
+Если ждать свободного слота дольше TELEGRAM_GATEWAY_MAX_WAIT_SECONDS, шлюз сразу
+отвечает обычным для Bot API 429 с retry_after — backend и PTB его уже понимают.
+
+    python telegram_gateway.py
+"""
+
+import os
+import asyncio
+import json
+import logging
+import math
+import socket
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger("telegram_gateway")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
+TELEGRAM_FORCE_IPV4 = os.getenv("TELEGRAM_FORCE_IPV4", "true").lower() == "true"
+TELEGRAM_PROXY_URL = os.getenv("TELEGRAM_PROXY_URL", "").strip()
+# Настоящий Bot API (или stand-in для тестов); клиенты шлюза используют TELEGRAM_GATEWAY_URL
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").strip().rstrip("/") or "https://api.telegram.org"
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_GATEWAY_LISTEN = os.getenv("TELEGRAM_GATEWAY_LISTEN", "127.0.0.1").strip()
+TELEGRAM_GATEWAY_PORT = int(os.getenv("TELEGRAM_GATEWAY_PORT", "8091"))
+# Чтение ответа: покрывает long polling getUpdates и загрузку файлов до 50MB
+TELEGRAM_GATEWAY_READ_TIMEOUT = max(10.0, float(os.getenv("TELEGRAM_GATEWAY_READ_TIMEOUT", "90")))
+TELEGRAM_GATEWAY_MAX_CONNECTIONS = max(1, int(os.getenv("TELEGRAM_GATEWAY_MAX_CONNECTIONS", "20")))
+# Общий лимит отправки на токен (Telegram допускает около 30 сообщений в секунду)
+TELEGRAM_GATEWAY_RATE_PER_SECOND = max(0.1, float(os.getenv("TELEGRAM_GATEWAY_RATE_PER_SECOND", "25")))
+TELEGRAM_GATEWAY_BURST = max(1, int(os.getenv("TELEGRAM_GATEWAY_BURST", "25")))
+# Суммарное ожидание слота на один запрос. Должно быть меньше read timeout клиентов
+# (TELEGRAM_READ_TIMEOUT у бота 8 сек): иначе клиент уже сдался и повторит запрос,
+# а шлюз все равно отправит сообщение — получится дубль
+TELEGRAM_GATEWAY_MAX_WAIT_SECONDS = max(0.0, float(os.getenv("TELEGRAM_GATEWAY_MAX_WAIT_SECONDS", "5")))
+TELEGRAM_CLIENT_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "8"))
+
+# Методы, которые расходуют лимит отправки; остальные (getUpdates, getMe, setWebhook...) идут без очереди
+RATE_LIMITED_METHODS = {
+    "sendmessage", "senddocument", "sendphoto", "sendvideo", "sendaudio", "sendvoice", "sendanimation",
+    "sendsticker", "sendmediagroup", "sendlocation", "sendcontact", "sendpoll", "senddice",
+    "forwardmessage", "forwardmessages", "copymessage", "copymessages",
+    "editmessagetext", "editmessagecaption", "editmessagemedia", "editmessagereplymarkup",
+    "answercallbackquery",
+}
+# Заголовки запроса, которые имеет смысл передавать в Telegram
+FORWARDED_REQUEST_HEADERS = ("content-type", "content-length", "accept")
+
+if TELEGRAM_FORCE_IPV4:
+    _original_getaddrinfo = socket.getaddrinfo
+
+    def _telegram_ipv4_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        if host == "api.telegram.org":
+            family = socket.AF_INET
+        return _original_getaddrinfo(host, port, family, type, proto, flags)
+
+    socket.getaddrinfo = _telegram_ipv4_getaddrinfo
+
+def get_telegram_proxy_url() -> str:
+    """Использует DNS-разрешение SOCKS-прокси, а не заблокированный маршрут VPS."""
+    if TELEGRAM_PROXY_URL.startswith("socks5://"):
+        return f"socks5h://{TELEGRAM_PROXY_URL[len('socks5://'):]}"
+    return TELEGRAM_PROXY_URL
+
+def mask_token(token: str) -> str:
+    return f"{token.split(':', 1)[0]}:***"
+
+@dataclass
+class TokenState:
+    """Лимит отправки и пауза после 429 для одного токена."""
+    tokens: float = float(TELEGRAM_GATEWAY_BURST)
+    updated_at: float = field(default_factory=time.monotonic)
+    blocked_until: float = 0.0
+    sent: int = 0
+    throttled: int = 0
+    rejected: int = 0
+    upstream_429: int = 0
+
+    def reserve(self) -> float:
+        """Резервирует слот и возвращает, сколько секунд до него ждать.
+
+        Токенов может стать меньше нуля: так ожидающие выстраиваются в очередь
+        по порядку резервирования без отдельной блокировки.
+        """
+        now = time.monotonic()
+        self.tokens = min(float(TELEGRAM_GATEWAY_BURST), self.tokens + (now - self.updated_at) * TELEGRAM_GATEWAY_RATE_PER_SECOND)
+        self.updated_at = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / TELEGRAM_GATEWAY_RATE_PER_SECOND)
+
+    def refund(self):
+        self.tokens += 1
+
+    def block_wait(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+class TelegramGateway:
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.states: Dict[str, TokenState] = {}
+
+    async def startup(self):
+        self.client = httpx.AsyncClient(
+            proxy=get_telegram_proxy_url() or None,
+            timeout=httpx.Timeout(TELEGRAM_GATEWAY_READ_TIMEOUT, connect=TELEGRAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=TELEGRAM_GATEWAY_MAX_CONNECTIONS,
+                max_keepalive_connections=TELEGRAM_GATEWAY_MAX_CONNECTIONS,
+            ),
+            trust_env=False,
+        )
+        logger.info(
+            f"🚦 Шлюз Telegram: {TELEGRAM_GATEWAY_RATE_PER_SECOND:g} сообщений/с, "
+            f"пул {TELEGRAM_GATEWAY_MAX_CONNECTIONS}, proxy {'включен' if TELEGRAM_PROXY_URL else 'нет'}"
+        )
+        if TELEGRAM_GATEWAY_MAX_WAIT_SECONDS >= TELEGRAM_CLIENT_READ_TIMEOUT:
+            logger.warning(
+                f"⚠️ TELEGRAM_GATEWAY_MAX_WAIT_SECONDS={TELEGRAM_GATEWAY_MAX_WAIT_SECONDS:g} не меньше "
+                f"TELEGRAM_READ_TIMEOUT={TELEGRAM_CLIENT_READ_TIMEOUT:g}: клиенты будут сдаваться раньше шлюза "
+                f"и повторять уже отправленные сообщения"
+            )
+
+    async def shutdown(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    def too_many_requests(self, state: TokenState, wait_seconds: float) -> JSONResponse:
+        state.rejected += 1
+        retry_after = max(1, math.ceil(wait_seconds))
+        return JSONResponse(
+            {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            },
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    async def acquire_send_slot(self, state: TokenState) -> Optional[float]:
+        """Ждет паузу 429 и слот token bucket; число секунд — ждать слишком долго.
+
+        Срок общий на весь запрос: паузы после нескольких 429 подряд складываются.
+        """
+        deadline = time.monotonic() + TELEGRAM_GATEWAY_MAX_WAIT_SECONDS
+        waited = False
+        while True:
+            block_wait = state.block_wait()
+            if block_wait > 0:
+                if time.monotonic() + block_wait > deadline:
+                    return block_wait
+                waited = True
+                await asyncio.sleep(block_wait)
+                continue
+            wait = state.reserve()
+            if time.monotonic() + wait > deadline:
+                state.refund()
+                return wait
+            if wait > 0:
+                waited = True
+                await asyncio.sleep(wait)
+                # За время ожидания Telegram мог ответить 429 другому запросу
+                if state.block_wait() > 0:
+                    state.refund()
+                    continue
+            if waited:
+                state.throttled += 1
+            return None
+
+    def remember_rate_limit(self, state: TokenState, token: str, method: str, body: bytes):
+        """429 от Telegram ставит паузу для всех клиентов шлюза с этим токеном."""
+        retry_after = 1.0
+        try:
+            parameters = json.loads(body).get("parameters") or {}
+            if isinstance(parameters.get("retry_after"), (int, float)):
+                retry_after = max(retry_after, float(parameters["retry_after"]))
+        except Exception:
+            pass
+        state.upstream_429 += 1
+        state.blocked_until = max(state.blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"⏳ Telegram вернул 429 на {method} ({mask_token(token)}): пауза {retry_after:.0f} сек для всех клиентов")
+
+    async def forward(self, request: Request) -> Response:
+        path = request.url.path
+        is_file = path.startswith("/file/bot")
+        prefix = "/file/bot" if is_file else "/bot"
+        if not path.startswith(prefix) or "/" not in path[len(prefix):]:
+            return JSONResponse({"ok": False, "error_code": 404, "description": "Not Found"}, status_code=404)
+        token, _, method = path[len(prefix):].partition("/")
+        state = self.states.setdefault(token, TokenState())
+
+        if not is_file and method.lower() in RATE_LIMITED_METHODS:
+            wait = await self.acquire_send_slot(state)
+            if wait is not None:
+                return self.too_many_requests(state, wait)
+            state.sent += 1
+
+        upstream_request = self.client.build_request(
+            request.method,
+            f"{TELEGRAM_API_BASE_URL}{path}",
+            params=request.query_params,
+            headers={name: value for name, value in request.headers.items() if name in FORWARDED_REQUEST_HEADERS},
+            content=request.stream() if request.method in ("POST", "PUT") else None,
+        )
+        try:
+            upstream = await self.client.send(upstream_request, stream=True)
+        except httpx.HTTPError as e:
+            logger.warning(f"⚠️ Telegram API недоступен для {method}: {type(e).__name__}")
+            return JSONResponse({"ok": False, "error_code": 502, "description": "Bad Gateway: Telegram API unavailable"}, status_code=502)
+
+        if is_file:
+            # Файлы отдаем потоком, не собирая в памяти
+            headers = {
+                name: value for name, value in upstream.headers.items()
+                if name in ("content-type", "content-length", "content-encoding")
+            }
+            return StreamingResponse(
+                upstream.aiter_raw(), status_code=upstream.status_code, headers=headers,
+                background=BackgroundTask(upstream.aclose),
+            )
+
+        try:
+            body = await upstream.aread()
+        finally:
+            await upstream.aclose()
+        if upstream.status_code == 429:
+            self.remember_rate_limit(state, token, method, body)
+        return Response(body, status_code=upstream.status_code, media_type=upstream.headers.get("content-type"))
+
+    async def health(self, request: Request) -> JSONResponse:
+        return JSONResponse({
+            "status": "ok",
+            "tokens": {
+                mask_token(token): {
+                    "sent": state.sent,
+                    "throttled": state.throttled,
+                    "rejected": state.rejected,
+                    "upstream_429": state.upstream_429,
+                    "blocked_for_seconds": round(state.block_wait(), 1),
+                }
+                for token, state in self.states.items()
+            },
+        })
+
+    def create_app(self) -> Starlette:
+        @asynccontextmanager
+        async def lifespan(app: Starlette):
+            await self.startup()
+            try:
+                yield
+            finally:
+                await self.shutdown()
+
+        return Starlette(
+            routes=[
+                Route("/healthz", self.health, methods=["GET"]),
+                Route("/{path:path}", self.forward, methods=["GET", "POST"]),
+            ],
+            lifespan=lifespan,
+        )
+
+def main():
+    logger.info(f"🚀 Шлюз Telegram слушает {TELEGRAM_GATEWAY_LISTEN}:{TELEGRAM_GATEWAY_PORT} -> {TELEGRAM_API_BASE_URL}")
+    uvicorn.run(
+        TelegramGateway().create_app(),
+        host=TELEGRAM_GATEWAY_LISTEN,
+        port=TELEGRAM_GATEWAY_PORT,
+        log_level="warning",
+        access_log=False,
+    )
+
+if __name__ == "__main__":
+    main()